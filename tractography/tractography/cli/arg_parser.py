@@ -110,6 +110,137 @@ def get_parser():
         "to T1w space and a structural connectome will be computed via "
         "tck2connectome. Mutually exclusive with --roi-dir.",
     )
+    g_other.add_argument(
+        "--roi-cache-dir",
+        "--roi_cache_dir",
+        action="store",
+        type=Path,
+        default=None,
+        metavar="PATH",
+        help="Directory caching merged ROI parcellations, keyed by the "
+        "content of the ROI files, so that a ROI set is merged once for "
+        "all subjects and runs. Default: <work-dir>/roi_cache",
+    )
+    g_other.add_argument(
+        "--roi-cache-max-size",
+        "--roi_cache_max_size",
+        action="store",
+        type=float,
+        default=1024,
+        metavar="MB",
+        help="Size of the ROI cache; least recently used parcellations are "
+        "evicted beyond it. 0 disables the cache. Default: 1024",
+    )
+    g_other.add_argument(
+        "--connectome-engine",
+        "--connectome_engine",
+        action="store",
+        choices=["tck2connectome", "python"],
+        default="tck2connectome",
+        help="How to compute the structural connectome. 'tck2connectome' "
+        "runs MRtrix3 and produces the streamline count matrix only. "
+        "'python' streams the tractogram once and additionally writes "
+        "length-sum, mean-length, length-std, inverse-length and "
+        "inverse-node-volume connectomes. Default: tck2connectome",
+    )
+    g_other.add_argument(
+        "--compress-streamlines",
+        "--compress_streamlines",
+        action="store",
+        type=float,
+        default=None,
+        metavar="MM",
+        help="Also store the output tractogram in lossy-compressed form: "
+        "points within this distance (mm) of a straight piece of streamline "
+        "are dropped, and coordinates are stored with "
+        "--compressed-precision. The settings and measured errors are "
+        "recorded in a JSON sidecar. Default: store the tractogram "
+        "uncompressed only",
+    )
+    g_other.add_argument(
+        "--compressed-precision",
+        "--compressed_precision",
+        action="store",
+        choices=["float16", "float32"],
+        default="float16",
+        help="Coordinate type of compressed tractograms. float16 halves the "
+        "size again but is not readable by MRtrix3, so these files get the "
+        ".tck16 extension; decompress them with "
+        "tractography.utils.compress_tck.decompress_tck. Default: float16",
+    )
+    g_other.add_argument(
+        "--compressed-only",
+        "--compressed_only",
+        action="store_true",
+        default=False,
+        help="With --compress-streamlines, do not store the uncompressed "
+        "float32 tractogram.",
+    )
+    g_other.add_argument(
+        "--trx",
+        action="store_true",
+        default=False,
+        help="Also write the tractogram in the TRX format (uncompressed zip "
+        "of raw arrays, with the length of every streamline), which can be "
+        "memory-mapped without parsing.",
+    )
+    g_other.add_argument(
+        "--report-format",
+        "--report_format",
+        action="store",
+        choices=["svg", "png", "webp"],
+        default="svg",
+        help="Format of the static report figures. png and webp figures are "
+        "rasterised, so their size and rendering time do not grow with the "
+        "number of voxels or streamlines drawn. Default: svg",
+    )
+    g_other.add_argument(
+        "--report-dpi",
+        "--report_dpi",
+        action="store",
+        type=int,
+        default=100,
+        help="Resolution of png and webp report figures. Default: 100",
+    )
+    g_other.add_argument(
+        "--report-figure-budget",
+        "--report_figure_budget",
+        action="store",
+        type=float,
+        default=1024,
+        metavar="KB",
+        help="Largest size of each png or webp report figure; figures are "
+        "compressed harder, then downscaled, until they fit. 0 disables "
+        "the budget. Default: 1024",
+    )
+    g_other.add_argument(
+        "--report-sidecar-figures",
+        "--report_sidecar_figures",
+        action="store_true",
+        default=False,
+        help="Store png and webp report figures in a directory next to the "
+        "report instead of embedding them as base64.",
+    )
+    g_other.add_argument(
+        "--report-mesh-triangles",
+        "--report_mesh_triangles",
+        action="store",
+        type=int,
+        default=10000,
+        metavar="N",
+        help="Decimate each pial surface of the interactive connectome to at "
+        "most N triangles, caching the result in <work-dir>/mesh_cache. 0 "
+        "keeps the full resolution. Default: 10000",
+    )
+    g_other.add_argument(
+        "--report-shared-js",
+        "--report_shared_js",
+        action="store_true",
+        default=False,
+        help="Write the JavaScript of the interactive connectome once to the "
+        "derivatives root and reference it from every report, instead of "
+        "embedding a copy in each one. Reports then need that file.",
+    )
     g_other.add_argument(
         "-w",
         "--work-dir",
@@ -0,0 +1,83 @@
+import nibabel
+import numpy as np
+import pytest
+from nilearn import datasets
+from nilearn.surface import load_surf_mesh
+
+from tractography.utils.decimate import decimated_surface
+from tractography.workflows.report import plot_connectome_interactive
+
+
+@pytest.fixture
+def fsaverage():
+    # fsaverage5 ships with nilearn, as gzipped GIfTI files
+    return datasets.fetch_surf_fsaverage()
+
+
+@pytest.fixture
+def connectome(tmp_path):
+    volume = np.zeros((10, 10, 10), dtype=np.int16)
+    volume[1:4, 1:4, 1:4] = 1
+    volume[6:9, 1:4, 1:4] = 2
+    volume[1:4, 6:9, 6:9] = 3
+    parcellation = tmp_path / "parcellation.nii.gz"
+    nibabel.save(nibabel.Nifti1Image(volume, np.eye(4)), parcellation)
+    connectome_file = tmp_path / "connectome.csv"
+    np.savetxt(
+        connectome_file,
+        [[0, 5, 2], [0, 0, 7], [0, 0, 0]],
+        fmt="%d",
+        delimiter=",",
+    )
+    return str(connectome_file), str(parcellation)
+
+
+def test_decimated_surface_gzipped_gifti(fsaverage, tmp_path):
+    n_triangles = len(load_surf_mesh(fsaverage["pial_left"]).faces)
+    vertices, triangles = decimated_surface(
+        fsaverage["pial_left"], n_triangles // 4, tmp_path
+    )
+    assert 0 < len(triangles) <= n_triangles // 4
+    assert triangles.max() < len(vertices)
+
+    cached = decimated_surface(
+        fsaverage["pial_left"], n_triangles // 4, tmp_path
+    )
+    assert len(list(tmp_path.glob("decimated_*.npz"))) == 1
+    np.testing.assert_array_equal(cached[1], triangles)
+
+
+@pytest.mark.parametrize("hemispheres", [None, ["hemi-L"]])
+def test_interactive_connectome_fsaverage_fallback(
+    fsaverage, connectome, tmp_path, hemispheres
+):
+    connectome_file, parcellation = connectome
+    surfaces = None
+    if hemispheres is not None:
+        # A subject surface for the left hemisphere only
+        surfaces = [str(tmp_path / "sub-01_hemi-L_pial.surf.gii")]
+        mesh = load_surf_mesh(fsaverage["pial_left"])
+        nibabel.save(
+            nibabel.gifti.GiftiImage(
+                darrays=[
+                    nibabel.gifti.GiftiDataArray(
+                        mesh.coordinates.astype(np.float32),
+                        intent="NIFTI_INTENT_POINTSET",
+                    ),
+                    nibabel.gifti.GiftiDataArray(
+                        mesh.faces.astype(np.int32),
+                        intent="NIFTI_INTENT_TRIANGLE",
+                    ),
+                ]
+            ),
+            surfaces[0],
+        )
+
+    html = plot_connectome_interactive(
+        connectome_file,
+        parcellation,
+        surfaces,
+        max_triangles=5000,
+        mesh_cache_dir=str(tmp_path / "mesh_cache"),
+    )
+    assert html.startswith("<iframe")
@@ -0,0 +1,36 @@
+import os
+import threading
+import time
+
+from tractography.utils.roi_cache import _locked
+
+
+def test_lock_survives_eviction_of_its_file(tmp_path):
+    holders = []
+    most = []
+    guard = threading.Lock()
+
+    def run():
+        with _locked(tmp_path, "key"):
+            with guard:
+                holders.append(1)
+                most.append(len(holders))
+            time.sleep(0.2)
+            with guard:
+                holders.pop()
+
+    # Eviction holds the lock while it deletes the lock file: one run has
+    # opened the old file and waits on it, another creates a new one
+    with _locked(tmp_path, "key", blocking=False) as acquired:
+        assert acquired
+        waiting = threading.Thread(target=run)
+        waiting.start()
+        time.sleep(0.1)
+        os.remove(tmp_path / "key.lock")
+        fresh = threading.Thread(target=run)
+        fresh.start()
+        time.sleep(0.1)
+    waiting.join()
+    fresh.join()
+
+    assert max(most) == 1
@@ -0,0 +1,52 @@
+import nibabel
+import nimesh
+import numpy as np
+from scipy.spatial import ConvexHull
+
+from tractography.utils.signed_distance import signed_distance_volume
+
+
+def _sphere(path, radius, centre):
+    """Save a closed sphere mesh with outward triangles."""
+
+    n = 1000
+    # Fibonacci points, spread evenly over the sphere
+    z = np.linspace(1 - 1 / n, 1 / n - 1, n)
+    angle = np.pi * (3 - np.sqrt(5)) * np.arange(n)
+    ring = np.sqrt(1 - z**2)
+    directions = np.column_stack(
+        (ring * np.cos(angle), ring * np.sin(angle), z)
+    )
+    triangles = ConvexHull(directions).simplices
+    corners = directions[triangles]
+    normals = np.cross(
+        corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]
+    )
+    inward = np.einsum("ij,ij->i", normals, corners.mean(axis=1)) < 0
+    triangles[inward] = triangles[inward][:, ::-1]
+    nimesh.io.save(
+        str(path), nimesh.Mesh(centre + radius * directions, triangles)
+    )
+
+
+def test_band_box_matches_clipped_full_volume(tmp_path):
+    surface = tmp_path / "sphere.gii"
+    _sphere(surface, 10, [1, 2, 3])
+    affine = np.array(
+        [[0.8, 0, 0, -16], [0, 0.8, 0, -16], [0, 0, 1, -15], [0, 0, 0, 1]]
+    )
+    reference = nibabel.Nifti1Image(np.zeros((40, 44, 36)), affine)
+
+    full = signed_distance_volume(surface, reference)
+    assert full.min() < -9 and full.max() > 9
+
+    # The box reaches past the part of the grid around the surface
+    low, high = np.array([3, 4, 5]), np.array([37, 40, 30])
+    banded = signed_distance_volume(
+        surface, reference, dtype=np.float32, band=3.0, box=(low, high)
+    )
+    expected = np.clip(full, -3, 3)[
+        tuple(slice(a, b) for a, b in zip(low, high))
+    ]
+    assert banded.shape == expected.shape
+    np.testing.assert_allclose(banded, expected, atol=1e-5)
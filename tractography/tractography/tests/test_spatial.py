@@ -0,0 +1,50 @@
+import numpy as np
+
+from tractography.utils.spatial import compare_grad_descend, grad_descend
+
+
+def _bumpy_sphere():
+    """Signed distance, descent gradient and vertices of a bumpy sphere."""
+
+    grid = np.indices((64, 64, 64), dtype=float) - 31.5
+    radius = np.sqrt((grid**2).sum(axis=0))
+    # Bumps bend the paths so the descent is not a straight line
+    signed_distance = radius - 20 - 2 * np.sin(grid[0] / 4) * np.cos(
+        grid[1] / 4
+    )
+    gradient = -np.array(np.gradient(signed_distance))
+
+    rng = np.random.default_rng(0)
+    directions = rng.normal(size=(2000, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    return signed_distance, gradient, 31.5 + 22 * directions
+
+
+def test_rk2_fewer_evaluations_on_1mm_grid():
+    _, gradient, vertices = _bumpy_sphere()
+    weight = [1.0, 1.0, 1.0]
+
+    positions, comparison = compare_grad_descend(
+        vertices, gradient, dist=2, weight=weight, method="rk2"
+    )
+    assert comparison["evaluations"] < comparison["euler_evaluations"] / 2
+
+    # Accurate reference from much smaller fixed steps
+    reference = grad_descend(
+        vertices, gradient, dist=2, weight=weight, step_size=0.005
+    )
+    euler = grad_descend(vertices, gradient, dist=2, weight=weight)
+    rk2_error = np.linalg.norm(positions - reference, axis=1).mean()
+    euler_error = np.linalg.norm(euler - reference, axis=1).mean()
+    assert rk2_error <= euler_error
+
+
+def test_scalar_field_descends_its_gradient():
+    signed_distance, gradient, vertices = _bumpy_sphere()
+
+    for method in ("euler", "rk2"):
+        expected = grad_descend(vertices, gradient, dist=2, method=method)
+        positions = grad_descend(
+            vertices, signed_distance, dist=2, method=method
+        )
+        np.testing.assert_allclose(positions, expected, atol=1e-6)
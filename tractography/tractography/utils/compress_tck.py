@@ -0,0 +1,369 @@
+import json
+import os
+
+import numpy as np
+
+from tractography.utils.read_tck import _read_tck_header, iter_tck
+from tractography.utils.streamlines import Streamlines
+from tractography.utils.write_tck import TCKWriter
+
+# TCK datatype used for each coordinate precision
+PRECISIONS = {"float16": "Float16LE", "float32": "Float32LE"}
+# File extension of compressed tractograms; Float16LE files, which MRtrix3
+# cannot read, do not use .tck so that tools globbing *.tck skip them
+EXTENSIONS = {"float16": ".tck16", "float32": ".tck"}
+
+
+def _segment_distance_sq(points, starts, stops):
+    """Squared distance of each point to the segment between two others."""
+
+    ab = stops - starts
+    ap = points - starts
+    norm_sq = np.einsum("ij,ij->i", ab, ab)
+    t = np.divide(
+        np.einsum("ij,ij->i", ap, ab),
+        norm_sq,
+        out=np.zeros(len(points)),
+        where=norm_sq > 0,
+    )
+    np.clip(t, 0.0, 1.0, out=t)
+    offset = ap - t[:, None] * ab
+    return np.einsum("ij,ij->i", offset, offset)
+
+
+def _linearize(points, offsets, lengths, tolerance, max_segment_length):
+    """Mask of the points kept by the linearization of all streamlines.
+
+    This is the Douglas-Peucker simplification run on every streamline at
+    once: each round considers all pending spans (first and last kept
+    point of a piece of streamline), measures the distance of every inner
+    point to the chord with a single vectorised pass, and splits the spans
+    whose farthest point is beyond ``tolerance`` (or whose chord is longer
+    than ``max_segment_length``) at that point. The number of rounds is the
+    depth of the recursion, not the number of streamlines.
+    """
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[offsets] = True
+    keep[offsets + lengths - 1] = True
+
+    long_enough = lengths > 2
+    starts = offsets[long_enough]
+    stops = (offsets + lengths - 1)[long_enough]
+
+    while len(starts):
+        n_inner = stops - starts - 1
+        span_starts = np.zeros(len(starts), dtype=np.int64)
+        np.cumsum(n_inner[:-1], out=span_starts[1:])
+        span = np.repeat(np.arange(len(starts)), n_inner)
+        inner = np.arange(int(n_inner.sum()), dtype=np.int64)
+        inner += np.repeat(starts + 1 - span_starts, n_inner)
+
+        distance = _segment_distance_sq(
+            points[inner], points[starts][span], points[stops][span]
+        )
+        farthest = np.maximum.reduceat(distance, span_starts)
+        chord = np.linalg.norm(points[stops] - points[starts], axis=1)
+        too_far = farthest > tolerance**2
+        split = too_far | (chord > max_segment_length)
+
+        # First point reaching the largest distance of its span; spans only
+        # split for their length are cut in the middle
+        candidates = np.where(
+            distance == farthest[span], inner, np.iinfo(np.int64).max
+        )
+        at = np.where(
+            too_far,
+            np.minimum.reduceat(candidates, span_starts),
+            (starts + stops) // 2,
+        )[split]
+        keep[at] = True
+
+        starts = np.concatenate((starts[split], at))
+        stops = np.concatenate((at, stops[split]))
+        pending = stops - starts > 1
+        starts, stops = starts[pending], stops[pending]
+
+    return keep
+
+
+def compress_streamlines(streamlines, tolerance=0.1, max_segment_length=10.0):
+    """Drop the points of each streamline that lie on a straight piece.
+
+    Every removed point is within ``tolerance`` of the polyline through the
+    kept points, and both endpoints are always kept.
+
+    Parameters
+    ----------
+    streamlines : Streamlines
+        Streamlines to compress
+    tolerance : float
+        Largest distance (mm) allowed between a removed point and the
+        compressed streamline
+    max_segment_length : float
+        Largest distance (mm) between two consecutive kept points, unless
+        they were already consecutive
+
+    Returns
+    -------
+    compressed : Streamlines
+        Packed streamlines, in the dtype of the input
+    """
+
+    if tolerance < 0:
+        raise ValueError(f"tolerance must be non-negative, got {tolerance}")
+    if not streamlines.is_packed:
+        streamlines = streamlines.packed()
+    if not len(streamlines):
+        return streamlines
+
+    keep = _linearize(
+        np.asarray(streamlines.points, dtype=np.float64),
+        streamlines.offsets,
+        streamlines.lengths,
+        tolerance,
+        max_segment_length,
+    )
+    ids = np.repeat(np.arange(len(streamlines)), streamlines.lengths)
+    lengths = np.bincount(ids[keep], minlength=len(streamlines))
+    return Streamlines(streamlines.points[keep], lengths=lengths)
+
+
+def resample_streamlines(streamlines, step_size):
+    """Resample streamlines to equally spaced points along their length.
+
+    Each streamline keeps its endpoints and is split into the smallest
+    number of equal steps no longer than ``step_size``. All streamlines are
+    interpolated together on the cumulative arc length of the point array.
+
+    Returns
+    -------
+    resampled : Streamlines
+        Packed float32 streamlines
+    """
+
+    if step_size <= 0:
+        raise ValueError(f"step_size must be positive, got {step_size}")
+    if not streamlines.is_packed:
+        streamlines = streamlines.packed()
+    if not len(streamlines):
+        return streamlines
+
+    points = np.asarray(streamlines.points, dtype=np.float64)
+    offsets, lengths = streamlines.offsets, streamlines.lengths
+    last = offsets + lengths - 1
+
+    # Arc length at every point; segments between streamlines count as 0
+    segments = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    segments[offsets[1:] - 1] = 0
+    arc = np.zeros(len(points))
+    np.cumsum(segments, out=arc[1:])
+    total = arc[last] - arc[offsets]
+
+    n_steps = np.maximum(np.ceil(total / step_size).astype(np.int64), 1)
+    n_steps[lengths < 2] = 0
+    new_lengths = n_steps + 1
+    new_lengths[lengths < 1] = 0
+    ids = np.repeat(np.arange(len(streamlines)), new_lengths)
+    new_offsets = np.zeros(len(new_lengths), dtype=np.int64)
+    np.cumsum(new_lengths[:-1], out=new_offsets[1:])
+    step = np.arange(len(ids)) - new_offsets[ids]
+
+    spacing = np.divide(
+        total, n_steps, out=np.zeros(len(total)), where=n_steps > 0
+    )
+    target = arc[offsets][ids] + step * spacing[ids]
+
+    # Segment of the streamline holding each target arc length
+    segment = np.searchsorted(arc, target, side="right") - 1
+    np.clip(
+        segment,
+        offsets[ids],
+        np.maximum(last[ids] - 1, offsets[ids]),
+        out=segment,
+    )
+    following = np.minimum(segment + 1, last[ids])
+    width = arc[following] - arc[segment]
+    fraction = np.divide(
+        target - arc[segment],
+        width,
+        out=np.zeros(len(target)),
+        where=width > 0,
+    )
+    np.clip(fraction, 0.0, 1.0, out=fraction)
+    resampled = points[segment] + fraction[:, None] * (
+        points[following] - points[segment]
+    )
+    return Streamlines(resampled.astype(np.float32), lengths=new_lengths)
+
+
+def _step_size(header):
+    """Step size (mm) of the tractography, when recorded in the header."""
+    return float(header["step_size"]) if "step_size" in header else None
+
+
+def compressed_sidecar_file(tck_file):
+    """Path of the JSON sidecar describing a compressed tractogram."""
+    return os.path.splitext(str(tck_file))[0] + ".json"
+
+
+def compress_tck(
+    tck_file,
+    out_file,
+    tolerance=0.1,
+    max_segment_length=10.0,
+    precision="float16",
+    chunk_bytes=64 * 2**20,
+):
+    """Write a lossy-compressed copy of a TCK file.
+
+    The tractogram is streamed in chunks; every chunk is linearized with
+    ``compress_streamlines`` and its coordinates are stored with the given
+    precision. The compression settings and the measured errors are written
+    to a JSON sidecar next to ``out_file`` and to its header.
+
+    Parameters
+    ----------
+    tck_file : str
+        Path to the input .tck file
+    out_file : str
+        Path to the compressed file. With ``precision="float16"`` its
+        datatype is Float16LE, which MRtrix3 cannot read; use
+        ``iter_decompressed_tck`` or ``decompress_tck`` instead, and an
+        extension from ``EXTENSIONS``.
+    tolerance : float
+        Largest distance (mm) between a removed point and the compressed
+        streamline
+    max_segment_length : float
+        Largest distance (mm) between two consecutive kept points
+    precision : {"float16", "float32"}
+        Storage type of the coordinates
+    chunk_bytes : int
+        Approximate number of bytes of track data read at a time
+
+    Returns
+    -------
+    out_file : str
+        Path to the compressed .tck file
+    sidecar_file : str
+        Path to the JSON sidecar
+    """
+
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision: {precision}")
+
+    header, _, _ = _read_tck_header(tck_file)
+    header = dict(header)
+    header["compression"] = "linearization"
+    header["compression_tolerance"] = tolerance
+    header["compression_max_segment_length"] = max_segment_length
+
+    n_points_in = n_points_out = 0
+    max_rounding = 0.0
+    with TCKWriter(
+        out_file, header=header, datatype=PRECISIONS[precision]
+    ) as writer:
+        for batch in iter_tck(tck_file, chunk_bytes=chunk_bytes):
+            compressed = compress_streamlines(
+                batch, tolerance, max_segment_length
+            )
+            stored = compressed.points.astype(writer.dtype)
+            if len(stored):
+                rounding = np.linalg.norm(
+                    stored.astype(np.float64) - compressed.points, axis=1
+                )
+                max_rounding = max(max_rounding, float(rounding.max()))
+            writer.write(Streamlines(stored, lengths=compressed.lengths))
+            n_points_in += batch.n_points
+            n_points_out += compressed.n_points
+        n_streamlines = writer.count
+
+    sidecar = {
+        "Compression": "linearization",
+        "CompressionTolerance": tolerance,
+        "MaxSegmentLength": max_segment_length,
+        "CoordinatePrecision": precision,
+        "MaxCoordinateError": max_rounding,
+        "MaxGeometricError": tolerance + max_rounding,
+        "StepSize": _step_size(header),
+        "NumberOfStreamlines": n_streamlines,
+        "SourceNumberOfPoints": n_points_in,
+        "NumberOfPoints": n_points_out,
+        "CompressionRatio": (
+            os.path.getsize(tck_file) / os.path.getsize(out_file)
+        ),
+    }
+    sidecar_file = compressed_sidecar_file(out_file)
+    with open(sidecar_file, "w") as f:
+        json.dump(sidecar, f, indent=2)
+
+    return os.path.abspath(out_file), os.path.abspath(sidecar_file)
+
+
+def iter_decompressed_tck(
+    tck_file, step_size="auto", batch_size=None, chunk_bytes=64 * 2**20
+):
+    """Iterate over the streamlines of a compressed TCK file.
+
+    Batches are read with ``iter_tck``, converted to float32 and, unless
+    ``step_size`` is None, resampled to a regular step.
+
+    Parameters
+    ----------
+    tck_file : str
+        Path to a file written by ``compress_tck``
+    step_size : float, "auto" or None
+        Step (mm) of the resampled streamlines. "auto" uses the step size of
+        the original tractography, as recorded in the header, and does not
+        resample when it is missing; None returns the kept points only.
+    batch_size : int or None
+        Number of streamlines per batch, see ``iter_tck``
+    chunk_bytes : int
+        Approximate number of bytes of track data read at a time
+
+    Yields
+    ------
+    streamlines : Streamlines
+        Packed float32 streamlines
+    """
+
+    if step_size == "auto":
+        step_size = _step_size(_read_tck_header(tck_file)[0])
+
+    for batch in iter_tck(
+        tck_file, batch_size=batch_size, chunk_bytes=chunk_bytes
+    ):
+        if step_size is not None:
+            yield resample_streamlines(batch, step_size)
+        else:
+            yield Streamlines(
+                batch.points.astype(np.float32), batch.offsets, batch.lengths
+            )
+
+
+def decompress_tck(
+    tck_file, out_file, step_size="auto", chunk_bytes=64 * 2**20
+):
+    """Write a compressed tractogram back as a Float32 TCK file.
+
+    See ``iter_decompressed_tck`` for ``step_size``. The compression fields
+    are dropped from the header.
+
+    Returns
+    -------
+    out_file : str
+        Path to the decompressed .tck file
+    """
+
+    header, _, _ = _read_tck_header(tck_file)
+    header = {
+        key: value
+        for key, value in header.items()
+        if not key.startswith("compression")
+    }
+    with TCKWriter(out_file, header=header) as writer:
+        for batch in iter_decompressed_tck(
+            tck_file, step_size=step_size, chunk_bytes=chunk_bytes
+        ):
+            writer.write(batch)
+    return out_file
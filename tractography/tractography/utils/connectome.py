@@ -0,0 +1,370 @@
+import hashlib
+import multiprocessing
+import os
+
+import nibabel
+import numpy as np
+
+from tractography.utils.read_tck import iter_tck, tck_row_ranges
+
+# Per-edge sums accumulated while streaming; every metric is derived from
+# them once the whole tractogram has been read
+_SUMS = ("count", "length_sum", "length_sq_sum", "invlength_sum")
+
+# Metrics written by save_connectomes, with their file name suffixes
+METRICS = {
+    "count": "",
+    "lengthsum": "_lengthsum",
+    "meanlength": "_meanlength",
+    "lengthstd": "_lengthstd",
+    "invlength": "_invlength",
+    "invnodevol": "_invnodevol",
+}
+# Length of the content hash in the names of binary connectomes
+_HASH_LENGTH = 16
+
+
+def _load_parcellation(parcellation):
+    img = nibabel.load(parcellation)
+    labels = np.rint(np.asanyarray(img.dataobj)).astype(np.int32)
+    return labels, img.affine, img.header.get_zooms()[:3]
+
+
+def _search_offsets(zooms, radius):
+    """Voxel offsets within ``radius`` mm, sorted by increasing distance."""
+
+    extent = np.ceil(radius / np.asarray(zooms)).astype(int)
+    grid = np.mgrid[tuple(slice(-e, e + 1) for e in extent)].reshape(3, -1).T
+    distance = np.linalg.norm(grid * np.asarray(zooms), axis=1)
+    inside = distance <= radius
+    order = np.argsort(distance[inside], kind="stable")
+    return grid[inside][order]
+
+
+def _assign_nodes(points, labels, world_to_voxel, offsets):
+    """Label of the parcel each endpoint belongs to, 0 for none.
+
+    An endpoint outside every parcel gets the label of the nearest labelled
+    voxel within the search radius, like the default radial search of
+    tck2connectome. The search loops over the (few hundred) offsets, each
+    step being vectorised over all unassigned endpoints.
+    """
+
+    shape = np.array(labels.shape)
+    voxels = np.rint(
+        nibabel.affines.apply_affine(world_to_voxel, points)
+    ).astype(np.int64)
+    nodes = np.zeros(len(points), dtype=np.int32)
+    pending = np.arange(len(points))
+
+    for offset in offsets:
+        if not len(pending):
+            break
+        candidate = voxels[pending] + offset
+        inside = np.all((candidate >= 0) & (candidate < shape), axis=1)
+        found = np.zeros(len(pending), dtype=np.int32)
+        found[inside] = labels[tuple(candidate[inside].T)]
+        nodes[pending] = found
+        pending = pending[found == 0]
+
+    return nodes
+
+
+def _connectome_range(args):
+    """Edge sums over the streamlines starting in one row range."""
+
+    tck_file, row_range, parcellation, radius, chunk_bytes = args
+    labels, affine, zooms = _load_parcellation(parcellation)
+    world_to_voxel = np.linalg.inv(affine)
+    offsets = _search_offsets(zooms, radius)
+    n_nodes = int(labels.max())
+
+    sums = {name: np.zeros(n_nodes * n_nodes) for name in _SUMS}
+    for streamlines in iter_tck(
+        tck_file, chunk_bytes=chunk_bytes, row_range=row_range
+    ):
+        first = streamlines.offsets
+        last = first + streamlines.lengths - 1
+        endpoints = np.asarray(
+            streamlines.points[np.concatenate((first, last))],
+            dtype=np.float64,
+        )
+        nodes = _assign_nodes(endpoints, labels, world_to_voxel, offsets)
+        node_a, node_b = nodes[: len(first)], nodes[len(first) :]
+
+        connected = (node_a > 0) & (node_b > 0)
+        row = np.minimum(node_a, node_b)[connected].astype(np.int64) - 1
+        col = np.maximum(node_a, node_b)[connected].astype(np.int64) - 1
+        edges = row * n_nodes + col
+        lengths = streamlines.arc_lengths()[connected]
+
+        size = n_nodes * n_nodes
+        sums["count"] += np.bincount(edges, minlength=size)
+        sums["length_sum"] += np.bincount(
+            edges, weights=lengths, minlength=size
+        )
+        sums["length_sq_sum"] += np.bincount(
+            edges, weights=lengths**2, minlength=size
+        )
+        sums["invlength_sum"] += np.bincount(
+            edges,
+            weights=np.divide(
+                1.0, lengths, out=np.zeros_like(lengths), where=lengths > 0
+            ),
+            minlength=size,
+        )
+
+    return sums
+
+
+def compute_connectomes(
+    tck_file,
+    parcellation,
+    radius=4.0,
+    n_jobs=1,
+    chunk_bytes=64 * 2**20,
+):
+    """Compute several structural connectomes in a single pass.
+
+    Both endpoints of every streamline are looked up in the parcellation,
+    and per-edge sums of the streamline count, length, squared length and
+    inverse length are accumulated with ``bincount`` on the node pair
+    indices. All metrics are derived from these sums, so the tractogram is
+    read once whatever the number of connectomes.
+
+    Parameters
+    ----------
+    tck_file : str
+        Path to .tck file
+    parcellation : str
+        Path to the parcellation NIfTI, in the space of the streamlines.
+        Node ``i`` of the connectomes is the parcel labelled ``i + 1``.
+    radius : float
+        Radius (mm) of the search for the nearest parcel around endpoints
+        that are not inside one
+    n_jobs : int or None
+        Number of processes, each streaming a range of the file; None uses
+        all CPUs
+    chunk_bytes : int
+        Approximate number of bytes of track data read at a time
+
+    Returns
+    -------
+    connectomes : dict of ndarray
+        Upper-triangular ``(n_nodes, n_nodes)`` matrices, as written by
+        tck2connectome, keyed by the names in ``METRICS``: streamline count,
+        sum of lengths, mean and standard deviation of lengths, sum of
+        inverse lengths, and count scaled by the inverse of the mean volume
+        (in voxels) of both nodes
+    """
+
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+    tasks = [
+        (str(tck_file), row_range, str(parcellation), radius, chunk_bytes)
+        for row_range in tck_row_ranges(tck_file, n_jobs)
+    ]
+
+    if len(tasks) > 1:
+        with multiprocessing.Pool(len(tasks)) as pool:
+            partials = pool.map(_connectome_range, tasks)
+        sums = {name: sum(p[name] for p in partials) for name in _SUMS}
+    else:
+        sums = _connectome_range(tasks[0])
+
+    labels, _, _ = _load_parcellation(parcellation)
+    n_nodes = int(labels.max())
+    volumes = np.bincount(labels[labels > 0], minlength=n_nodes + 1)[1:]
+    sums = {name: s.reshape(n_nodes, n_nodes) for name, s in sums.items()}
+
+    count = sums["count"]
+    has_streamlines = count > 0
+    mean = np.divide(
+        sums["length_sum"],
+        count,
+        out=np.zeros_like(count),
+        where=has_streamlines,
+    )
+    mean_sq = np.divide(
+        sums["length_sq_sum"],
+        count,
+        out=np.zeros_like(count),
+        where=has_streamlines,
+    )
+    pair_volume = (volumes[:, None] + volumes[None, :]) / 2.0
+
+    return {
+        "count": count,
+        "lengthsum": sums["length_sum"],
+        "meanlength": mean,
+        "lengthstd": np.sqrt(np.maximum(mean_sq - mean**2, 0)),
+        "invlength": sums["invlength_sum"],
+        "invnodevol": np.divide(
+            count,
+            pair_volume,
+            out=np.zeros_like(count),
+            where=pair_volume > 0,
+        ),
+    }
+
+
+def label_centroids(parcellation):
+    """Centre of mass of every label of a parcellation, in one pass.
+
+    The labels are read as integers, and the voxel coordinates of all
+    labelled voxels are summed per label with ``bincount``, instead of
+    scanning the volume once per label.
+
+    Returns
+    -------
+    labels : ndarray of int
+        Labels present in the parcellation, in increasing order, without 0
+    centroids : ndarray, shape (len(labels), 3)
+        World coordinates (mm) of the centre of mass of each label
+    n_voxels : ndarray of int
+        Number of voxels of each label
+    """
+
+    volume, affine, _ = _load_parcellation(parcellation)
+    voxels = np.flatnonzero(volume > 0)
+    voxel_labels = volume.ravel()[voxels]
+    counts = np.bincount(voxel_labels)
+    labels = np.flatnonzero(counts)
+    labels = labels[labels > 0]
+    sums = np.column_stack(
+        [
+            np.bincount(voxel_labels, weights=axis, minlength=len(counts))
+            for axis in np.unravel_index(voxels, volume.shape)
+        ]
+    )
+    centroids = nibabel.affines.apply_affine(
+        affine, sums[labels] / counts[labels, None]
+    )
+    return labels, centroids, counts[labels]
+
+
+def save_label_centroids(labels, centroids, n_voxels, out_file):
+    """Write label centroids as a TSV with columns label, x, y, z, n_voxels."""
+
+    table = np.column_stack((labels, centroids, n_voxels))
+    np.savetxt(
+        out_file,
+        table,
+        fmt=["%d", "%.6f", "%.6f", "%.6f", "%d"],
+        delimiter="\t",
+        header="label\tx\ty\tz\tn_voxels",
+        comments="",
+    )
+    return out_file
+
+
+def load_label_centroids(centroids_file):
+    """Read a TSV written by ``save_label_centroids``.
+
+    Returns
+    -------
+    labels : ndarray of int
+    centroids : ndarray, shape (len(labels), 3)
+    """
+
+    table = np.loadtxt(centroids_file, delimiter="\t", skiprows=1, ndmin=2)
+    return table[:, 0].astype(int), table[:, 1:4]
+
+
+def save_connectomes(connectomes, out_dir=".", prefix="connectome"):
+    """Write connectomes as comma-separated files, like tck2connectome.
+
+    Returns
+    -------
+    out_files : dict of str
+        Path of each file, keyed by metric; the streamline count is saved
+        as ``{prefix}.csv`` and every other metric as
+        ``{prefix}_{metric}.csv``
+    """
+
+    out_files = {}
+    for name, matrix in connectomes.items():
+        out_file = os.path.abspath(
+            os.path.join(out_dir, f"{prefix}{METRICS[name]}.csv")
+        )
+        fmt = "%d" if name == "count" else "%.10g"
+        np.savetxt(out_file, matrix, fmt=fmt, delimiter=",")
+        out_files[name] = out_file
+    return out_files
+
+
+def symmetrize_connectome(matrix):
+    """Mirror an upper-triangular connectome to a full float32 matrix.
+
+    tck2connectome and ``compute_connectomes`` only fill the upper
+    triangle; the diagonal is kept as is.
+    """
+
+    matrix = np.asarray(matrix, dtype=np.float32)
+    symmetric = matrix + matrix.T
+    np.fill_diagonal(symmetric, np.diagonal(matrix))
+    return symmetric
+
+
+def binary_connectome_file(connectome_file):
+    """Path of the binary companion of a connectome CSV.
+
+    The companion lies next to the CSV and its name holds a hash of the
+    CSV content, ``<stem>.<hash>.npy``, so that it is never used once the
+    CSV has changed.
+    """
+
+    digest = hashlib.sha256()
+    with open(connectome_file, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    stem = os.path.splitext(os.path.abspath(connectome_file))[0]
+    return f"{stem}.{digest.hexdigest()[:_HASH_LENGTH]}.npy"
+
+
+def save_binary_connectome(connectome_file, matrix=None):
+    """Write the binary companion of a connectome CSV, unless it exists.
+
+    The companion holds the connectome symmetrised by
+    ``symmetrize_connectome``, so readers can memory-map it instead of
+    parsing and symmetrising the CSV.
+
+    Parameters
+    ----------
+    connectome_file : str
+        Connectome CSV
+    matrix : ndarray or None
+        The connectome stored in the CSV, when already in memory; otherwise
+        the CSV is parsed
+
+    Returns
+    -------
+    out_file : str
+        Path of the companion, see ``binary_connectome_file``
+    """
+
+    out_file = binary_connectome_file(connectome_file)
+    if os.path.exists(out_file):
+        return out_file
+    if matrix is None:
+        matrix = np.loadtxt(connectome_file, delimiter=",", ndmin=2)
+    # Write next to the final name first so readers never see partial files
+    tmp_file = f"{out_file}.tmp{os.getpid()}.npy"
+    np.save(tmp_file, symmetrize_connectome(matrix))
+    os.replace(tmp_file, out_file)
+    return out_file
+
+
+def load_connectome(connectome_file):
+    """Symmetric float32 connectome of a CSV.
+
+    The binary companion written by ``save_binary_connectome`` is
+    memory-mapped when present; otherwise the CSV is parsed.
+    """
+
+    binary_file = binary_connectome_file(connectome_file)
+    if os.path.exists(binary_file):
+        return np.load(binary_file, mmap_mode="r")
+    return symmetrize_connectome(
+        np.loadtxt(connectome_file, delimiter=",", ndmin=2)
+    )
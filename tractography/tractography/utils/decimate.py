@@ -0,0 +1,158 @@
+import hashlib
+import os
+
+import numpy as np
+from nilearn.surface import load_surf_mesh
+
+# Bumped whenever decimation changes its output for the same inputs
+_CACHE_VERSION = 1
+# Largest number of cell size refinements tried to meet a triangle budget
+_MAX_ITERATIONS = 20
+
+
+def _cluster_vertices(vertices, triangles, cell_size):
+    """Merge the vertices falling in the same cell of a regular grid.
+
+    Every cluster is replaced by the mean of its vertices. Triangles with
+    two corners in the same cluster collapse and are dropped, as are
+    duplicates; the others keep their orientation.
+    """
+
+    cells = np.floor((vertices - vertices.min(axis=0)) / cell_size)
+    _, clusters = np.unique(
+        cells.astype(np.int64), axis=0, return_inverse=True
+    )
+    clusters = clusters.ravel()
+    n_clusters = clusters.max() + 1
+
+    counts = np.bincount(clusters, minlength=n_clusters)
+    new_vertices = np.column_stack(
+        [
+            np.bincount(clusters, weights=coordinate, minlength=n_clusters)
+            for coordinate in vertices.T
+        ]
+    )
+    new_vertices /= counts[:, None]
+
+    new_triangles = clusters[triangles]
+    collapsed = (
+        (new_triangles[:, 0] == new_triangles[:, 1])
+        | (new_triangles[:, 1] == new_triangles[:, 2])
+        | (new_triangles[:, 2] == new_triangles[:, 0])
+    )
+    new_triangles = new_triangles[~collapsed]
+    _, first = np.unique(
+        np.sort(new_triangles, axis=1), axis=0, return_index=True
+    )
+    new_triangles = new_triangles[np.sort(first)]
+
+    # Drop the clusters left without triangles
+    used, new_triangles = np.unique(new_triangles, return_inverse=True)
+    return new_vertices[used], new_triangles.reshape(-1, 3)
+
+
+def decimate_mesh(vertices, triangles, max_triangles):
+    """Decimate a triangle mesh to at most ``max_triangles`` triangles.
+
+    Vertices are clustered on a regular grid (see ``_cluster_vertices``),
+    whose cell size is grown until the mesh fits the budget. The cell size
+    starts from the one at which a surface of the same area is covered by
+    about ``max_triangles / 2`` cells, since a closed triangle mesh has
+    about twice as many triangles as vertices. Meshes within the budget are
+    returned unchanged.
+
+    Parameters
+    ----------
+    vertices : ndarray, shape (n_vertices, 3)
+        Vertex coordinates
+    triangles : ndarray, shape (n_triangles, 3)
+        Vertex indices of each triangle
+    max_triangles : int
+        Triangle budget
+
+    Returns
+    -------
+    vertices : ndarray
+        Decimated vertex coordinates
+    triangles : ndarray
+        Decimated triangles
+    """
+
+    vertices = np.asarray(vertices, dtype=float)
+    triangles = np.asarray(triangles)
+    if max_triangles < 1:
+        raise ValueError("max_triangles must be positive")
+    if len(triangles) <= max_triangles:
+        return vertices, triangles
+
+    corners = vertices[triangles]
+    area = 0.5 * np.linalg.norm(
+        np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]),
+        axis=1,
+    ).sum()
+    cell_size = np.sqrt(area / (max_triangles / 2))
+
+    for _ in range(_MAX_ITERATIONS):
+        new_vertices, new_triangles = _cluster_vertices(
+            vertices, triangles, cell_size
+        )
+        if len(new_triangles) <= max_triangles:
+            return new_vertices, new_triangles
+        # The number of triangles falls with the square of the cell size
+        cell_size *= 1.05 * np.sqrt(len(new_triangles) / max_triangles)
+
+    raise ValueError(
+        f"Cannot decimate the mesh to {max_triangles} triangles"
+    )
+
+
+def decimated_surface(surface_file, max_triangles, cache_dir=None):
+    """Load a surface decimated to at most ``max_triangles`` triangles.
+
+    Parameters
+    ----------
+    surface_file : str or mesh
+        Surface readable by ``nilearn.surface.load_surf_mesh``: a GIfTI or
+        FreeSurfer file, possibly gzipped like nilearn's fsaverage, or a
+        mesh object
+    max_triangles : int
+        Triangle budget, see ``decimate_mesh``
+    cache_dir : str or None
+        Directory where decimated surfaces are cached, keyed by the content
+        of the surface file and the budget; mesh objects are not cached
+
+    Returns
+    -------
+    vertices : ndarray
+        Vertex coordinates
+    triangles : ndarray
+        Triangles
+    """
+
+    cache_file = None
+    if cache_dir is not None and isinstance(surface_file, (str, os.PathLike)):
+        digest = hashlib.sha256(f"{_CACHE_VERSION}:{max_triangles}".encode())
+        with open(surface_file, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                digest.update(block)
+        cache_file = os.path.join(
+            cache_dir, f"decimated_{digest.hexdigest()}.npz"
+        )
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                return cached["vertices"], cached["triangles"]
+
+    surface = load_surf_mesh(surface_file)
+    vertices, triangles = decimate_mesh(
+        surface.coordinates, surface.faces, max_triangles
+    )
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write next to the final name first so readers never see partial
+        # files
+        tmp_file = f"{cache_file}.tmp{os.getpid()}.npz"
+        np.savez(tmp_file, vertices=vertices, triangles=triangles)
+        os.replace(tmp_file, cache_file)
+
+    return vertices, triangles
@@ -0,0 +1,125 @@
+import io
+import os
+
+# Formats figures can be saved in; png and webp are rasterised
+FIGURE_FORMATS = ("svg", "png", "webp")
+# Largest side (pixels) of rasterised figures, whatever their size in inches
+_MAX_PIXELS = 4096
+# WebP qualities tried, in order, to meet a byte budget
+_WEBP_QUALITIES = (85, 70, 55, 40)
+# Factor applied to both sides of an image that does not fit its budget at
+# any quality
+_DOWNSCALE = 0.75
+
+
+def _encodings(image, figure_format):
+    """Encodings of an image, from the best to the most compact."""
+
+    if figure_format == "webp":
+        for quality in _WEBP_QUALITIES:
+            buffer = io.BytesIO()
+            image.save(buffer, format="WEBP", quality=quality, method=4)
+            yield buffer.getvalue()
+        return
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    yield buffer.getvalue()
+    # Plots use few colours, so a 256-colour palette is usually lossless
+    # to the eye and several times smaller
+    buffer = io.BytesIO()
+    image.quantize(256).save(buffer, format="PNG", optimize=True)
+    yield buffer.getvalue()
+
+
+def encode_image(image, figure_format="png", max_bytes=None):
+    """Encode a PIL image as PNG or WebP within a byte budget.
+
+    The encodings of ``_encodings`` are tried in turn, and the image is
+    downscaled by ``_DOWNSCALE`` until one of them fits ``max_bytes``.
+
+    Returns
+    -------
+    data : bytes
+        Encoded image
+    """
+
+    from PIL import Image
+
+    while True:
+        for data in _encodings(image, figure_format):
+            if max_bytes is None or len(data) <= max_bytes:
+                return data
+        if image.size == (1, 1):
+            raise ValueError(
+                f"Cannot encode a figure as {figure_format} in {max_bytes} "
+                "bytes"
+            )
+        width, height = image.size
+        image = image.resize(
+            (
+                max(1, round(width * _DOWNSCALE)),
+                max(1, round(height * _DOWNSCALE)),
+            ),
+            Image.LANCZOS,
+        )
+
+
+def save_figure(
+    figure, out_base, figure_format="svg", dpi=100, max_bytes=None, **kwargs
+):
+    """Save a matplotlib figure or nilearn display in the working directory.
+
+    SVG figures are written as is. PNG and WebP figures are rendered once
+    at ``dpi``, lowered so that no side exceeds ``_MAX_PIXELS``, and then
+    encoded with ``encode_image`` to fit ``max_bytes``. Their size and
+    rendering time therefore do not depend on the number of elements
+    drawn.
+
+    Parameters
+    ----------
+    figure : matplotlib Figure or nilearn display
+        Object with a ``savefig(filename, dpi=...)`` method
+    out_base : str
+        File name without extension
+    figure_format : {"svg", "png", "webp"}
+        Output format
+    dpi : float
+        Resolution of rasterised figures
+    max_bytes : int or None
+        Largest size of rasterised figures
+    **kwargs
+        Passed to ``figure.savefig``, e.g. ``bbox_inches="tight"``
+
+    Returns
+    -------
+    out_file : str
+        Absolute path of the saved figure
+    """
+
+    if figure_format not in FIGURE_FORMATS:
+        raise ValueError(f"Unknown figure format: {figure_format}")
+
+    out_file = os.path.abspath(f"{out_base}.{figure_format}")
+    if figure_format == "svg":
+        figure.savefig(out_file, **kwargs)
+        return out_file
+
+    from PIL import Image
+
+    # nilearn displays draw on the figure of their frame axes
+    frame_axes = getattr(figure, "frame_axes", None)
+    size = (frame_axes.figure if frame_axes else figure).get_size_inches()
+    dpi = min(dpi, _MAX_PIXELS / max(size))
+
+    render_file = os.path.abspath(f"{out_base}.render.png")
+    figure.savefig(render_file, dpi=dpi, **kwargs)
+    try:
+        with Image.open(render_file) as image:
+            image = image.convert("RGB")
+    finally:
+        os.remove(render_file)
+
+    with open(out_file, "wb") as f:
+        f.write(encode_image(image, figure_format, max_bytes))
+    return out_file
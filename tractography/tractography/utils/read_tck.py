@@ -1,13 +1,35 @@
 import numpy as np
-import struct
+import multiprocessing
 import os
 
+from tractography.utils.streamlines import Streamlines, _gather
 
-def read_tck_file(tck_file):
-    """Read streamlines from MRTrix3 TCK file format.
 
-    TCK format consists of a text header followed by binary track data.
-    Tracks are separated by NaN triplets and file ends with Inf triplet.
+def _tck_dtype(datatype):
+    """Convert a TCK ``datatype`` field (e.g. Float32LE) to a numpy dtype."""
+
+    # Determine float format
+    if "Float16" in datatype:
+        # Not an MRtrix3 datatype; only used by compressed tractograms
+        fmt = "f2"  # 16-bit float
+    elif "Float32" in datatype:
+        fmt = "f4"  # 32-bit float
+    elif "Float64" in datatype:
+        fmt = "f8"  # 64-bit float
+    else:
+        raise ValueError(f"Unsupported datatype: {datatype}")
+
+    # Determine byte order
+    if "BE" in datatype:
+        byte_order = ">"  # Big endian
+    else:
+        byte_order = "<"  # Little endian (default)
+
+    return np.dtype(byte_order + fmt)
+
+
+def _read_tck_header(tck_file):
+    """Parse the text header of an MRTrix3 TCK file.
 
     Parameters
     ----------
@@ -16,21 +38,31 @@ def read_tck_file(tck_file):
 
     Returns
     -------
-    streamlines_list : list of ndarray
-        List of streamlines, each as an Nx3 array of coordinates
+    header : dict
+        Header fields as strings, keyed by field name
+    offset : int
+        Byte offset of the binary track data
+    dtype : numpy.dtype
+        Data type of a single coordinate, with its byte order
     """
 
-    streamlines_list = []
+    header = {}
+    offset = None
+    datatype = "Float32LE"  # Default
 
     with open(tck_file, "rb") as f:
-        # Read header
-        header_lines = []
-        offset = None
-        datatype = "Float32LE"  # Default
-
         while True:
-            line = f.readline().decode("utf-8").strip()
-            header_lines.append(line)
+            raw = f.readline()
+            if not raw:
+                raise ValueError("No 'END' found in TCK header")
+            line = raw.decode("utf-8").strip()
+
+            if line == "END":
+                break
+
+            key, sep, value = line.partition(":")
+            if sep:
+                header[key.strip()] = value.strip()
 
             if line.startswith("file:"):
                 # Extract file offset
@@ -40,57 +72,467 @@ def read_tck_file(tck_file):
             if line.startswith("datatype:"):
                 datatype = line.split()[-1]
 
-            if line == "END":
-                break
+    if offset is None:
+        raise ValueError("No 'file:' offset found in TCK header")
+
+    return header, offset, _tck_dtype(datatype)
+
 
-        if offset is None:
-            raise ValueError("No 'file:' offset found in TCK header")
+def _find_streamlines(points):
+    """Locate the streamlines inside a block of raw TCK triplets.
 
-        # Determine float format
-        if "Float32" in datatype:
-            fmt = "f"  # 32-bit float
-            float_size = 4
-        elif "Float64" in datatype:
-            fmt = "d"  # 64-bit float
-            float_size = 8
-        else:
-            raise ValueError(f"Unsupported datatype: {datatype}")
+    Tracks are separated by NaN triplets and the data ends with an Inf
+    triplet. Only the (few) non-finite rows are inspected element-wise; the
+    search over the full block is a single vectorised pass.
 
-        # Determine byte order
-        if "BE" in datatype:
-            byte_order = ">"  # Big endian
-        else:
-            byte_order = "<"  # Little endian (default)
+    Parameters
+    ----------
+    points : ndarray, shape (N, 3)
+        Raw triplets, delimiters included
+
+    Returns
+    -------
+    offsets : ndarray of int64
+        Index of the first point of each streamline in ``points``
+    lengths : ndarray of int64
+        Number of points of each streamline
+    consumed : int
+        Number of rows up to and including the last delimiter; rows past it
+        belong to a streamline that is not complete yet
+    terminated : bool
+        Whether the Inf end-of-file marker was found
+    """
 
-        # Move to binary data
-        f.seek(offset)
+    candidates = np.flatnonzero(~np.isfinite(points[:, 0]))
+    rows = np.asarray(points[candidates])
 
-        # Read binary track data
-        current_streamline = []
+    return _split_at_delimiters(candidates, rows)
 
-        while True:
-            # Read triplet of floats
-            data = f.read(3 * float_size)
-            if len(data) < 3 * float_size:
-                break  # End of file
-
-            # Unpack triplet
-            fmt_str = byte_order + "3" + fmt
-            triplet = struct.unpack(fmt_str, data)
-
-            # Check for end of file marker (all Inf)
-            if all(np.isinf(v) for v in triplet):
-                if current_streamline:
-                    streamlines_list.append(np.array(current_streamline))
-                    current_streamline = []
+
+def _split_at_delimiters(candidates, rows):
+    """Turn the non-finite rows of some track data into streamlines.
+
+    Parameters
+    ----------
+    candidates : ndarray of int
+        Sorted indices of the rows whose first coordinate is not finite
+    rows : ndarray, shape (len(candidates), 3)
+        The corresponding triplets
+
+    Returns
+    -------
+    offsets, lengths, consumed, terminated
+        See ``_find_streamlines``
+    """
+
+    end = np.flatnonzero(np.isinf(rows).all(axis=1))
+    terminated = end.size > 0
+    if terminated:
+        candidates = candidates[: end[0] + 1]
+        rows = rows[: end[0] + 1]
+
+    # Boundaries are the delimiter rows; a trailing streamline without an
+    # end marker is incomplete and ignored
+    is_delimiter = np.isnan(rows).all(axis=1)
+    if terminated:
+        is_delimiter[-1] = True
+    boundaries = np.concatenate(([-1], candidates[is_delimiter]))
+
+    offsets = boundaries[:-1] + 1
+    lengths = boundaries[1:] - offsets
+    keep = lengths > 0
+
+    return (
+        offsets[keep].astype(np.int64),
+        lengths[keep].astype(np.int64),
+        int(boundaries[-1]) + 1,
+        terminated,
+    )
+
+
+# State shared with the decoding processes of _load_tck_parallel
+_worker_state = {}
+
+
+def _init_decode_worker(buffer, tck_file, offset, dtype):
+    _worker_state.update(
+        buffer=buffer, tck_file=tck_file, offset=offset, dtype=dtype
+    )
+
+
+def _decode_range(bounds):
+    """Read rows ``start:stop`` of the track data into the shared buffer.
+
+    Returns the indices and values of the rows whose first coordinate is
+    not finite, i.e. the delimiter candidates of the range.
+    """
+
+    start, stop = bounds
+    dtype = _worker_state["dtype"]
+    points = np.frombuffer(_worker_state["buffer"], dtype=dtype).reshape(-1, 3)
+    view = memoryview(points[start:stop]).cast("B")
+
+    with open(_worker_state["tck_file"], "rb") as f:
+        f.seek(_worker_state["offset"] + start * 3 * dtype.itemsize)
+        n_read = 0
+        while n_read < len(view):
+            n = f.readinto(view[n_read:])
+            if not n:
+                raise ValueError(
+                    f"Unexpected end of file in {_worker_state['tck_file']}"
+                )
+            n_read += n
+
+    candidates = np.flatnonzero(~np.isfinite(points[start:stop, 0]))
+    return candidates + start, points[start + candidates]
+
+
+def _load_tck_parallel(tck_file, offset, dtype, n_rows, n_jobs):
+    """Decode the track data with a pool of processes.
+
+    The rows are split into ranges aligned on triplets, each read by a
+    worker straight into an anonymous shared mapping. Delimiters are
+    resolved once all ranges are back, so a streamline spanning several
+    ranges is handled exactly as in a serial read.
+    """
+
+    import mmap as _mmap
+
+    buffer = _mmap.mmap(-1, n_rows * 3 * dtype.itemsize)
+    n_ranges = min(n_rows, 4 * n_jobs)
+    bounds = np.linspace(0, n_rows, n_ranges + 1).astype(np.int64)
+
+    # The shared mapping is inherited by forked workers; it cannot be
+    # pickled for other start methods
+    context = multiprocessing.get_context("fork")
+    with context.Pool(
+        n_jobs,
+        initializer=_init_decode_worker,
+        initargs=(buffer, tck_file, offset, dtype),
+    ) as pool:
+        results = pool.map(_decode_range, zip(bounds[:-1], bounds[1:]))
+
+    candidates = np.concatenate([c for c, _ in results])
+    rows = np.concatenate([r for _, r in results]).reshape(-1, 3)
+    offsets, lengths, _, _ = _split_at_delimiters(candidates, rows)
+
+    points = np.frombuffer(buffer, dtype=dtype).reshape(n_rows, 3)
+    return Streamlines(points, offsets, lengths)
+
+
+def tck_index_file(tck_file):
+    """Path of the sidecar streamline index of a TCK file."""
+    return os.path.splitext(str(tck_file))[0] + ".idx.npy"
+
+
+def _index_is_fresh(tck_file, index_file):
+    return os.path.exists(index_file) and (
+        os.path.getmtime(index_file) >= os.path.getmtime(tck_file)
+    )
+
+
+def _save_index(index_file, parts):
+    """Save per-block ``(first_row, length)`` pairs as one int64 array."""
+
+    index = (
+        np.concatenate(parts) if parts else np.empty((0, 2), dtype=np.int64)
+    )
+    # Write next to the final name first so readers never see partial files
+    tmp_file = index_file + ".tmp.npy"
+    np.save(tmp_file, index)
+    os.replace(tmp_file, index_file)
+
+
+def tck_row_ranges(tck_file, n_ranges):
+    """Split the track data of a TCK file into contiguous row ranges.
+
+    The ranges are meant for ``iter_tck(row_range=...)``: each streamline is
+    read by the range holding its first point, so processing every range
+    covers the tractogram exactly once, e.g. from separate processes.
+
+    Returns
+    -------
+    ranges : list of (int, int)
+        ``(start_row, stop_row)`` pairs of triplet indices
+    """
+
+    _, offset, dtype = _read_tck_header(tck_file)
+    n_rows = max(
+        0, (os.path.getsize(tck_file) - offset) // (3 * dtype.itemsize)
+    )
+    n_ranges = max(1, min(int(n_ranges), n_rows))
+    bounds = np.linspace(0, n_rows, n_ranges + 1).astype(np.int64)
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def _iter_blocks(tck_file, chunk_bytes, row_range=None):
+    """Read the track data sequentially in blocks of about ``chunk_bytes``.
+
+    Points of a streamline that straddles two blocks are carried over to
+    the next one, so every yielded block only reports complete streamlines.
+
+    With ``row_range=(start_row, stop_row)`` only the streamlines whose first
+    point lies in that range are reported. Reading starts on the row before
+    ``start_row`` to resynchronise on the delimiters, and goes on past
+    ``stop_row`` until the last of those streamlines is complete.
+
+    Yields
+    ------
+    block : ndarray, shape (N, 3)
+        Raw triplets in the file's datatype, delimiters included
+    first_row : int
+        Index of ``block[0]`` among all triplets of the track data
+    offsets, lengths : ndarray of int64
+        Complete streamlines of the block, as in ``_find_streamlines``
+    """
+
+    _, offset, dtype = _read_tck_header(tck_file)
+    block_rows = max(1, int(chunk_bytes) // (3 * dtype.itemsize))
+
+    start_row, stop_row = row_range if row_range is not None else (0, None)
+    carry = np.empty((0, 3), dtype=dtype)
+    rows_read = max(start_row - 1, 0)
+
+    with open(tck_file, "rb") as f:
+        f.seek(offset + rows_read * 3 * dtype.itemsize)
+        terminated = False
+
+        while not terminated:
+            block = np.fromfile(f, dtype=dtype, count=3 * block_rows)
+            if block.size < 3:
                 break
+            block = block[: block.size - block.size % 3].reshape(-1, 3)
+            first_row = rows_read - len(carry)
+            rows_read += len(block)
+            if len(carry):
+                block = np.concatenate((carry, block))
+
+            offsets, lengths, consumed, terminated = _find_streamlines(block)
+            carry = block[consumed:].copy()
+
+            if row_range is not None:
+                owned = offsets + first_row >= start_row
+                owned &= offsets + first_row < stop_row
+                offsets, lengths = offsets[owned], lengths[owned]
+            if len(lengths):
+                yield block, first_row, offsets, lengths
+
+            # Streamlines starting after the last delimiter of the block
+            # belong to the next range
+            if stop_row is not None and first_row + consumed >= stop_row:
+                break
+
+
+def build_tck_index(tck_file, index_file=None, chunk_bytes=64 * 2**20):
+    """Build the sidecar streamline index of a TCK file.
+
+    The index is an ``(n_streamlines, 2)`` int64 ``.npy`` array holding, for
+    each streamline, the row of its first point in the track data and its
+    number of points. The byte position of streamline ``i`` is
+    ``offset + index[i, 0] * 3 * itemsize``, with ``offset`` the ``file:``
+    field of the header. The file is read as a stream, in bounded memory.
+
+    Parameters
+    ----------
+    tck_file : str
+        Path to .tck file
+    index_file : str or None
+        Output path; defaults to ``tck_index_file(tck_file)``
+    chunk_bytes : int
+        Approximate number of bytes of track data read at a time
+
+    Returns
+    -------
+    index_file : str
+        Path to the index
+    """
+
+    if index_file is None:
+        index_file = tck_index_file(tck_file)
+
+    parts = [
+        np.column_stack((offsets + first_row, lengths))
+        for _, first_row, offsets, lengths in _iter_blocks(
+            tck_file, chunk_bytes
+        )
+    ]
+    _save_index(index_file, parts)
+
+    return index_file
+
+
+def load_tck(tck_file, mmap=True, use_index=False, n_jobs=1):
+    """Load all streamlines of a TCK file as flat arrays.
+
+    The binary section is memory-mapped (or read in a single call) as an
+    ``(N, 3)`` array and the NaN/Inf delimiters are located with vectorised
+    NumPy operations, so no Python code runs per point.
+
+    Parameters
+    ----------
+    tck_file : str
+        Path to .tck file
+    mmap : bool
+        Memory-map the track data instead of reading it into memory
+    use_index : bool
+        Take the streamline offsets and lengths from the sidecar index
+        (see ``build_tck_index``), building it first if it is missing or
+        older than the .tck. The index is memory-mapped too, so fetching
+        arbitrary streamlines or ranges only touches the pages they span.
+    n_jobs : int or None
+        Number of processes used to decode the track data into shared
+        memory; None uses all CPUs. Values above 1 read the data into
+        memory, so ``mmap`` is ignored. Requires the ``fork`` start method
+        and falls back to a serial read where it is unavailable, or when
+        ``use_index`` is set.
+
+    Returns
+    -------
+    streamlines : Streamlines
+        Streamlines backed by the raw track data, in the file's datatype.
+        Delimiter rows are left in place in ``streamlines.points``.
+    """
+
+    _, offset, dtype = _read_tck_header(tck_file)
+
+    n_rows = (os.path.getsize(tck_file) - offset) // (3 * dtype.itemsize)
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    parallel = (
+        n_jobs > 1
+        and n_rows > 0
+        and not use_index
+        and "fork" in multiprocessing.get_all_start_methods()
+    )
+
+    if parallel:
+        return _load_tck_parallel(tck_file, offset, dtype, n_rows, n_jobs)
+    elif n_rows <= 0:
+        points = np.empty((0, 3), dtype=dtype)
+    elif mmap:
+        points = np.memmap(
+            tck_file, dtype=dtype, mode="r", offset=offset, shape=(n_rows, 3)
+        )
+    else:
+        points = np.fromfile(
+            tck_file, dtype=dtype, count=3 * n_rows, offset=offset
+        ).reshape(n_rows, 3)
+
+    if use_index:
+        index_file = tck_index_file(tck_file)
+        if not _index_is_fresh(tck_file, index_file):
+            build_tck_index(tck_file, index_file)
+        index = np.load(index_file, mmap_mode="r" if mmap else None)
+        return Streamlines(points, index[:, 0], index[:, 1])
 
-            # Check for track separator (all NaN)
-            if all(np.isnan(v) for v in triplet):
-                if current_streamline:
-                    streamlines_list.append(np.array(current_streamline))
-                    current_streamline = []
-            else:
-                current_streamline.append(triplet)
+    offsets, lengths, _, _ = _find_streamlines(points)
+
+    return Streamlines(points, offsets, lengths)
+
+
+def iter_tck(
+    tck_file,
+    batch_size=None,
+    chunk_bytes=64 * 2**20,
+    index_file=None,
+    row_range=None,
+):
+    """Iterate over the streamlines of a TCK file in batches.
+
+    The track data is read sequentially in blocks of about ``chunk_bytes``.
+    Points of a streamline that straddles two blocks are carried over to the
+    next one, so peak memory depends on the block and batch sizes, not on
+    the size of the file.
+
+    Parameters
+    ----------
+    tck_file : str
+        Path to .tck file
+    batch_size : int or None
+        Number of streamlines per batch (the last batch may be smaller).
+        When None, each batch holds the complete streamlines of one block.
+    chunk_bytes : int
+        Approximate number of bytes of track data read at a time
+    index_file : str or None
+        When given, the sidecar index (see ``build_tck_index``) is written
+        to this path once the iteration is complete
+    row_range : (int, int) or None
+        Only iterate over the streamlines whose first point lies in this
+        range of triplet indices, see ``tck_row_ranges``
+
+    Yields
+    ------
+    streamlines : Streamlines
+        Packed, native-endian streamlines of the batch
+    """
+
+    if batch_size is not None and batch_size < 1:
+        raise ValueError(f"batch_size must be positive, got {batch_size}")
+
+    dtype = _read_tck_header(tck_file)[2].newbyteorder("=")
+    pending_points = np.empty((0, 3), dtype=dtype)
+    pending_lengths = np.empty(0, dtype=np.int64)
+    index = []
+
+    for block, first_row, offsets, lengths in _iter_blocks(
+        tck_file, chunk_bytes, row_range
+    ):
+        if index_file is not None:
+            index.append(np.column_stack((offsets + first_row, lengths)))
+
+        points, offsets = _gather(block, offsets, lengths)
+        del block
+
+        if batch_size is None:
+            yield Streamlines(points, offsets, lengths)
+            continue
+
+        # Top up the streamlines left over from the previous block and
+        # emit as many full batches as possible
+        if len(pending_lengths):
+            points = np.concatenate((pending_points, points))
+            lengths = np.concatenate((pending_lengths, lengths))
+        starts = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=starts[1:])
+
+        n_full = len(lengths) // batch_size
+        for i in range(n_full):
+            first, last = i * batch_size, (i + 1) * batch_size
+            yield Streamlines(
+                points[starts[first] : starts[last]],
+                starts[first:last] - starts[first],
+                lengths[first:last],
+            )
+
+        rest = n_full * batch_size
+        pending_points = points[starts[rest] :].copy()
+        pending_lengths = lengths[rest:]
+
+    if len(pending_lengths):
+        yield Streamlines(pending_points, lengths=pending_lengths)
+
+    if index_file is not None:
+        _save_index(index_file, index)
+
+
+def read_tck_file(tck_file):
+    """Read streamlines from MRTrix3 TCK file format.
+
+    TCK format consists of a text header followed by binary track data.
+    Tracks are separated by NaN triplets and file ends with Inf triplet.
+
+    Parameters
+    ----------
+    tck_file : str
+        Path to .tck file
+
+    Returns
+    -------
+    streamlines_list : list of ndarray
+        List of streamlines, each as an Nx3 array of coordinates
+    """
 
-    return streamlines_list
+    return [
+        np.array(streamline, dtype=np.float64)
+        for streamline in load_tck(tck_file)
+    ]
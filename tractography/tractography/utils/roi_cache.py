@@ -0,0 +1,236 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+# Bumped whenever the merge changes its output for the same inputs
+_CACHE_VERSION = 2
+_MERGED_NAME = "merged_parcellation.nii.gz"
+
+
+def roi_cache_key(parcellation_files, engulf_threshold):
+    """Hash of the content and names of ROI files, in order.
+
+    The names are part of the key because they appear in the warnings and
+    the order because it sets the labels. The files are hashed as stored,
+    without decompressing them.
+    """
+
+    digest = hashlib.sha256()
+    digest.update(f"{_CACHE_VERSION}:{engulf_threshold!r}".encode())
+    for parcellation_file in parcellation_files:
+        digest.update(os.path.basename(str(parcellation_file)).encode())
+        digest.update(b"\0")
+        with open(parcellation_file, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                digest.update(block)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def _locked(cache_dir, key, blocking=True):
+    """Hold an exclusive lock on one cache entry.
+
+    Yields whether the lock was acquired, which is always the case when
+    ``blocking``. Eviction deletes lock files while holding them, so a lock
+    taken on a file that is no longer the one at its path is released and
+    taken again on the current file.
+    """
+
+    path = os.path.join(cache_dir, f"{key}.lock")
+    while True:
+        lock = open(path, "a")
+        try:
+            fcntl.flock(
+                lock, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB)
+            )
+        except BlockingIOError:
+            lock.close()
+            yield False
+            return
+        try:
+            current = os.stat(path).st_ino
+        except FileNotFoundError:
+            current = None
+        if current == os.fstat(lock.fileno()).st_ino:
+            break
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+    try:
+        yield True
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+
+def _entry_files(cache_dir, key):
+    return (
+        os.path.join(cache_dir, f"{key}.json"),
+        os.path.join(cache_dir, f"{key}.nii.gz"),
+    )
+
+
+def _atomic_copy(src, dst):
+    """Copy a file so that readers never see it partially written."""
+    tmp = f"{dst}.tmp{os.getpid()}"
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _link_or_copy(src, dst):
+    """Hard link a file (so eviction cannot remove it), copying if needed."""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def evict_roi_cache(cache_dir, max_bytes, keep=()):
+    """Delete the least recently used entries until the cache fits.
+
+    Entries are ordered by the time their JSON was last written or reused.
+    Entries in ``keep``, or being read or written by another run, are not
+    deleted.
+
+    Returns
+    -------
+    evicted : list of str
+        Keys of the deleted entries
+    """
+
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        if not name.endswith(".json"):
+            continue
+        key = name[: -len(".json")]
+        files = [f for f in _entry_files(cache_dir, key) if os.path.exists(f)]
+        size = sum(os.path.getsize(f) for f in files)
+        entries.append((os.path.getmtime(files[0]), key, files, size))
+        total += size
+
+    evicted = []
+    for _, key, files, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if key in keep:
+            continue
+        with _locked(cache_dir, key, blocking=False) as acquired:
+            if not acquired:
+                continue
+            for f in files + [os.path.join(cache_dir, f"{key}.lock")]:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(f)
+        total -= size
+        evicted.append(key)
+    return evicted
+
+
+class _Recorder(logging.Handler):
+    """Keep the messages emitted while a merge runs."""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def cached_roi_merge(
+    parcellation_files,
+    merge,
+    cache_dir,
+    engulf_threshold,
+    max_bytes=2**30,
+    logger_name="nipype.interface",
+):
+    """Merge ROI files through a persistent cache shared by all runs.
+
+    The cache is a directory of entries keyed by ``roi_cache_key``: a JSON
+    file with the warnings of the merge and, when the merge produced a new
+    volume, that volume. Entries are locked while they are computed, so
+    concurrent runs on the same ROI set wait for a single merge. After
+    every new entry, least recently used entries are evicted until the
+    cache holds at most ``max_bytes``.
+
+    Parameters
+    ----------
+    parcellation_files : list of str
+        ROI files, in label order
+    merge : callable
+        Called without arguments on a cache miss; returns the path of the
+        merged parcellation, or one of ``parcellation_files`` when it is
+        used as is
+    cache_dir : str
+        Cache directory, created if needed
+    engulf_threshold : float
+        Engulf threshold of the merge, part of the key
+    max_bytes : int
+        Size budget of the cache
+    logger_name : str
+        Logger whose warnings are recorded on a miss and re-emitted on hits
+
+    Returns
+    -------
+    out_file : str
+        ``merged_parcellation.nii.gz`` in the working directory, or one of
+        ``parcellation_files``
+    """
+
+    logger = logging.getLogger(logger_name)
+    parcellation_files = [str(f) for f in parcellation_files]
+    key = roi_cache_key(parcellation_files, engulf_threshold)
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_file, merged_file = _entry_files(cache_dir, key)
+
+    with _locked(cache_dir, key):
+        entry = None
+        if os.path.exists(entry_file):
+            with open(entry_file) as f:
+                entry = json.load(f)
+            if entry["kept_file"] is None and not os.path.exists(merged_file):
+                entry = None
+
+        if entry is not None:
+            # Only the JSON is touched: the volume may be hard linked into
+            # working directories, where its time stamp must not change
+            os.utime(entry_file)
+        else:
+            recorder = _Recorder()
+            logger.addHandler(recorder)
+            try:
+                out_file = merge()
+            finally:
+                logger.removeHandler(recorder)
+
+            kept_file = None
+            if out_file in parcellation_files:
+                kept_file = parcellation_files.index(out_file)
+            else:
+                _atomic_copy(out_file, merged_file)
+            entry = {"warnings": recorder.messages, "kept_file": kept_file}
+            tmp = f"{entry_file}.tmp{os.getpid()}"
+            with open(tmp, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp, entry_file)
+
+            evict_roi_cache(cache_dir, max_bytes, keep=(key,))
+            return out_file
+
+        if entry["kept_file"] is None:
+            out_file = os.path.abspath(_MERGED_NAME)
+            _link_or_copy(merged_file, out_file)
+
+    for message in entry["warnings"]:
+        logger.warning("%s", message)
+    if entry["kept_file"] is not None:
+        return parcellation_files[entry["kept_file"]]
+    return out_file
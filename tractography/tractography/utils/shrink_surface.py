@@ -1,56 +1,348 @@
 #!/usr/bin/env python
 import argparse
-import tempfile
-
+import multiprocessing
 import os
+import tempfile
+import time
+from collections import defaultdict
 
 import nibabel
 import nimesh
 import numpy
 
 from tractography.utils import spatial
+from tractography.utils.signed_distance import signed_distance_volume
+
+# Stages whose time is reported by shrink_surfaces
+STAGES = ("distance", "gradient", "descent", "save")
+
+
+def shrink_surface(
+    surface_file,
+    reference,
+    distance,
+    outfile,
+    distance_method="native",
+    cache_dir=None,
+    low_memory=False,
+    descent_method="euler",
+):
+    """Shrinks the surfaces some mm in the wmmask followind the sig_dis
+
+    The signed distance to the surface is computed in-process by default
+    (``distance_method="native"``), or with ``wb_command`` when
+    ``distance_method="wb_command"``; see
+    ``tractography.utils.signed_distance.signed_distance_volume``, which
+    also describes ``cache_dir``.
+
+    With ``low_memory``, the signed distance is stored as float32 over the
+    bounding box of the surface grown by ``distance`` only, and only
+    computed up to a few voxels beyond ``distance``. Its gradient is not
+    stored but evaluated where the vertices go, for a fraction of the peak
+    memory. Vertices follow
+    the same path up to float32 rounding, except where the native distance
+    within the band resolves equidistant voxels differently.
+
+    ``descent_method`` is passed to
+    ``tractography.utils.spatial.grad_descend``.
+    """
+
+    shrink_surfaces(
+        [surface_file],
+        reference,
+        [distance],
+        outfile,
+        distance_method=distance_method,
+        cache_dir=cache_dir,
+        low_memory=low_memory,
+        descent_method=descent_method,
+    )
+
+
+def _descend_vertices(
+    gradient, vertices_voxel, distance, voxel_size, method, compare
+):
+    """Descended vertices, and their comparison with fixed steps if asked."""
+
+    if compare:
+        return spatial.compare_grad_descend(
+            vertices_voxel, gradient, distance, voxel_size, method=method
+        )
+    shrinked = spatial.grad_descend(
+        vertices_voxel, gradient, distance, voxel_size, method=method
+    )
+    return shrinked, None
+
+
+def _descend_range(args):
+    """Descend a range of vertices on a gradient saved as .npy."""
 
+    gradient_file, *descent_args = args
+    gradient = numpy.load(gradient_file, mmap_mode="r")
+    return _descend_vertices(gradient, *descent_args)
 
-def shrink_surface(surface_file, reference, distance, outfile):
-    """Shrinks the surfaces some mm in the wmmask followind the sig_dis"""
 
-    surface = nimesh.io.load(surface_file)
+def _merge_comparisons(comparisons, sizes):
+    """Comparison of all vertices from those of ranges of vertices."""
+
+    return {
+        "max_difference": max(c["max_difference"] for c in comparisons),
+        "mean_difference": float(
+            numpy.average(
+                [c["mean_difference"] for c in comparisons], weights=sizes
+            )
+        )
+        if sum(sizes)
+        else 0.0,
+        "evaluations": sum(c["evaluations"] for c in comparisons),
+        "euler_evaluations": sum(
+            c["euler_evaluations"] for c in comparisons
+        ),
+    }
+
+
+def _surface_name(surface_file):
+    """Name of a surface file without its folder and extension."""
+    return os.path.splitext(os.path.basename(str(surface_file)))[0]
+
+
+def shrink_surfaces(
+    surface_files,
+    reference,
+    distances,
+    outfile,
+    distance_method="native",
+    cache_dir=None,
+    low_memory=False,
+    n_jobs=1,
+    descent_method="euler",
+    compare_descent=False,
+):
+    """Shrink several surfaces by several distances against one reference.
+
+    The reference is loaded once, and the signed distance and its gradient
+    are computed once per surface for all distances. The descents of every
+    distance are then split in ranges of vertices run across a process
+    pool, which reads the gradient memory-mapped from a temporary file
+    rather than receiving a copy. See ``shrink_surface`` for
+    ``distance_method``, ``cache_dir`` and ``low_memory``; with
+    ``low_memory`` the fields of a surface cover its largest distance.
+    See ``tractography.utils.spatial.grad_descend`` for ``descent_method``.
+
+    Parameters
+    ----------
+    surface_files : list of str
+        Surfaces to shrink, e.g. both hemispheres
+    reference : str
+        Reference volume
+    distances : list of float
+        Distances (mm) to shrink every surface by
+    outfile : str
+        Output path, formatted with ``surface`` (file name of the surface
+        without extension) and ``distance``, e.g.
+        ``"{surface}_shrink-{distance:g}mm.gii"``. It only needs these
+        fields when more than one surface is written.
+    n_jobs : int or None
+        Number of processes running the descents; None uses all CPUs
+    descent_method : {"euler", "rk2"}
+        Fixed-step or adaptive integration of the descent
+    compare_descent : bool
+        Also descend with fixed steps and report how far the vertices of
+        ``descent_method`` are from those (in mm), see
+        ``tractography.utils.spatial.compare_grad_descend``
+
+    Returns
+    -------
+    out_files : list of str
+        Shrunk surfaces, for every surface then every distance
+    timings : dict
+        Seconds spent in each of ``STAGES``, over all surfaces
+    comparisons : dict
+        Comparison of the descent methods for every output file, empty
+        unless ``compare_descent``
+    """
+
+    distances = [float(distance) for distance in distances]
+    if not surface_files or not distances:
+        raise ValueError("At least one surface and one distance are needed")
+    out_files = [
+        outfile.format(surface=_surface_name(surface_file), distance=distance)
+        for surface_file in surface_files
+        for distance in distances
+    ]
+    if len(set(out_files)) < len(out_files):
+        raise ValueError(
+            f"{outfile} gives the same path to several outputs; use "
+            "{surface} and {distance} in it"
+        )
+
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
 
     # Load white matter mask and its metadata
     wm_mask = nibabel.load(reference)
     voxel_size = wm_mask.header.get_zooms()[:3]
+    mm_to_voxel_affine = numpy.linalg.inv(wm_mask.affine)
+    max_distance = max(distances)
 
-    # Compute a signed distance map inside of the white matter
-    tmp_file = tempfile.NamedTemporaryFile(suffix=".nii.gz")
+    timings = defaultdict(float)
+    comparisons = {}
+    pool = multiprocessing.Pool(n_jobs) if n_jobs > 1 else None
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for i, surface_file in enumerate(surface_files):
+                surface = nimesh.io.load(surface_file)
 
-    command_string = "wb_command -create-signed-distance-volume {} {} {}"
-    os.system(command_string.format(surface_file, reference, tmp_file.name))
+                # Transform the points to voxels
+                vertices_voxel = nibabel.affines.apply_affine(
+                    mm_to_voxel_affine, surface.vertices
+                )
 
-    signed_distance_si = nibabel.load(tmp_file.name)
-    signed_distance = signed_distance_si.get_fdata()
+                tic = time.perf_counter()
+                if low_memory:
+                    # Vertices never get farther than distance from the
+                    # surface, and the gradient there only needs the
+                    # distances of neighbouring voxels
+                    band = max_distance + 3 * max(voxel_size)
+                    dtype = numpy.float32
+                    low, high = _descent_box(
+                        vertices_voxel,
+                        max_distance,
+                        voxel_size,
+                        wm_mask.shape[:3],
+                    )
+                else:
+                    band, dtype = None, numpy.float64
+                    low = numpy.zeros(3, dtype=int)
+                    high = numpy.array(wm_mask.shape[:3])
 
-    # Transform the points to voxels
-    mm_to_voxel_affine = numpy.linalg.inv(wm_mask.affine)
-    vertices_voxel = nibabel.affines.apply_affine(
-        mm_to_voxel_affine, surface.vertices
-    )
+                # Compute a signed distance map inside of the white matter
+                signed_distance = signed_distance_volume(
+                    surface_file,
+                    wm_mask if distance_method == "native" else reference,
+                    method=distance_method,
+                    dtype=dtype,
+                    band=band,
+                    cache_dir=cache_dir,
+                    box=(low, high),
+                )
+                timings["distance"] += time.perf_counter() - tic
 
-    # Push vertices in the white matter following the gradient
-    gradient = numpy.array(numpy.gradient(-signed_distance))
+                # Push vertices in the white matter following the gradient
+                tic = time.perf_counter()
+                if low_memory:
+                    # The descent differentiates the signed distance only
+                    # where it goes, see spatial.grad_descend
+                    gradient = signed_distance
+                else:
+                    gradient = _descent_gradient(signed_distance)
+                del signed_distance
+                if pool is not None:
+                    gradient_file = os.path.join(tmp_dir, f"gradient_{i}.npy")
+                    numpy.save(gradient_file, gradient)
+                    del gradient
+                timings["gradient"] += time.perf_counter() - tic
 
-    shrinked_vertices_voxel = [
-        spatial.grad_descend(p, gradient, distance, voxel_size)
-        for p in vertices_voxel
-    ]
+                tic = time.perf_counter()
+                vertices_voxel = vertices_voxel - low
+                if pool is None:
+                    ranges = [numpy.arange(len(vertices_voxel))]
+                    parts = [
+                        _descend_vertices(
+                            gradient,
+                            vertices_voxel,
+                            distance,
+                            voxel_size,
+                            descent_method,
+                            compare_descent,
+                        )
+                        for distance in distances
+                    ]
+                else:
+                    ranges = numpy.array_split(
+                        numpy.arange(len(vertices_voxel)), n_jobs
+                    )
+                    tasks = [
+                        (
+                            gradient_file,
+                            vertices_voxel[ids],
+                            distance,
+                            voxel_size,
+                            descent_method,
+                            compare_descent,
+                        )
+                        for distance in distances
+                        for ids in ranges
+                    ]
+                    parts = pool.map(_descend_range, tasks)
 
-    # Bring back to mm
-    shrinked_vertices = nibabel.affines.apply_affine(
-        wm_mask.affine, shrinked_vertices_voxel
-    )
+                shrinked = []
+                for j in range(len(distances)):
+                    positions, comparison = zip(
+                        *parts[j * len(ranges) : (j + 1) * len(ranges)]
+                    )
+                    shrinked.append(numpy.concatenate(positions))
+                    if compare_descent:
+                        comparisons[
+                            out_files[i * len(distances) + j]
+                        ] = _merge_comparisons(
+                            comparison, [len(ids) for ids in ranges]
+                        )
+                timings["descent"] += time.perf_counter() - tic
 
-    # Save the shrinked surface
-    shrinked_surface = nimesh.Mesh(shrinked_vertices, surface.triangles)
-    nimesh.io.save(outfile, shrinked_surface)
+                tic = time.perf_counter()
+                for j, shrinked_vertices_voxel in enumerate(shrinked):
+                    # Bring back to mm
+                    shrinked_vertices = nibabel.affines.apply_affine(
+                        wm_mask.affine, shrinked_vertices_voxel + low
+                    )
+
+                    # Save the shrinked surface
+                    shrinked_surface = nimesh.Mesh(
+                        shrinked_vertices, surface.triangles
+                    )
+                    nimesh.io.save(
+                        out_files[i * len(distances) + j], shrinked_surface
+                    )
+                timings["save"] += time.perf_counter() - tic
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    timings = {stage: timings[stage] for stage in STAGES}
+    return out_files, timings, comparisons
+
+
+def _descent_box(vertices_voxel, distance, voxel_size, shape):
+    """Voxel box holding every position the vertices can descend to.
+
+    The box is the bounding box of the vertices grown by ``distance`` and
+    three voxels, so that the gradient at, and around, every reachable
+    position is the same as in the full volume.
+    """
+
+    margin = numpy.ceil(distance / numpy.asarray(voxel_size)).astype(int) + 3
+    low = numpy.floor(vertices_voxel.min(axis=0)).astype(int) - margin
+    high = numpy.ceil(vertices_voxel.max(axis=0)).astype(int) + margin + 1
+    return numpy.maximum(low, 0), numpy.minimum(high, shape)
+
+
+def _descent_gradient(signed_distance):
+    """Gradient of the negated signed distance, stacked as (3, x, y, z).
+
+    The components are computed one at a time into a single array of the
+    dtype of ``signed_distance``, without negated or stacked copies.
+    """
+
+    gradient = numpy.empty(
+        (3,) + signed_distance.shape, dtype=signed_distance.dtype
+    )
+    for axis in range(3):
+        numpy.negative(
+            numpy.gradient(signed_distance, axis=axis), out=gradient[axis]
+        )
+    return gradient
 
 
 def command_line_main():
@@ -61,8 +353,9 @@ def command_line_main():
         "-surface",
         dest="surface",
         required=True,
+        nargs="+",
         type=str,
-        help="surface to shrink",
+        help="surfaces to shrink",
     )
 
     parser.add_argument(
@@ -77,8 +370,10 @@ def command_line_main():
         "-mm",
         dest="distance",
         type=float,
+        nargs="+",
         required=True,
-        help="How much to shrink the surface into the white",
+        help="How much to shrink the surface into the white; several "
+        "distances give one output each",
     )
 
     parser.add_argument(
@@ -86,9 +381,87 @@ def command_line_main():
         dest="outfile",
         required=True,
         type=str,
-        help="outfile (nifti gii)",
+        help="outfile (nifti gii); with several surfaces or distances, a "
+        "template using {surface} and {distance}, e.g. "
+        "'{surface}_shrink-{distance:g}mm.gii'",
+    )
+
+    parser.add_argument(
+        "-distance_method",
+        dest="distance_method",
+        choices=["native", "wb_command"],
+        default="native",
+        help="how to compute the signed distance to the surface: in-process "
+        "(default) or with Connectome Workbench",
+    )
+
+    parser.add_argument(
+        "-cache_dir",
+        dest="cache_dir",
+        type=str,
+        default=None,
+        help="directory where signed distance volumes are cached",
+    )
+
+    parser.add_argument(
+        "-low_memory",
+        dest="low_memory",
+        action="store_true",
+        help="compute the distance in float32, only around the surface, "
+        "and its gradient only where the vertices go",
+    )
+
+    parser.add_argument(
+        "-n_jobs",
+        dest="n_jobs",
+        type=int,
+        default=1,
+        help="number of processes running the descents",
+    )
+
+    parser.add_argument(
+        "-descent_method",
+        dest="descent_method",
+        choices=spatial.DESCENT_METHODS,
+        default="euler",
+        help="integration of the descent: fixed steps (default) or "
+        "adaptive Runge-Kutta steps, which end exactly at the distance and "
+        "need fewer gradient evaluations on fine (about 1 mm) grids, but "
+        "more on coarse ones",
+    )
+
+    parser.add_argument(
+        "-compare_descent",
+        dest="compare_descent",
+        action="store_true",
+        help="report how far the vertices are from those of the fixed-step "
+        "descent",
     )
 
     args = parser.parse_args()
 
-    shrink_surface(args.surface, args.reference, args.distance, args.outfile)
+    out_files, timings, comparisons = shrink_surfaces(
+        args.surface,
+        args.reference,
+        args.distance,
+        args.outfile,
+        distance_method=args.distance_method,
+        cache_dir=args.cache_dir,
+        low_memory=args.low_memory,
+        n_jobs=args.n_jobs,
+        descent_method=args.descent_method,
+        compare_descent=args.compare_descent,
+    )
+
+    for out_file in out_files:
+        print(f"Saved {out_file}")
+    for stage, seconds in timings.items():
+        print(f"{stage}: {seconds:.2f} s")
+    for out_file, comparison in comparisons.items():
+        print(
+            f"{out_file}: {args.descent_method} vs euler, max difference "
+            f"{comparison['max_difference']:.4f} mm, mean difference "
+            f"{comparison['mean_difference']:.4f} mm, "
+            f"{comparison['evaluations']} vs "
+            f"{comparison['euler_evaluations']} gradient evaluations"
+        )
@@ -0,0 +1,343 @@
+import hashlib
+import os
+import subprocess
+import tempfile
+
+import nibabel
+import nimesh
+import numpy
+from scipy import ndimage
+
+# Largest distance (voxels) between the points sampled on each triangle when
+# rasterising a surface, small enough for the rasterised shell to have no
+# gaps through which the inside would leak
+_SAMPLE_SPACING = 0.5
+# Number of sampled points processed at a time while rasterising
+_SAMPLE_CHUNK = 2**18
+
+
+def _rasterize_surface(vertices_voxel, triangles, shape):
+    """Voxels crossed by the triangles of a surface.
+
+    Every triangle is sampled on a regular barycentric grid fine enough
+    that consecutive samples are less than half a voxel apart. Triangles
+    are grouped by their number of subdivisions so each group is sampled in
+    one vectorised step.
+
+    Returns
+    -------
+    voxels : ndarray of int64
+        Sorted flat indices of the voxels holding a sample
+    points : ndarray, shape (len(voxels), 3)
+        For each voxel, the sample closest to its centre (voxel units)
+    point_triangles : ndarray of int64
+        Triangle each of these samples lies on
+    """
+
+    corners = vertices_voxel[triangles]
+    edges = numpy.linalg.norm(
+        corners - numpy.roll(corners, 1, axis=1), axis=2
+    ).max(axis=1)
+    n_div = numpy.maximum(numpy.ceil(edges / _SAMPLE_SPACING), 1).astype(int)
+
+    voxels, points, point_triangles = [], [], []
+    for k in numpy.unique(n_div):
+        grid = numpy.add.outer(numpy.arange(k + 1), numpy.arange(k + 1))
+        i, j = numpy.nonzero(grid <= k)
+        u, v = i / k, j / k
+        weights = numpy.stack((1 - u - v, u, v))
+        group = numpy.flatnonzero(n_div == k)
+        step = max(1, _SAMPLE_CHUNK // len(u))
+        for start in range(0, len(group), step):
+            ids = group[start : start + step]
+            samples = numpy.einsum(
+                "kg,tkc->tgc", weights, corners[ids]
+            ).reshape(-1, 3)
+            sample_voxels = numpy.rint(samples).astype(numpy.int64)
+            inside = numpy.all(
+                (sample_voxels >= 0) & (sample_voxels < shape), axis=1
+            )
+            # Reduce every chunk right away, so that only one sample per
+            # voxel is held instead of all of them
+            chunk = _closest_to_centre(
+                numpy.ravel_multi_index(sample_voxels[inside].T, shape),
+                samples[inside],
+                numpy.repeat(ids, len(u))[inside],
+            )
+            voxels.append(chunk[0])
+            points.append(chunk[1])
+            point_triangles.append(chunk[2])
+
+    return _closest_to_centre(
+        numpy.concatenate(voxels),
+        numpy.concatenate(points),
+        numpy.concatenate(point_triangles),
+    )
+
+
+def _closest_to_centre(voxels, points, point_triangles):
+    """Keep the sample closest to the centre of each voxel."""
+
+    offset = numpy.linalg.norm(points - numpy.rint(points), axis=1)
+    order = numpy.lexsort((offset, voxels))
+    voxels, first = numpy.unique(voxels[order], return_index=True)
+    keep = order[first]
+    return voxels, points[keep], point_triangles[keep]
+
+
+def _slices(start, stop):
+    return tuple(slice(a, b) for a, b in zip(start, stop))
+
+
+def _paste(values, low, box, fill):
+    """Part of a grid within ``box`` holding ``values`` placed at ``low``.
+
+    This is a view of ``values`` when they cover the box; otherwise the
+    rest of the box is set to ``fill``.
+    """
+
+    box_low, box_high = (numpy.asarray(corner, dtype=int) for corner in box)
+    low = numpy.asarray(low, dtype=int)
+    high = low + values.shape
+    if numpy.all(box_low >= low) and numpy.all(box_high <= high):
+        return values[_slices(box_low - low, box_high - low)]
+    out = numpy.full(tuple(box_high - box_low), fill, dtype=values.dtype)
+    start = numpy.maximum(low, box_low)
+    stop = numpy.maximum(numpy.minimum(high, box_high), start)
+    out[_slices(start - box_low, stop - box_low)] = values[
+        _slices(start - low, stop - low)
+    ]
+    return out
+
+
+def _native_signed_distance(surface_file, reference, band, dtype, box):
+    """Signed distance (mm) to a closed surface, negative inside it.
+
+    The surface is rasterised into the reference grid and its inside is the
+    part of the grid enclosed by the rasterised shell. Every voxel is given
+    its nearest shell voxel, and the distance is measured to the surface
+    point sampled in that shell voxel. Shell voxels themselves get the sign
+    of their side of the triangle their point lies on.
+
+    Nearest shell voxels are given by the Euclidean distance transform of
+    the whole grid. With a ``band``, only the bounding box of the surface
+    grown by the band is processed, the transform is run over thin
+    overlapping slabs of it, and distances are clipped to
+    ``[-band, band]``. Apart from the surface, only the distances, the
+    shell and its inside are then held for the whole box, and the part of
+    it within ``box`` is returned as a view.
+    """
+
+    surface = nimesh.io.load(surface_file)
+    triangles = numpy.asarray(surface.triangles)
+    shape = numpy.array(reference.shape[:3])
+    zooms = numpy.array(reference.header.get_zooms()[:3], dtype=float)
+    vertices_voxel = nibabel.affines.apply_affine(
+        numpy.linalg.inv(reference.affine), surface.vertices
+    )
+
+    if band is None:
+        low, high = numpy.zeros(3, dtype=int), shape
+    else:
+        margin = numpy.ceil(band / zooms).astype(int) + 1
+        low = numpy.floor(vertices_voxel.min(axis=0)).astype(int) - margin
+        high = numpy.ceil(vertices_voxel.max(axis=0)).astype(int) + margin + 1
+        low, high = numpy.maximum(low, 0), numpy.minimum(high, shape)
+    vertices_voxel = vertices_voxel - low
+    crop_shape = tuple(high - low)
+
+    shell_voxels, shell_points, shell_triangles = _rasterize_surface(
+        vertices_voxel, triangles, crop_shape
+    )
+    shell = numpy.zeros(crop_shape, dtype=bool)
+    shell.flat[shell_voxels] = True
+    inside = ndimage.binary_fill_holes(shell)
+
+    # Nearest shell voxels from the Euclidean distance transform, over
+    # slabs along x so that its indices are only held for a slab at a time.
+    # Slabs overlap by more than the band and half a voxel diagonal, beyond
+    # which shell points are farther than the band from any voxel of the
+    # slab, so distances within the band are the same as over the whole
+    # grid.
+    if band is None:
+        overlap = slab = crop_shape[0]
+    else:
+        overlap = int(
+            numpy.ceil((band + numpy.linalg.norm(zooms) / 2) / zooms[0])
+        )
+        slab = 2 * overlap
+    plane = numpy.indices(crop_shape[1:]).reshape(2, -1).T
+    distance = numpy.empty(crop_shape, dtype=dtype)
+    for start in range(0, crop_shape[0], slab):
+        stop = min(start + slab, crop_shape[0])
+        first = max(start - overlap, 0)
+        last = min(stop + overlap, crop_shape[0])
+        if band is not None and not shell[first:last].any():
+            distance[start:stop] = band
+            continue
+        nearest = ndimage.distance_transform_edt(
+            ~shell[first:last],
+            sampling=zooms,
+            return_distances=False,
+            return_indices=True,
+        )
+        nearest[0] += first
+
+        # Distance to the surface point of the nearest shell voxel, one x
+        # at a time to bound the size of the temporaries
+        for x in range(start, stop):
+            points = shell_points[
+                numpy.searchsorted(
+                    shell_voxels,
+                    numpy.ravel_multi_index(
+                        nearest[:, x - first].reshape(3, -1), crop_shape
+                    ),
+                )
+            ]
+            centres = numpy.column_stack((numpy.full(len(plane), x), plane))
+            distance[x] = numpy.linalg.norm(
+                (centres - points) * zooms, axis=1
+            ).reshape(crop_shape[1:])
+        del nearest
+    del shell
+    if band is not None:
+        numpy.minimum(distance, band, out=distance)
+
+    # Outward normals of the triangles holding the shell points; the mesh
+    # is oriented outward when it encloses a positive volume
+    corners = vertices_voxel[triangles[shell_triangles]]
+    normals = numpy.cross(
+        corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]
+    )
+    all_corners = vertices_voxel[triangles]
+    volume = numpy.einsum(
+        "ij,ij->",
+        all_corners[:, 0],
+        numpy.cross(all_corners[:, 1], all_corners[:, 2]),
+    )
+    normals *= numpy.sign(volume)
+    centres = numpy.column_stack(numpy.unravel_index(shell_voxels, crop_shape))
+    outside = numpy.einsum("ij,ij->i", centres - shell_points, normals) > 0
+
+    inside.flat[shell_voxels] = ~outside
+    numpy.negative(distance, out=distance, where=inside)
+    del inside
+
+    return _paste(distance, low, box, band)
+
+
+def _wb_command_signed_distance(surface_file, reference_file):
+    """Signed distance computed by Connectome Workbench."""
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_file = os.path.join(tmp_dir, "signed_distance.nii.gz")
+        subprocess.run(
+            [
+                "wb_command",
+                "-create-signed-distance-volume",
+                str(surface_file),
+                str(reference_file),
+                out_file,
+            ],
+            check=True,
+        )
+        return nibabel.load(out_file).get_fdata()
+
+
+def _cache_key(surface_file, reference, method, band, dtype, box):
+    """Hash of everything the signed distance volume depends on."""
+
+    digest = hashlib.sha256()
+    with open(surface_file, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    digest.update(numpy.asarray(reference.affine, dtype=float).tobytes())
+    digest.update(numpy.asarray(reference.shape[:3], dtype=int).tobytes())
+    digest.update(f"{method}:{band}:{numpy.dtype(dtype).str}".encode())
+    digest.update(numpy.asarray(box, dtype=int).tobytes())
+    return digest.hexdigest()
+
+
+def signed_distance_volume(
+    surface_file,
+    reference,
+    method="native",
+    dtype=numpy.float64,
+    band=None,
+    cache_dir=None,
+    box=None,
+):
+    """Signed distance (mm) to a surface on the grid of a reference volume.
+
+    Parameters
+    ----------
+    surface_file : str
+        Closed surface (e.g. GIfTI), in the world coordinates of the reference
+    reference : str or nibabel image
+        Volume defining the output grid
+    method : {"native", "wb_command"}
+        "native" rasterises the surface and uses SciPy's Euclidean distance
+        transform to find the nearest surface point of every voxel.
+        "wb_command" runs Connectome Workbench's
+        ``-create-signed-distance-volume``, which must be installed.
+    dtype : numpy dtype
+        Type of the returned volume, e.g. float32 to halve its size
+    band : float or None
+        Only compute distances up to this many mm from the surface; farther
+        voxels get ``-band`` inside and ``band`` outside
+    cache_dir : str or None
+        Directory where volumes are cached, keyed by the content of the
+        surface, the reference grid and the above options. A cached volume is
+        returned memory-mapped.
+    box : pair of sequences of int or None
+        Only return the voxels from ``box[0]`` (included) to ``box[1]``
+        (excluded) of the grid, instead of the whole grid. With a ``band``,
+        the native method only processes the grid around the surface, so
+        a box around the surface never needs a volume of the whole grid.
+
+    Returns
+    -------
+    signed_distance : ndarray
+        Negative inside the surface, positive outside
+    """
+
+    if method not in ("native", "wb_command"):
+        raise ValueError(f"Unknown signed distance method: {method}")
+    reference_file = None
+    if isinstance(reference, (str, os.PathLike)):
+        reference_file = reference
+        reference = nibabel.load(reference_file)
+    if box is None:
+        box = (numpy.zeros(3, dtype=int), numpy.array(reference.shape[:3]))
+
+    cache_file = None
+    if cache_dir is not None:
+        key = _cache_key(surface_file, reference, method, band, dtype, box)
+        cache_file = os.path.join(cache_dir, f"signed_distance_{key}.npy")
+        if os.path.exists(cache_file):
+            return numpy.load(cache_file, mmap_mode="r")
+
+    if method == "native":
+        signed_distance = _native_signed_distance(
+            surface_file, reference, band, dtype, box
+        )
+    else:
+        if reference_file is None:
+            raise ValueError("wb_command needs the reference as a file")
+        signed_distance = _wb_command_signed_distance(
+            surface_file, reference_file
+        )
+        if band is not None:
+            numpy.clip(signed_distance, -band, band, out=signed_distance)
+        signed_distance = _paste(signed_distance, (0, 0, 0), box, 0)
+    signed_distance = signed_distance.astype(dtype, copy=False)
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write next to the final name first so readers never see partial
+        # files
+        tmp_file = cache_file + ".tmp.npy"
+        numpy.save(tmp_file, signed_distance)
+        os.replace(tmp_file, cache_file)
+
+    return signed_distance
@@ -2,30 +2,220 @@ import numpy as np
 
 from scipy import ndimage
 
-def grad_descend(start_pos, gradient, dist=2, weight=[1, 1, 1],
-                 step_size=0.1, eps=1e-4):
-    ''' Walks a determinated distance following the gradient field '''
+# Integrators of grad_descend
+DESCENT_METHODS = ("euler", "rk2")
 
-    weight = np.abs(weight)
-    x, y, z = pos_act = start_pos
-    walked_distance = 0
-    step_length = np.inf
 
-    while walked_distance < dist and step_length > eps:
-        x, y, z = pos_act
+def _interpolate_gradient(gradient, positions):
+    ''' Gradient at (N, 3) positions, with a single interpolation call '''
+
+    if gradient.ndim == 3:
+        # Negated central differences of a scalar field, from the field
+        # one voxel before and after every position along each axis
+        offsets = np.concatenate((-np.eye(3), np.eye(3)))
+        coordinates = (positions[:, None] + offsets).reshape(-1, 3).T
+        values = ndimage.map_coordinates(
+            gradient, coordinates, order=1
+        ).reshape(-1, 2, 3)
+        return (values[:, 0] - values[:, 1]) / 2
+
+    x, y, z = positions.T
+
+    # Gradient components of all positions, as (component, x, y, z)
+    # coordinates into the 4D gradient array
+    coordinates = [
+        np.tile(np.arange(3), len(positions)),
+        np.repeat(x, 3),
+        np.repeat(y, 3),
+        np.repeat(z, 3),
+    ]
+    return ndimage.map_coordinates(
+        gradient, coordinates, order=1
+    ).reshape(-1, 3)
+
+
+def _weighted_length(vectors, weight):
+    return np.sqrt(np.einsum('ij,ij->i', vectors * weight, vectors * weight))
+
+
+def _descend_euler(pos_act, gradient, dist, weight, step_size, eps):
+    ''' Fixed-step descent; returns the number of gradient evaluations '''
+
+    walked_distance = np.zeros(len(pos_act))
+    active = np.arange(len(pos_act)) if dist > 0 else np.arange(0)
+    evaluations = 0
 
-        direction = ndimage.map_coordinates(gradient,
-                                            [[0, 1, 2], [x, x, x],
-                                             [y, y, y], [z, z, z]],
-                                            order=1)
+    while len(active):
+        direction = _interpolate_gradient(gradient, pos_act[active])
+        evaluations += len(active)
 
         step = step_size * direction
 
-        step_length = np.linalg.norm(np.multiply(step, weight))
-        pos_new = pos_act + step
+        step_length = _weighted_length(step, weight)
+        pos_act[active] += step
+
+        walked_distance[active] += step_length
+
+        moving = (walked_distance[active] < dist) & (step_length > eps)
+        active = active[moving]
+
+    return evaluations
+
+
+def _descend_rk2(pos_act, gradient, dist, weight, step_size, eps, tolerance):
+    ''' Adaptive Heun-Euler descent; returns the number of evaluations
+
+    Every step is taken with Heun's method, and the difference with the
+    Euler step of the same size estimates its error. Steps whose error is
+    above ``tolerance`` times their length are retried shorter, and the
+    next step size is scaled from the error of the current one. The first
+    step tries to walk all of ``dist`` at once, so the number of steps
+    follows the curvature of the path rather than the grid. The last step
+    is shortened along its chord to end exactly at ``dist``.
+    '''
+
+    walked_distance = np.zeros(len(pos_act))
+    active = np.arange(len(pos_act)) if dist > 0 else np.arange(0)
+    slope = np.zeros_like(pos_act)
+    if len(active):
+        slope[active] = _interpolate_gradient(gradient, pos_act[active])
+    evaluations = len(active)
+    # Multiple of the slope walking all of dist in one step
+    h = dist / np.maximum(_weighted_length(slope, weight), 1e-300)
+
+    while len(active):
+        # Same stopping rule as the fixed-step descent: a position whose
+        # step of step_size would be below eps takes it and stops
+        small = _weighted_length(step_size * slope[active], weight) <= eps
+        done = active[small]
+        pos_act[done] += step_size * slope[done]
+        active = active[~small]
+        if not len(active):
+            break
+
+        k1 = slope[active]
+        steps = h[active][:, None]
+        k2 = _interpolate_gradient(gradient, pos_act[active] + steps * k1)
+        evaluations += len(active)
+
+        increment = steps * (k1 + k2) / 2
+        length = _weighted_length(increment, weight)
+        error = _weighted_length(steps * (k2 - k1) / 2, weight)
+        allowed = tolerance * length
+
+        # Standard step size control for a method of order 1 error
+        factor = np.clip(
+            0.9 * np.sqrt(allowed / np.maximum(error, 1e-300)), 0.2, 5.0
+        )
+        h[active] *= factor
+
+        accepted = error <= allowed
+        active_accepted = active[accepted]
+        increment = increment[accepted]
+        length = length[accepted]
+        remaining = dist - walked_distance[active_accepted]
+        last = length >= remaining
+        fraction = np.ones(len(length))
+        fraction[last] = remaining[last] / length[last]
+        pos_act[active_accepted] += fraction[:, None] * increment
+        walked_distance[active_accepted] += fraction * length
+
+        arrived = active_accepted[last]
+        moving = np.ones(len(active), dtype=bool)
+        moving[np.flatnonzero(accepted)[last]] = False
+        active = active[moving]
+        walked_distance[arrived] = dist
+
+        # The slope at the new positions starts their next step
+        updated = active_accepted[~last]
+        if len(updated):
+            slope[updated] = _interpolate_gradient(gradient, pos_act[updated])
+            evaluations += len(updated)
+
+    return evaluations
+
+
+def _descend(start_pos, gradient, dist, weight, step_size, eps, method,
+             tolerance):
+    ''' Descended positions and the number of gradient evaluations '''
+
+    if method not in DESCENT_METHODS:
+        raise ValueError(f"Unknown descent method: {method}")
+
+    weight = np.abs(weight)
+    pos_act = np.array(start_pos, dtype=float)
+    single = pos_act.ndim == 1
+    pos_act = pos_act.reshape(-1, 3)
+
+    if method == "euler":
+        evaluations = _descend_euler(
+            pos_act, gradient, dist, weight, step_size, eps
+        )
+    else:
+        evaluations = _descend_rk2(
+            pos_act, gradient, dist, weight, step_size, eps, tolerance
+        )
+
+    return (pos_act[0] if single else pos_act), evaluations
+
+
+def grad_descend(start_pos, gradient, dist=2, weight=[1, 1, 1],
+                 step_size=0.1, eps=1e-4, method="euler", tolerance=0.1):
+    ''' Walks a determinated distance following the gradient field
+
+    ``start_pos`` is a single position (3,) or an array of positions (N, 3).
+    All positions are moved together: each step interpolates the gradient at
+    every position still moving with a single ``map_coordinates`` call, and a
+    position stops once it has walked ``dist`` or its step is below ``eps``,
+    exactly as when it is moved on its own.
+
+    ``gradient`` is a (3, x, y, z) field, or a (x, y, z) scalar field which
+    is descended: its negated central differences are then interpolated at
+    the positions as needed. More than a voxel away from the border, this is
+    the same as interpolating its negated ``np.gradient``, without holding
+    three times the field.
+
+    ``method="euler"`` takes fixed steps of ``step_size`` times the gradient.
+    ``method="rk2"`` integrates the same path with adaptive Heun steps, whose
+    error is kept below ``tolerance`` times their length, and stops exactly
+    at ``dist``. A fixed step walks about ``step_size`` times the squared
+    voxel size, so on 1 mm grids rk2 needs several times fewer gradient
+    evaluations for a smaller error; on grids of several mm, a fixed step
+    walks past ``dist`` in one or two evaluations, which rk2 (two at least
+    per step) does not undercut. See ``compare_grad_descend``.
+    '''
+
+    return _descend(start_pos, gradient, dist, weight, step_size, eps,
+                    method, tolerance)[0]
+
 
-        walked_distance += step_length
+def compare_grad_descend(start_pos, gradient, dist=2, weight=[1, 1, 1],
+                         step_size=0.1, eps=1e-4, method="rk2",
+                         tolerance=0.1):
+    ''' Descends with ``method`` and with fixed steps, and compares them
 
-        pos_act = pos_new
+    Returns
+    -------
+    positions : ndarray
+        Positions reached with ``method``
+    comparison : dict
+        ``max_difference`` and ``mean_difference`` between the positions of
+        both methods (units of ``weight``), and the number of gradient
+        evaluations of each (``evaluations`` and ``euler_evaluations``)
+    '''
 
-    return pos_act
+    positions, evaluations = _descend(start_pos, gradient, dist, weight,
+                                      step_size, eps, method, tolerance)
+    fixed, euler_evaluations = _descend(start_pos, gradient, dist, weight,
+                                        step_size, eps, "euler", tolerance)
+    difference = _weighted_length(
+        np.reshape(positions - fixed, (-1, 3)), np.abs(weight)
+    )
+    comparison = {
+        'max_difference': float(difference.max(initial=0)),
+        'mean_difference': float(difference.mean()) if len(difference)
+        else 0.0,
+        'evaluations': evaluations,
+        'euler_evaluations': euler_evaluations,
+    }
+    return positions, comparison
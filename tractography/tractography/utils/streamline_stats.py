@@ -0,0 +1,273 @@
+import csv
+import multiprocessing
+
+import numpy as np
+
+from tractography.utils.read_tck import iter_tck, tck_row_ranges
+
+# Histogram range and bin width of each metric, used to stream quantiles
+# without keeping the per-streamline values; values beyond the range are
+# counted in the last bin
+HISTOGRAMS = {
+    "length": (0.0, 500.0, 0.5),
+    "endpoint_distance": (0.0, 300.0, 0.5),
+    "mean_curvature": (0.0, 1.0, 0.001),
+    "max_angle": (0.0, 180.0, 0.25),
+}
+
+# Units of each metric, as reported in the TSV
+UNITS = {
+    "length": "mm",
+    "endpoint_distance": "mm",
+    "mean_curvature": "rad/mm",
+    "max_angle": "deg",
+}
+
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def _reduce_per_streamline(ufunc, values, offsets, valid):
+    """Reduce runs of ``values`` starting at each offset, in one call.
+
+    ``values`` is laid out like the packed points, so the run of streamline
+    ``i`` ends right before ``offsets[i + 1]``. Entries that do not belong
+    to their run (e.g. segments joining two streamlines) must already be set
+    to the identity of ``ufunc``; runs of streamlines for which ``valid`` is
+    False are set to 0.
+    """
+
+    # A trailing pad keeps the offsets of short trailing streamlines in
+    # range for reduceat
+    padded = np.zeros(len(values) + 1, dtype=values.dtype)
+    padded[:-1] = values
+    starts = np.minimum(offsets, len(values))
+    result = ufunc.reduceat(padded, starts)
+    result[~valid] = 0
+    return result
+
+
+def streamline_geometry(streamlines):
+    """Length and shape measures of every streamline, without a loop.
+
+    Segment vectors and turning angles are computed over the whole point
+    array at once, and summed or maximised per streamline with
+    ``reduceat`` on the streamline offsets. Lengths are those of
+    ``Streamlines.arc_lengths``.
+
+    Parameters
+    ----------
+    streamlines : Streamlines
+        Streamlines, in mm
+
+    Returns
+    -------
+    geometry : dict of ndarray
+        Per-streamline values keyed by the names in ``HISTOGRAMS``: arc
+        length (mm), straight-line distance between the endpoints (mm), mean
+        curvature as the total turning angle per unit length (rad/mm), and
+        largest angle between consecutive segments (degrees)
+    """
+
+    if not streamlines.is_packed:
+        streamlines = streamlines.packed()
+    points = np.asarray(streamlines.points, dtype=np.float64)
+    offsets, lengths = streamlines.offsets, streamlines.lengths
+
+    first = np.minimum(offsets, max(len(points) - 1, 0))
+    last = first + np.maximum(lengths - 1, 0)
+    endpoint_distance = np.zeros(len(lengths))
+    if len(points):
+        endpoint_distance = np.linalg.norm(
+            points[last] - points[first], axis=1
+        )
+
+    segments = np.diff(points, axis=0)
+    segment_lengths = np.sqrt(np.einsum("ij,ij->i", segments, segments))
+    # Segment j joins points j and j + 1, which belong to different
+    # streamlines right before each offset
+    inner = np.ones(len(segments), dtype=bool)
+    boundaries = offsets[1:] - 1
+    inner[boundaries[(boundaries >= 0) & (boundaries < len(inner))]] = False
+    segment_lengths[~inner] = 0
+
+    # Turning angle between segments j and j + 1 of the same streamline
+    norms = segment_lengths[:-1] * segment_lengths[1:]
+    dots = np.einsum("ij,ij->i", segments[:-1], segments[1:])
+    turns = inner[:-1] & inner[1:] & (norms > 0)
+    cosines = np.divide(dots, norms, out=np.ones_like(dots), where=turns)
+    angles = np.arccos(np.clip(cosines, -1.0, 1.0))
+
+    length = streamlines.arc_lengths()
+    total_angle = _reduce_per_streamline(np.add, angles, offsets, lengths > 2)
+    max_angle = _reduce_per_streamline(
+        np.maximum, angles, offsets, lengths > 2
+    )
+
+    return {
+        "length": length,
+        "endpoint_distance": endpoint_distance,
+        "mean_curvature": np.divide(
+            total_angle,
+            length,
+            out=np.zeros_like(length),
+            where=length > 0,
+        ),
+        "max_angle": np.degrees(max_angle),
+    }
+
+
+def _empty_summary():
+    summary = {}
+    for name, (low, high, width) in HISTOGRAMS.items():
+        n_bins = int(round((high - low) / width))
+        summary[name] = {
+            "n": 0,
+            "sum": 0.0,
+            "sum_sq": 0.0,
+            "min": np.inf,
+            "max": -np.inf,
+            "histogram": np.zeros(n_bins, dtype=np.int64),
+        }
+    return summary
+
+
+def _accumulate(summary, geometry):
+    """Add per-streamline values to running moments and histograms."""
+
+    for name, values in geometry.items():
+        if not len(values):
+            continue
+        low, high, width = HISTOGRAMS[name]
+        entry = summary[name]
+        n_bins = len(entry["histogram"])
+        bins = ((values - low) / width).astype(np.int64)
+        np.clip(bins, 0, n_bins - 1, out=bins)
+        entry["histogram"] += np.bincount(bins, minlength=n_bins)
+        entry["n"] += len(values)
+        entry["sum"] += float(values.sum())
+        entry["sum_sq"] += float(np.dot(values, values))
+        entry["min"] = min(entry["min"], float(values.min()))
+        entry["max"] = max(entry["max"], float(values.max()))
+
+
+def _merge_summaries(partials):
+    summary = _empty_summary()
+    for partial in partials:
+        for name, entry in partial.items():
+            total = summary[name]
+            total["histogram"] += entry["histogram"]
+            for key in ("n", "sum", "sum_sq"):
+                total[key] += entry[key]
+            total["min"] = min(total["min"], entry["min"])
+            total["max"] = max(total["max"], entry["max"])
+    return summary
+
+
+def _stats_range(args):
+    """Running summary of the streamlines starting in one row range."""
+
+    tck_file, row_range, chunk_bytes = args
+    summary = _empty_summary()
+    for streamlines in iter_tck(
+        tck_file, chunk_bytes=chunk_bytes, row_range=row_range
+    ):
+        _accumulate(summary, streamline_geometry(streamlines))
+    return summary
+
+
+def _histogram_quantile(histogram, edges, q, low, high):
+    """Quantile interpolated linearly within the histogram bins."""
+
+    cumulative = np.cumsum(histogram)
+    target = q * cumulative[-1]
+    i = int(np.searchsorted(cumulative, target, side="left"))
+    before = cumulative[i - 1] if i else 0
+    fraction = (target - before) / histogram[i] if histogram[i] else 0.0
+    value = edges[i] + fraction * (edges[i + 1] - edges[i])
+    return float(np.clip(value, low, high))
+
+
+def compute_streamline_stats(tck_file, n_jobs=1, chunk_bytes=64 * 2**20):
+    """Summarise the geometry of all streamlines of a TCK file.
+
+    The file is streamed in chunks with ``iter_tck`` and per-streamline
+    values from ``streamline_geometry`` are folded into running moments and
+    fixed-width histograms, so memory does not grow with the tractogram.
+
+    Parameters
+    ----------
+    tck_file : str
+        Path to .tck file
+    n_jobs : int or None
+        Number of processes, each streaming a range of the file; None uses
+        all CPUs
+    chunk_bytes : int
+        Approximate number of bytes of track data read at a time
+
+    Returns
+    -------
+    stats : dict of dict
+        For each metric of ``HISTOGRAMS``: the number of streamlines, mean,
+        standard deviation, exact minimum and maximum, the quantiles in
+        ``QUANTILES`` (keys ``p5``, ``p25``, ...) interpolated from the
+        histogram, and the ``histogram`` counts with their ``bin_edges``
+    """
+
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+    tasks = [
+        (str(tck_file), row_range, chunk_bytes)
+        for row_range in tck_row_ranges(tck_file, n_jobs)
+    ]
+
+    if len(tasks) > 1:
+        with multiprocessing.Pool(len(tasks)) as pool:
+            summary = _merge_summaries(pool.map(_stats_range, tasks))
+    else:
+        summary = _stats_range(tasks[0])
+
+    stats = {}
+    for name, entry in summary.items():
+        low, high, width = HISTOGRAMS[name]
+        histogram = entry["histogram"]
+        edges = low + width * np.arange(len(histogram) + 1)
+        n = entry["n"]
+        metric = {"n": n, "histogram": histogram, "bin_edges": edges}
+        if n:
+            mean = entry["sum"] / n
+            metric["mean"] = mean
+            variance = max(entry["sum_sq"] / n - mean**2, 0)
+            metric["std"] = float(np.sqrt(variance))
+            metric["min"] = entry["min"]
+            metric["max"] = entry["max"]
+            for q in QUANTILES:
+                metric[f"p{round(q * 100)}"] = _histogram_quantile(
+                    histogram, edges, q, entry["min"], entry["max"]
+                )
+        else:
+            for key in ("mean", "std", "min", "max"):
+                metric[key] = np.nan
+            for q in QUANTILES:
+                metric[f"p{round(q * 100)}"] = np.nan
+        stats[name] = metric
+    return stats
+
+
+def save_streamline_stats(stats, out_file):
+    """Write the summary of ``compute_streamline_stats`` as a TSV.
+
+    The file has one row per metric, with its unit, the number of
+    streamlines, mean, standard deviation, minimum, quantiles and maximum.
+    """
+
+    quantiles = [f"p{round(q * 100)}" for q in QUANTILES]
+    columns = ["n", "mean", "std", "min", *quantiles, "max"]
+    with open(out_file, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(["metric", "unit", *columns])
+        for name, metric in stats.items():
+            writer.writerow(
+                [name, UNITS[name], metric["n"]]
+                + [f"{metric[key]:.6g}" for key in columns[1:]]
+            )
+    return out_file
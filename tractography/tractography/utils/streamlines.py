@@ -0,0 +1,153 @@
+import numbers
+
+import numpy as np
+
+
+def _gather(points, offsets, lengths):
+    """Copy the given streamlines into one contiguous native-endian array.
+
+    Returns
+    -------
+    packed : ndarray, shape (sum(lengths), 3)
+        Points of all streamlines, back to back
+    packed_offsets : ndarray of int64
+        Index of the first point of each streamline in ``packed``
+    """
+
+    packed_offsets = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=packed_offsets[1:])
+
+    index = np.arange(int(lengths.sum()), dtype=np.int64)
+    index += np.repeat(offsets - packed_offsets, lengths)
+
+    packed = np.asarray(points[index], dtype=points.dtype.newbyteorder("="))
+    return packed, packed_offsets
+
+
+class Streamlines:
+    """Array-backed collection of streamlines.
+
+    All points live in a single ``(N, 3)`` array; streamline ``i`` is the
+    view ``points[offsets[i]:offsets[i] + lengths[i]]``. Streamlines need
+    not be back to back in ``points`` (e.g. the delimiter rows of a
+    memory-mapped TCK file stay in place), which is what makes slicing and
+    indexing by streamline id free of copies of the point data.
+
+    Parameters
+    ----------
+    points : ndarray, shape (N, 3)
+        Point buffer
+    offsets : array-like of int, optional
+        Index of the first point of each streamline. Defaults to packed
+        streamlines, i.e. the cumulative sum of ``lengths``.
+    lengths : array-like of int, optional
+        Number of points of each streamline. Defaults to a single streamline
+        spanning ``points`` when ``offsets`` is not given either.
+    """
+
+    __slots__ = ("points", "offsets", "lengths")
+
+    def __init__(self, points, offsets=None, lengths=None):
+        if lengths is None:
+            if offsets is not None:
+                raise ValueError("lengths are required when offsets are given")
+            lengths = [len(points)] if len(points) else []
+        lengths = np.asarray(lengths, dtype=np.int64)
+
+        if offsets is None:
+            offsets = np.zeros(len(lengths), dtype=np.int64)
+            np.cumsum(lengths[:-1], out=offsets[1:])
+        offsets = np.asarray(offsets, dtype=np.int64)
+
+        if offsets.shape != lengths.shape:
+            raise ValueError(
+                f"offsets and lengths differ in shape: {offsets.shape} "
+                f"and {lengths.shape}"
+            )
+
+        self.points = points
+        self.offsets = offsets
+        self.lengths = lengths
+
+    @classmethod
+    def from_list(cls, streamlines, dtype=np.float32):
+        """Pack a sequence of ``(n_i, 3)`` arrays into a container."""
+        lengths = np.array([len(s) for s in streamlines], dtype=np.int64)
+        if len(lengths):
+            points = np.concatenate(streamlines).astype(dtype, copy=False)
+        else:
+            points = np.empty((0, 3), dtype=dtype)
+        return cls(points, lengths=lengths)
+
+    @classmethod
+    def concatenate(cls, parts):
+        """Pack several containers, in order, into a single one."""
+        parts = [p for p in parts if len(p)]
+        if not parts:
+            return cls(np.empty((0, 3), dtype=np.float32), lengths=[])
+        gathered = [_gather(p.points, p.offsets, p.lengths)[0] for p in parts]
+        lengths = np.concatenate([p.lengths for p in parts])
+        return cls(np.concatenate(gathered), lengths=lengths)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, key):
+        if isinstance(key, numbers.Integral):
+            start = self.offsets[key]
+            return self.points[start : start + self.lengths[key]]
+        return Streamlines(self.points, self.offsets[key], self.lengths[key])
+
+    def __iter__(self):
+        for start, length in zip(self.offsets, self.lengths):
+            yield self.points[start : start + length]
+
+    def __repr__(self):
+        return (
+            f"Streamlines(n_streamlines={len(self)}, "
+            f"n_points={self.n_points}, dtype={self.points.dtype})"
+        )
+
+    @property
+    def n_points(self):
+        """Total number of points over all streamlines."""
+        return int(self.lengths.sum())
+
+    @property
+    def is_packed(self):
+        """Whether the streamlines fill ``points`` back to back."""
+        if not len(self):
+            return True
+        return (
+            self.offsets[0] == 0
+            and np.array_equal(
+                self.offsets[1:], self.offsets[:-1] + self.lengths[:-1]
+            )
+            and self.n_points == len(self.points)
+        )
+
+    def arc_lengths(self):
+        """Length of each streamline, in the units of ``points``."""
+        points = np.asarray(self.points, dtype=np.float64)
+        segments = np.linalg.norm(np.diff(points, axis=0), axis=1)
+        # Segments crossing streamline boundaries never fall inside a
+        # [first, last) span, so a cumulative sum gives every length at once
+        cumulative = np.zeros(len(points))
+        np.cumsum(np.nan_to_num(segments), out=cumulative[1:])
+        last = self.offsets + np.maximum(self.lengths - 1, 0)
+        return cumulative[last] - cumulative[self.offsets]
+
+    def packed(self):
+        """Return a copy whose streamlines are contiguous and native-endian."""
+        points, offsets = _gather(self.points, self.offsets, self.lengths)
+        return Streamlines(points, offsets, self.lengths.copy())
+
+    def to_array_sequence(self):
+        """Wrap the buffers in a nibabel ``ArraySequence`` without copying."""
+        from nibabel.streamlines import ArraySequence
+
+        seq = ArraySequence()
+        seq._data = self.points
+        seq._offsets = self.offsets
+        seq._lengths = self.lengths
+        return seq
@@ -0,0 +1,132 @@
+import numpy as np
+
+from tractography.utils.read_tck import _read_tck_header, iter_tck
+from tractography.utils.streamlines import Streamlines
+from tractography.utils.write_tck import write_tck
+
+# Default length strata (mm) for method="length"; streamlines longer than
+# the last edge fall in the last stratum
+LENGTH_BINS = (0, 20, 40, 60, 80, 100, 150, 200, 250)
+
+
+def _update_reservoir(reservoir, keys, ids, batch, capacity):
+    """Keep the ``capacity`` streamlines with the smallest keys so far.
+
+    Giving every streamline an independent uniform key and keeping the
+    smallest ones is a uniform sample without replacement, and can be
+    updated a whole batch at a time.
+    """
+
+    res_keys, res_ids, res_streamlines = reservoir
+    if len(res_keys) == capacity:
+        candidate = keys < res_keys.max()
+        keys, ids, batch = keys[candidate], ids[candidate], batch[candidate]
+    if not len(keys):
+        return reservoir
+
+    all_keys = np.concatenate((res_keys, keys))
+    all_ids = np.concatenate((res_ids, ids))
+    merged = Streamlines.concatenate((res_streamlines, batch))
+    if len(all_keys) > capacity:
+        keep = np.argpartition(all_keys, capacity - 1)[:capacity]
+        return all_keys[keep], all_ids[keep], merged[keep].packed()
+    return all_keys, all_ids, merged
+
+
+def subsample_tck(
+    tck_file,
+    n_samples,
+    method="uniform",
+    length_bins=LENGTH_BINS,
+    seed=0,
+    out_file=None,
+    chunk_bytes=64 * 2**20,
+):
+    """Draw a random subset of the streamlines of a TCK file in one pass.
+
+    The file is streamed with ``iter_tck`` and only the current sample is
+    kept in memory, so the cost is bounded by ``n_samples`` rather than by
+    the size of the tractogram.
+
+    Parameters
+    ----------
+    tck_file : str
+        Path to .tck file
+    n_samples : int
+        Number of streamlines to draw
+    method : {"uniform", "length"}
+        "uniform" draws every streamline with the same probability.
+        "length" splits ``n_samples`` evenly across the length strata in
+        ``length_bins`` and samples uniformly within each, so that short and
+        long streamlines are represented whatever their share of the
+        tractogram. Strata holding fewer streamlines than their quota are
+        returned whole, so the sample can then be smaller than
+        ``n_samples``.
+    length_bins : sequence of float
+        Edges (mm) of the length strata for ``method="length"``
+    seed : int
+        Seed of the random generator; the sample does not depend on
+        ``chunk_bytes``
+    out_file : str or None
+        When given, the sample is written to this .tck file
+    chunk_bytes : int
+        Approximate number of bytes of track data read at a time
+
+    Returns
+    -------
+    Streamlines or str
+        The sampled streamlines in file order, or ``out_file`` when given
+    """
+
+    if method not in ("uniform", "length"):
+        raise ValueError(f"Unknown sampling method: {method}")
+    if n_samples < 1:
+        raise ValueError(f"n_samples must be positive, got {n_samples}")
+
+    n_strata = len(length_bins) - 1 if method == "length" else 1
+    if n_strata < 1:
+        raise ValueError("length_bins needs at least two edges")
+    quotas = np.full(n_strata, n_samples // n_strata)
+    quotas[: n_samples % n_strata] += 1
+
+    rng = np.random.default_rng(seed)
+    empty = (
+        np.empty(0),
+        np.empty(0, dtype=np.int64),
+        Streamlines(np.empty((0, 3), dtype=np.float32), lengths=[]),
+    )
+    reservoirs = [empty] * n_strata
+    n_seen = 0
+
+    for batch in iter_tck(tck_file, chunk_bytes=chunk_bytes):
+        keys = rng.random(len(batch))
+        ids = np.arange(n_seen, n_seen + len(batch))
+        n_seen += len(batch)
+
+        if method == "uniform":
+            strata = np.zeros(len(batch), dtype=np.int64)
+        else:
+            strata = np.digitize(batch.arc_lengths(), length_bins[1:-1])
+
+        for stratum in np.unique(strata):
+            if not quotas[stratum]:
+                continue
+            selected = strata == stratum
+            reservoirs[stratum] = _update_reservoir(
+                reservoirs[stratum],
+                keys[selected],
+                ids[selected],
+                batch[selected],
+                quotas[stratum],
+            )
+
+    ids = np.concatenate([r[1] for r in reservoirs])
+    sample = Streamlines.concatenate([r[2] for r in reservoirs])
+    sample = sample[np.argsort(ids, kind="stable")].packed()
+
+    if out_file is None:
+        return sample
+
+    header, _, _ = _read_tck_header(tck_file)
+    write_tck(out_file, sample, header=header)
+    return out_file
@@ -0,0 +1,126 @@
+import multiprocessing
+
+import nibabel
+import numpy as np
+
+from tractography.utils.read_tck import iter_tck, tck_row_ranges
+
+
+def _downsampled_grid(affine, shape, factor):
+    """Grid whose voxels each cover ``factor**3`` voxels of the given one."""
+
+    factor = int(factor)
+    if factor == 1:
+        return affine, tuple(shape)
+
+    # Voxel (0, 0, 0) of the new grid is centred on the block of reference
+    # voxels 0 .. factor - 1 along each axis
+    scaling = np.diag([factor, factor, factor, 1.0])
+    scaling[:3, 3] = (factor - 1) / 2.0
+    new_shape = tuple(int(np.ceil(n / factor)) for n in shape)
+    return affine @ scaling, new_shape
+
+
+def _accumulate_tdi(tdi, streamlines, world_to_voxel, shape):
+    """Add the voxels visited by each streamline to a flat count volume.
+
+    A voxel is counted once for every streamline entering it; consecutive
+    points of a streamline falling in the same voxel are merged.
+    """
+
+    ijk = np.rint(
+        nibabel.affines.apply_affine(world_to_voxel, streamlines.points)
+    ).astype(np.int64)
+    ids = np.repeat(np.arange(len(streamlines)), streamlines.lengths)
+
+    inside = np.all((ijk >= 0) & (ijk < shape), axis=1)
+    voxels = np.ravel_multi_index(ijk[inside].T, shape)
+    ids = ids[inside]
+
+    entering = np.ones(len(voxels), dtype=bool)
+    entering[1:] = (voxels[1:] != voxels[:-1]) | (ids[1:] != ids[:-1])
+    voxels = voxels[entering]
+
+    # bincount is much faster than add.at, but allocates a full volume
+    if len(voxels) > tdi.size // 8:
+        tdi += np.bincount(voxels, minlength=tdi.size).astype(tdi.dtype)
+    else:
+        np.add.at(tdi, voxels, 1)
+
+
+def _tdi_range(args):
+    """Track density of the streamlines starting in one row range."""
+
+    tck_file, row_range, affine, shape, chunk_bytes = args
+    tdi = np.zeros(int(np.prod(shape)), dtype=np.uint32)
+    world_to_voxel = np.linalg.inv(affine)
+    for streamlines in iter_tck(
+        tck_file, chunk_bytes=chunk_bytes, row_range=row_range
+    ):
+        _accumulate_tdi(tdi, streamlines, world_to_voxel, shape)
+    return tdi
+
+
+def compute_tdi(
+    tck_file,
+    reference,
+    out_file=None,
+    downsample=1,
+    n_jobs=1,
+    chunk_bytes=64 * 2**20,
+):
+    """Compute a track density image of a TCK file.
+
+    Streamline points are mapped to voxels of the reference grid through its
+    affine and counted with ``bincount``. The file is streamed in chunks, so
+    memory is bounded by one count volume and one chunk per process.
+
+    Parameters
+    ----------
+    tck_file : str
+        Path to .tck file
+    reference : str or nibabel image
+        Image defining the output grid, e.g. the T1w
+    out_file : str or None
+        Where to save the TDI; when None the image is returned in memory
+    downsample : int
+        Integer factor by which the reference grid is coarsened
+    n_jobs : int or None
+        Number of processes, each streaming a range of the file; None uses
+        all CPUs
+    chunk_bytes : int
+        Approximate number of bytes of track data read at a time
+
+    Returns
+    -------
+    str or nibabel.Nifti1Image
+        ``out_file`` when given, otherwise the uint32 TDI image
+    """
+
+    if not hasattr(reference, "affine"):
+        reference = nibabel.load(reference)
+    affine, shape = _downsampled_grid(
+        reference.affine, reference.shape[:3], downsample
+    )
+
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+    tasks = [
+        (str(tck_file), row_range, affine, shape, chunk_bytes)
+        for row_range in tck_row_ranges(tck_file, n_jobs)
+    ]
+
+    if len(tasks) > 1:
+        tdi = np.zeros(int(np.prod(shape)), dtype=np.uint32)
+        with multiprocessing.Pool(len(tasks)) as pool:
+            for partial in pool.imap_unordered(_tdi_range, tasks):
+                tdi += partial
+    else:
+        tdi = _tdi_range(tasks[0])
+
+    tdi_img = nibabel.Nifti1Image(tdi.reshape(shape), affine)
+    if out_file is None:
+        return tdi_img
+
+    nibabel.save(tdi_img, out_file)
+    return out_file
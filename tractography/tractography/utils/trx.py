@@ -0,0 +1,267 @@
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+
+import nibabel
+import numpy as np
+
+from tractography.utils.read_tck import iter_tck
+from tractography.utils.streamlines import Streamlines
+
+# Size of the fixed part of a zip local file header, and the position of
+# the file name and extra field lengths within it
+_ZIP_LOCAL_HEADER_SIZE = 30
+_ZIP_NAME_LENGTHS = slice(26, 30)
+
+
+def _write_array(f, array):
+    """Append an array to a raw little-endian file (object or path)."""
+    array = np.asarray(array)
+    array.astype(array.dtype.newbyteorder("<"), copy=False).tofile(f)
+
+
+def tck_to_trx(
+    tck_file,
+    out_file,
+    reference,
+    data_per_streamline=None,
+    groups=None,
+    dtype="float32",
+    chunk_bytes=64 * 2**20,
+):
+    """Convert a TCK file to the TRX format, streaming the track data.
+
+    A TRX tractogram is a directory, or a zip archive of it, holding
+    ``header.json`` and raw little-endian arrays whose shape and type are
+    encoded in their names: ``positions.3.<dtype>`` for all points back to
+    back, ``offsets.uint64`` for the first point of each streamline (plus
+    the total number of points), ``dps/<name>.<dtype>`` for data per
+    streamline and ``groups/<name>.uint32`` for sets of streamline ids.
+    The arrays are written as the .tck is read, and the archive is not
+    compressed, so every array can be memory-mapped (see ``load_trx``).
+
+    Parameters
+    ----------
+    tck_file : str
+        Path to .tck file
+    out_file : str
+        Output path; a zip archive when it ends with ``.trx``, a directory
+        otherwise
+    reference : str or nibabel image
+        Image whose grid is recorded in the header (``VOXEL_TO_RASMM`` and
+        ``DIMENSIONS``), e.g. the T1w the streamlines were tracked in
+    data_per_streamline : dict of array-like, optional
+        Extra per-streamline values, e.g. SIFT2 weights or cluster ids, of
+        shape ``(n_streamlines,)`` or ``(n_streamlines, k)``. The length of
+        every streamline is always stored, as ``dps/length.float32``.
+    groups : dict of array-like, optional
+        Streamline ids of named groups, e.g. bundles
+    dtype : {"float32", "float16"}
+        Type of the stored positions
+    chunk_bytes : int
+        Approximate number of bytes of track data read at a time
+
+    Returns
+    -------
+    out_file : str
+        Path to the TRX tractogram
+    """
+
+    if dtype not in ("float32", "float16"):
+        raise ValueError(f"Unsupported positions dtype: {dtype}")
+    if not hasattr(reference, "affine"):
+        reference = nibabel.load(reference)
+
+    out_file = os.path.abspath(str(out_file))
+    as_zip = out_file.endswith(".trx")
+    work_dir = tempfile.mkdtemp(
+        prefix=".trx_", dir=os.path.dirname(out_file)
+    )
+    try:
+        os.makedirs(os.path.join(work_dir, "dps"))
+        positions_file = os.path.join(work_dir, f"positions.3.{dtype}")
+        offsets_file = os.path.join(work_dir, "offsets.uint64")
+        lengths_file = os.path.join(work_dir, "dps", "length.float32")
+
+        n_streamlines = n_vertices = 0
+        with open(positions_file, "wb") as positions, open(
+            offsets_file, "wb"
+        ) as offsets, open(lengths_file, "wb") as lengths:
+            for batch in iter_tck(tck_file, chunk_bytes=chunk_bytes):
+                _write_array(positions, batch.points.astype(dtype))
+                _write_array(
+                    offsets, (batch.offsets + n_vertices).astype(np.uint64)
+                )
+                _write_array(lengths, batch.arc_lengths().astype(np.float32))
+                n_streamlines += len(batch)
+                n_vertices += batch.n_points
+            _write_array(offsets, np.array([n_vertices], dtype=np.uint64))
+
+        for name, values in (data_per_streamline or {}).items():
+            values = np.asarray(values)
+            if len(values) != n_streamlines:
+                raise ValueError(
+                    f"data_per_streamline {name!r} has {len(values)} values "
+                    f"for {n_streamlines} streamlines"
+                )
+            dims = "" if values.ndim == 1 else f".{values.shape[1]}"
+            _write_array(
+                os.path.join(work_dir, "dps", f"{name}{dims}.{values.dtype}"),
+                values,
+            )
+
+        if groups:
+            os.makedirs(os.path.join(work_dir, "groups"))
+        for name, ids in (groups or {}).items():
+            ids = np.asarray(ids, dtype=np.uint32)
+            if len(ids) and ids.max() >= n_streamlines:
+                raise ValueError(
+                    f"Group {name!r} refers to streamline {ids.max()} of "
+                    f"{n_streamlines}"
+                )
+            _write_array(
+                os.path.join(work_dir, "groups", f"{name}.uint32"), ids
+            )
+
+        header = {
+            "VOXEL_TO_RASMM": np.asarray(reference.affine).tolist(),
+            "DIMENSIONS": [int(n) for n in reference.shape[:3]],
+            "NB_STREAMLINES": n_streamlines,
+            "NB_VERTICES": n_vertices,
+        }
+        with open(os.path.join(work_dir, "header.json"), "w") as f:
+            json.dump(header, f)
+
+        if os.path.isdir(out_file):
+            shutil.rmtree(out_file)
+        if as_zip:
+            # Stored (not deflated) members can be memory-mapped in place
+            with zipfile.ZipFile(
+                out_file, "w", compression=zipfile.ZIP_STORED
+            ) as zf:
+                for root, _, files in os.walk(work_dir):
+                    for name in sorted(files):
+                        path = os.path.join(root, name)
+                        zf.write(path, os.path.relpath(path, work_dir))
+        else:
+            os.replace(work_dir, out_file)
+    finally:
+        if os.path.isdir(work_dir):
+            shutil.rmtree(work_dir)
+
+    return out_file
+
+
+def _trx_members(trx_file):
+    """Map the name of every array of a TRX tractogram to its location.
+
+    Returns
+    -------
+    members : dict
+        ``(path, byte_offset, n_bytes)`` of each member, keyed by its name
+        relative to the root of the tractogram (e.g. ``dps/length.float32``)
+    """
+
+    if os.path.isdir(trx_file):
+        members = {}
+        for root, _, files in os.walk(trx_file):
+            for name in files:
+                path = os.path.join(root, name)
+                members[os.path.relpath(path, trx_file)] = (
+                    path,
+                    0,
+                    os.path.getsize(path),
+                )
+        return members
+
+    members = {}
+    with zipfile.ZipFile(trx_file) as zf, open(trx_file, "rb") as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(
+                    f"{info.filename} is compressed in {trx_file} and cannot "
+                    "be memory-mapped"
+                )
+            # The data follows the local header, whose name and extra field
+            # may differ from those of the central directory
+            f.seek(info.header_offset)
+            local = f.read(_ZIP_LOCAL_HEADER_SIZE)
+            name_length, extra_length = np.frombuffer(
+                local[_ZIP_NAME_LENGTHS], dtype="<u2"
+            )
+            offset = (
+                info.header_offset
+                + _ZIP_LOCAL_HEADER_SIZE
+                + int(name_length)
+                + int(extra_length)
+            )
+            members[info.filename] = (trx_file, offset, info.file_size)
+    return members
+
+
+def _map_member(path, offset, n_bytes, name):
+    """Memory-map one ``<name>[.<dims>].<dtype>`` array."""
+
+    parts = os.path.basename(name).split(".")
+    dims = int(parts[1]) if len(parts) == 3 else 1
+    dtype = np.dtype(parts[-1]).newbyteorder("<")
+    n_rows = n_bytes // (dims * dtype.itemsize)
+    shape = (n_rows, dims) if dims > 1 else (n_rows,)
+    if not n_rows:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+
+def load_trx(trx_file):
+    """Memory-map a TRX tractogram.
+
+    Parameters
+    ----------
+    trx_file : str
+        Path to a TRX directory or uncompressed .trx archive
+
+    Returns
+    -------
+    streamlines : Streamlines
+        Streamlines backed by the memory-mapped positions
+    header : dict
+        Content of ``header.json``
+    data_per_streamline : dict of ndarray
+        Memory-mapped arrays of ``dps/``
+    groups : dict of ndarray
+        Memory-mapped streamline ids of ``groups/``
+    """
+
+    members = _trx_members(trx_file)
+    path, offset, n_bytes = members.pop("header.json")
+    with open(path, "rb") as f:
+        f.seek(offset)
+        header = json.loads(f.read(n_bytes))
+
+    positions = offsets = None
+    data_per_streamline, groups = {}, {}
+    for name, member in members.items():
+        folder, base = os.path.split(name)
+        array = _map_member(*member, name)
+        if base.startswith("positions."):
+            positions = array
+        elif base.startswith("offsets."):
+            offsets = array
+        elif folder == "dps":
+            data_per_streamline[base.split(".")[0]] = array
+        elif folder == "groups":
+            groups[base.split(".")[0]] = array
+
+    if positions is None or offsets is None:
+        raise ValueError(f"No positions or offsets found in {trx_file}")
+    if len(offsets) != header["NB_STREAMLINES"] + 1:
+        raise ValueError(
+            f"{trx_file} has {len(offsets)} offsets for "
+            f"{header['NB_STREAMLINES']} streamlines"
+        )
+
+    offsets = np.asarray(offsets, dtype=np.int64)
+    streamlines = Streamlines(positions, offsets[:-1], np.diff(offsets))
+    return streamlines, header, data_per_streamline, groups
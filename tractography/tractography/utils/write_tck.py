@@ -0,0 +1,225 @@
+import os
+
+import numpy as np
+
+from tractography.utils.read_tck import _read_tck_header, _tck_dtype
+from tractography.utils.streamlines import Streamlines
+
+# Digits reserved for the ``count`` field so it can be rewritten in place
+_COUNT_WIDTH = 10
+# Header fields that are always written by TCKWriter itself
+_RESERVED_FIELDS = ("datatype", "count", "file")
+
+
+def _format_header(header, datatype):
+    """Render a TCK header whose ``file:`` offset points right past it."""
+
+    lines = ["mrtrix tracks"]
+    for key, value in (header or {}).items():
+        if key not in _RESERVED_FIELDS:
+            lines.append(f"{key}: {value}")
+    lines.append(f"datatype: {datatype}")
+    lines.append(f"count: {0:0{_COUNT_WIDTH}d}")
+    text = "\n".join(lines) + "\n"
+
+    # The offset is part of the header it points past, so iterate until the
+    # number of digits is stable
+    offset = len(text.encode("utf-8"))
+    while True:
+        raw = f"{text}file: . {offset}\nEND\n".encode("utf-8")
+        if len(raw) == offset:
+            return raw
+        offset = len(raw)
+
+
+def _locate_count(raw_header):
+    """Find the byte position of the ``count`` field value and its digits.
+
+    The value is written as a space followed by a zero-padded integer, so
+    it can be rewritten in place as long as it fits in the same width.
+    """
+
+    start = raw_header.find(b"\ncount:")
+    if start < 0:
+        raise ValueError("No 'count:' field found in TCK header")
+    start += len(b"\ncount:")
+    stop = raw_header.index(b"\n", start)
+    return start, stop - start - 1
+
+
+class TCKWriter:
+    """Write streamlines to an MRTrix3 TCK file in large buffered batches.
+
+    The file always ends with the Inf end-of-file marker, which is
+    overwritten by the next batch, and the ``count`` field of the header is
+    rewritten in place when the writer is closed.
+
+    Parameters
+    ----------
+    tck_file : str
+        Path to .tck file
+    mode : {"w", "a"}
+        Create/overwrite the file, or append to an existing one. Appending
+        keeps the header and datatype of the existing file.
+    header : dict or None
+        Extra header fields, e.g. as returned by ``_read_tck_header``. The
+        ``datatype``, ``count`` and ``file`` fields are always managed by
+        the writer.
+    datatype : str
+        TCK datatype of new files: Float32LE, Float32BE, Float64LE or
+        Float64BE
+    buffer_bytes : int
+        Approximate size of a single write
+    """
+
+    def __init__(
+        self,
+        tck_file,
+        mode="w",
+        header=None,
+        datatype="Float32LE",
+        buffer_bytes=64 * 2**20,
+    ):
+        if mode not in ("w", "a"):
+            raise ValueError(f"mode must be 'w' or 'a', got {mode!r}")
+
+        self.tck_file = tck_file
+        self.buffer_bytes = buffer_bytes
+
+        if mode == "a" and os.path.exists(tck_file):
+            existing, offset, self.dtype = _read_tck_header(tck_file)
+            self.count = int(existing.get("count", 0))
+            self._file = open(tck_file, "r+b")
+            self._count_pos, self._count_digits = _locate_count(
+                self._file.read(offset)
+            )
+            self._seek_end_of_data(offset)
+        else:
+            self.dtype = _tck_dtype(datatype)
+            self.count = 0
+            raw_header = _format_header(header, datatype)
+            self._file = open(tck_file, "wb")
+            self._file.write(raw_header)
+            self._count_pos, self._count_digits = _locate_count(raw_header)
+
+        self._max_count = 10**self._count_digits - 1
+        self._end_marker = np.full((1, 3), np.inf, dtype=self.dtype)
+        self._write_rows(np.empty((0, 3), dtype=self.dtype))
+
+    def _seek_end_of_data(self, offset):
+        """Position the file right after the last complete streamline."""
+
+        row_bytes = 3 * self.dtype.itemsize
+        size = self._file.seek(0, os.SEEK_END)
+        end = offset + (size - offset) // row_bytes * row_bytes
+
+        position = offset
+        if end > offset:
+            self._file.seek(end - row_bytes)
+            last = np.frombuffer(self._file.read(row_bytes), dtype=self.dtype)
+            if np.isinf(last).all():
+                position = end - row_bytes
+            elif np.isnan(last).all():
+                position = end
+            else:
+                raise ValueError(
+                    f"Cannot append to {self.tck_file}: it does not end with "
+                    "a complete streamline"
+                )
+
+        self._file.seek(position)
+        self._file.truncate()
+
+    def _write_rows(self, rows):
+        """Write rows followed by the end marker, then step back over it."""
+
+        rows.tofile(self._file)
+        self._end_marker.tofile(self._file)
+        self._file.seek(-self._end_marker.nbytes, os.SEEK_CUR)
+
+    def write(self, streamlines):
+        """Append a batch of streamlines.
+
+        Parameters
+        ----------
+        streamlines : Streamlines or sequence of ndarray
+            Streamlines to write; converted to the file's datatype
+        """
+
+        if not isinstance(streamlines, Streamlines):
+            streamlines = Streamlines.from_list(
+                list(streamlines), dtype=self.dtype
+            )
+        if not len(streamlines):
+            return
+        if self.count + len(streamlines) > self._max_count:
+            raise ValueError(
+                f"Cannot store more than {self._max_count} streamlines in the "
+                f"'count' field of {self.tck_file}"
+            )
+
+        # Split the batch so that each write holds about buffer_bytes
+        max_rows = max(1, self.buffer_bytes // (3 * self.dtype.itemsize))
+        ends = np.cumsum(streamlines.lengths + 1)
+        start = 0
+        while start < len(streamlines):
+            base = ends[start - 1] if start else 0
+            stop = int(np.searchsorted(ends, base + max_rows, side="right"))
+            stop = max(stop, start + 1)
+            self._write_rows(self._delimited(streamlines[start:stop]))
+            start = stop
+
+        self.count += len(streamlines)
+
+    def _delimited(self, streamlines):
+        """Lay out streamlines back to back, each followed by a NaN row."""
+
+        lengths = streamlines.lengths
+        n_points = int(lengths.sum())
+        ids = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+
+        packed_offsets = np.zeros(len(lengths), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=packed_offsets[1:])
+        index = np.arange(n_points, dtype=np.int64)
+
+        rows = np.full((n_points + len(lengths), 3), np.nan, dtype=self.dtype)
+        rows[index + ids] = streamlines.points[
+            index + (streamlines.offsets - packed_offsets)[ids]
+        ]
+        return rows
+
+    def close(self):
+        """Rewrite the ``count`` field and close the file."""
+
+        if self._file.closed:
+            return
+        self._file.seek(self._count_pos)
+        self._file.write(
+            f" {self.count:0{self._count_digits}d}".encode("utf-8")
+        )
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_tck(tck_file, streamlines, header=None, datatype="Float32LE"):
+    """Write streamlines to a new TCK file.
+
+    Parameters
+    ----------
+    tck_file : str
+        Path to .tck file
+    streamlines : Streamlines or sequence of ndarray
+        Streamlines to write
+    header : dict or None
+        Extra header fields
+    datatype : str
+        TCK datatype: Float32LE, Float32BE, Float64LE or Float64BE
+    """
+
+    with TCKWriter(tck_file, header=header, datatype=datatype) as writer:
+        writer.write(streamlines)
@@ -1,42 +1,65 @@
 from nipype.interfaces.utility.wrappers import Function
 from nipype import IdentityInterface, Node, Workflow, Merge
-from nipype.interfaces.mrtrix3.utils import ComputeTDI
 import os
 
 TEMPLATE_ROOT = os.path.join(os.path.dirname(__file__), "report_template")
 REPORT_TEMPLATE = os.path.join(TEMPLATE_ROOT, "report_template.html")
 
 
-def plot_tdi_on_image(tdi_file, background_file, title="Track Density"):
+def plot_tdi_on_image(
+    tdi_file,
+    background_file,
+    title="Track Density",
+    n_jobs=1,
+    figure_format="svg",
+    dpi=100,
+    max_bytes=None,
+):
     """Plot track density image overlaid on anatomical image.
 
     Parameters
     ----------
     tdi_file : str
-        Path to track density image (.mif or .nii.gz)
+        Path to track density image (.mif or .nii.gz), or to a .tck
+        tractogram whose track density is then computed in-process on the
+        grid of the background image
     background_file : str
         Path to background anatomical image (NIfTI)
     title : str
         Title for the plot
+    n_jobs : int
+        Number of processes used to compute the track density from a .tck
+    figure_format : {"svg", "png", "webp"}
+        Output format; png and webp are rasterised at ``dpi`` and
+        compressed to at most ``max_bytes``, see
+        ``tractography.utils.figures.save_figure``
+    dpi : float
+        Resolution of rasterised figures
+    max_bytes : int or None
+        Byte budget of rasterised figures
 
     Returns
     -------
     out_file : str
-        Path to output SVG file
+        Path to output figure
     """
     import nibabel as nib
     import numpy as np
     from nilearn.plotting import plot_stat_map
     from nilearn.image import new_img_like
     import matplotlib.pyplot as plt
-    import os
-
-    # Load TDI image
-    tdi_img = nib.load(tdi_file)
+    from tractography.utils.figures import save_figure
+    from tractography.utils.tdi import compute_tdi
 
     # Load background image
     bg_img = nib.load(background_file)
 
+    # Load TDI image, or map the streamlines onto the background grid
+    if str(tdi_file).endswith(".tck"):
+        tdi_img = compute_tdi(tdi_file, bg_img, n_jobs=n_jobs)
+    else:
+        tdi_img = nib.load(tdi_file)
+
     # Create plot
     display = plot_stat_map(
         stat_map_img=tdi_img,
@@ -48,16 +71,21 @@ def plot_tdi_on_image(tdi_file, background_file, title="Track Density"):
         threshold=500,
     )
 
-    # Save as SVG
-    out_file = "tdi_on_image.svg"
-    display.savefig(out_file)
+    out_file = save_figure(
+        display, "tdi_on_image", figure_format, dpi, max_bytes
+    )
     plt.close()
 
-    return os.path.abspath(out_file)
+    return out_file
 
 
 def plot_parcellation_on_t1w(
-    parcellation_t1w, t1w_file, title="Parcellation on T1w"
+    parcellation_t1w,
+    t1w_file,
+    title="Parcellation on T1w",
+    figure_format="svg",
+    dpi=100,
+    max_bytes=None,
 ):
     """Plot a parcellation image overlaid on a T1w image using nilearn.
 
@@ -69,15 +97,23 @@ def plot_parcellation_on_t1w(
         Path to the T1w background image (NIfTI)
     title : str
         Title for the plot
+    figure_format : {"svg", "png", "webp"}
+        Output format; png and webp are rasterised at ``dpi`` and
+        compressed to at most ``max_bytes``, see
+        ``tractography.utils.figures.save_figure``
+    dpi : float
+        Resolution of rasterised figures
+    max_bytes : int or None
+        Byte budget of rasterised figures
 
     Returns
     -------
     out_file : str
-        Path to output SVG file
+        Path to output figure
     """
     from nilearn.plotting import plot_roi
     import matplotlib.pyplot as plt
-    import os
+    from tractography.utils.figures import save_figure
 
     display = plot_roi(
         roi_img=parcellation_t1w,
@@ -87,15 +123,43 @@ def plot_parcellation_on_t1w(
         colorbar=True,
     )
 
-    out_file = "parcellation_on_t1w.svg"
-    display.savefig(out_file)
+    out_file = save_figure(
+        display, "parcellation_on_t1w", figure_format, dpi, max_bytes
+    )
     plt.close()
 
-    return os.path.abspath(out_file)
+    return out_file
+
+
+def compute_label_centroids(parcellation_t1w):
+    """Save the centre of mass of every parcellation label as a TSV.
+
+    Computed once per parcellation and shared by the connectome views; see
+    ``tractography.utils.connectome.label_centroids``.
+
+    Returns
+    -------
+    out_file : str
+        Path to the TSV (label, x, y, z, n_voxels)
+    """
+    import os
+    from tractography.utils.connectome import (
+        label_centroids,
+        save_label_centroids,
+    )
+
+    out_file = os.path.abspath("label_centroids.tsv")
+    return save_label_centroids(*label_centroids(parcellation_t1w), out_file)
 
 
 def plot_connectome_interactive(
-    connectome_file, parcellation_t1w, surfaces_t1=None
+    connectome_file,
+    parcellation_t1w=None,
+    surfaces_t1=None,
+    centroids_file=None,
+    max_triangles=None,
+    mesh_cache_dir=None,
+    js_lib_url=None,
 ):
     """Generate an interactive 3D connectome visualization on the subject's
     pial surface.
@@ -105,25 +169,48 @@ def plot_connectome_interactive(
     fsaverage mesh with the subject-specific pial GIfTI files from sMRIprep.
     Falls back to fsaverage for any missing hemisphere.
 
+    The surfaces and the JavaScript libraries make up most of the page:
+    ``max_triangles`` decimates each surface, and ``js_lib_url`` loads the
+    libraries from a file shared by all reports instead of embedding them.
+
     Parameters
     ----------
     connectome_file : str
-        Path to the connectome CSV produced by tck2connectome.
+        Path to the connectome CSV produced by tck2connectome; its binary
+        companion is memory-mapped when present, see
+        ``tractography.utils.connectome.load_connectome``.
     parcellation_t1w : str
-        Path to the parcellation NIfTI in T1w space.
+        Path to the parcellation NIfTI in T1w space; only read when
+        ``centroids_file`` is not given.
     surfaces_t1 : list of str or None
         Paths to the left and right pial surface GIfTI files in T1w/fsnative
         space from sMRIprep derivatives.
+    centroids_file : str or None
+        Label centroids saved by ``compute_label_centroids``, used as node
+        coordinates.
+    max_triangles : int or None
+        Triangle budget of each surface, see
+        ``tractography.utils.decimate.decimate_mesh``; None keeps the full
+        resolution.
+    mesh_cache_dir : str or None
+        Directory caching the decimated surfaces, keyed by the content of
+        the surface files.
+    js_lib_url : str or None
+        URL, relative to the report, of the JavaScript written by
+        ``write_connectome_js``; by default the libraries are embedded.
 
     Returns
     -------
     html_str : str
         An ``<iframe>`` HTML string ready for embedding in a report.
     """
-    import numpy as np
-    import nibabel as nib
-    from scipy import ndimage
     from nilearn.plotting.html_connectome import _get_connectome
+    from tractography.utils.connectome import (
+        label_centroids,
+        load_connectome,
+        load_label_centroids,
+    )
+    from tractography.utils.decimate import decimated_surface
 
     def _make_connectome_html_with_surfaces(
         connectome_info, pial_left, pial_right
@@ -150,6 +237,13 @@ def plot_connectome_interactive(
             mesh_to_plotly,
         )
 
+        def _mesh(surf_path):
+            if max_triangles is None:
+                return mesh_to_plotly(surf_path)
+            return mesh_to_plotly(
+                decimated_surface(surf_path, max_triangles, mesh_cache_dir)
+            )
+
         plot_info = {"connectome": connectome_info}
 
         # Use subject surfaces where available, fall back to fsaverage otherwise
@@ -159,11 +253,11 @@ def plot_connectome_interactive(
             ("pial_right", pial_right),
         ]:
             if surf_path is not None:
-                plot_info[key] = mesh_to_plotly(surf_path)
+                plot_info[key] = _mesh(surf_path)
             else:
                 if fsaverage is None:
                     fsaverage = datasets.fetch_surf_fsaverage()
-                plot_info[key] = mesh_to_plotly(fsaverage[key])
+                plot_info[key] = _mesh(fsaverage[key])
 
         as_json = json.dumps(plot_info)
         as_html = get_html_template(
@@ -176,26 +270,22 @@ def plot_connectome_interactive(
                 ),
             }
         )
-        as_html = add_js_lib(as_html, embed_js=True)
+        if js_lib_url is None:
+            as_html = add_js_lib(as_html, embed_js=True)
+        else:
+            as_html = as_html.replace(
+                "$INSERT_JS_LIBRARIES_HERE",
+                f'<script src="{js_lib_url}"></script>',
+            )
         return ConnectomeView(as_html)
 
-    matrix = np.loadtxt(connectome_file, delimiter=",")
-    matrix = matrix + matrix.T - np.diag(np.diag(matrix))
-
-    parc_img = nib.load(parcellation_t1w)
-    parc_data = parc_img.get_fdata()
-    affine = parc_img.affine
-
-    labels = np.unique(parc_data)
-    labels = sorted(labels[labels > 0].astype(int))
-
-    node_coords = []
-    for label in labels:
-        voxel_coords = ndimage.center_of_mass(parc_data == label)
-        world_coords = nib.affines.apply_affine(affine, voxel_coords)
-        node_coords.append(world_coords)
+    matrix = load_connectome(connectome_file)
 
-    node_coords = np.array(node_coords)
+    # Centre of mass of every label, computed in a single pass
+    if centroids_file is not None:
+        _, node_coords = load_label_centroids(centroids_file)
+    else:
+        _, node_coords, _ = label_centroids(parcellation_t1w)
 
     connectome_info = _get_connectome(
         matrix,
@@ -231,15 +321,69 @@ def plot_connectome_interactive(
     return iframe
 
 
+def write_connectome_js(bids_entities):
+    """Write the JavaScript of the interactive connectome view to one file.
+
+    The file bundles the jQuery, plotly and surface plotting scripts that
+    nilearn otherwise embeds in every view. Its name holds a hash of its
+    content, so that all reports of a derivatives directory share one copy
+    and reports made with other nilearn versions keep theirs.
+
+    Parameters
+    ----------
+    bids_entities : dict
+        BIDS entities of the report, which set its depth below the
+        derivatives root
+
+    Returns
+    -------
+    js_file : str
+        Path to the JavaScript file, to be sunk to the derivatives root
+    js_url : str
+        Its URL relative to the sunk report
+    """
+    import hashlib
+    import os
+    from pathlib import Path
+    from nilearn.plotting import js_plotting_utils
+
+    js_dir = Path(js_plotting_utils.__file__).parent / "data" / "js"
+    bundle = ";\n".join(
+        (js_dir / name).read_text(encoding="utf-8")
+        for name in (
+            "jquery.min.js",
+            "plotly-gl3d-latest.min.js",
+            "surface-plot-utils.js",
+        )
+    )
+    digest = hashlib.sha256(bundle.encode()).hexdigest()[:16]
+    js_file = os.path.abspath(f"connectome_plot_{digest}.js")
+    with open(js_file, "w", encoding="utf-8") as f:
+        f.write(bundle)
+
+    # Reports are sunk to sub-<label>[/ses-<label>]/report/; the view is
+    # an iframe srcdoc, which resolves URLs against the report
+    depth = 3 if bids_entities.get("session") else 2
+    js_url = "../" * depth + os.path.basename(js_file)
+    return js_file, js_url
+
+
 def plot_connectome_heatmap(
-    connectome_file, title="Structural Connectome", labels_file=None
+    connectome_file,
+    title="Structural Connectome",
+    labels_file=None,
+    figure_format="svg",
+    dpi=100,
+    max_bytes=None,
 ):
     """Plot the lower-triangular connectome matrix as a seaborn heatmap.
 
     Parameters
     ----------
     connectome_file : str
-        Path to the connectome CSV produced by tck2connectome
+        Path to the connectome CSV produced by tck2connectome; its binary
+        companion is memory-mapped when present, see
+        ``tractography.utils.connectome.load_connectome``
     title : str
         Title for the plot
     labels_file : str or None
@@ -247,22 +391,29 @@ def plot_connectome_heatmap(
         Expected format: tab-separated with index in column 0 and
         region name in column 1. When provided, region names are used
         as tick labels on the heatmap axes.
+    figure_format : {"svg", "png", "webp"}
+        Output format; png and webp are rasterised at ``dpi`` and
+        compressed to at most ``max_bytes``, see
+        ``tractography.utils.figures.save_figure``
+    dpi : float
+        Resolution of rasterised figures
+    max_bytes : int or None
+        Byte budget of rasterised figures
 
     Returns
     -------
     out_file : str
-        Path to output SVG file
+        Path to output figure
     """
     import numpy as np
     import matplotlib.pyplot as plt
     import seaborn as sns
-    import os
+    from tractography.utils.connectome import load_connectome
+    from tractography.utils.figures import save_figure
 
-    matrix = np.loadtxt(connectome_file, delimiter=",")
-
-    # tck2connectome outputs an upper-triangular matrix; reflect it to lower
-    # by symmetrising (avoid doubling the diagonal values)
-    matrix = matrix + matrix.T - np.diag(np.diag(matrix))
+    # tck2connectome outputs an upper-triangular matrix, symmetrised here
+    # (or memory-mapped already symmetrised from its binary companion)
+    matrix = load_connectome(connectome_file)
 
     # Log-scale for better dynamic range visualisation (zeros stay zero)
     matrix_log = np.log1p(matrix)
@@ -312,11 +463,85 @@ def plot_connectome_heatmap(
 
     ax.set_title(title, fontsize=fontsize + 2)
 
-    out_file = "connectome_heatmap.svg"
-    fig.savefig(out_file, format="svg", bbox_inches="tight")
+    out_file = save_figure(
+        fig,
+        "connectome_heatmap",
+        figure_format,
+        dpi,
+        max_bytes,
+        bbox_inches="tight",
+    )
     plt.close(fig)
 
-    return os.path.abspath(out_file)
+    return out_file
+
+
+def plot_streamline_stats(
+    tck_file, n_jobs=1, figure_format="svg", dpi=100, max_bytes=None
+):
+    """Summarise streamline geometry and plot its distributions.
+
+    Parameters
+    ----------
+    tck_file : str
+        Path to the .tck tractogram
+    n_jobs : int
+        Number of processes used to stream the tractogram
+    figure_format : {"svg", "png", "webp"}
+        Output format; png and webp are rasterised at ``dpi`` and
+        compressed to at most ``max_bytes``, see
+        ``tractography.utils.figures.save_figure``
+    dpi : float
+        Resolution of rasterised figures
+    max_bytes : int or None
+        Byte budget of rasterised figures
+
+    Returns
+    -------
+    stats_file : str
+        Path to the TSV summary (one row per metric)
+    out_file : str
+        Path to output figure with the histogram of each metric
+    """
+    import matplotlib.pyplot as plt
+    import numpy as np
+    import os
+    from tractography.utils.figures import save_figure
+    from tractography.utils.streamline_stats import (
+        UNITS,
+        compute_streamline_stats,
+        save_streamline_stats,
+    )
+
+    stats = compute_streamline_stats(tck_file, n_jobs=n_jobs)
+    stats_file = save_streamline_stats(
+        stats, os.path.abspath("streamline_stats.tsv")
+    )
+
+    fig, axes = plt.subplots(2, 2, figsize=(11, 7))
+    for ax, (name, metric) in zip(axes.ravel(), stats.items()):
+        histogram, edges = metric["histogram"], metric["bin_edges"]
+        # Only show the populated part of the histogram range
+        populated = np.flatnonzero(histogram)
+        if len(populated):
+            stop = populated[-1] + 1
+            ax.stairs(histogram[:stop], edges[: stop + 1], fill=True)
+            ax.axvline(metric["p50"], color="k", linestyle="--", linewidth=1)
+        ax.set_xlabel(f"{name.replace('_', ' ')} ({UNITS[name]})")
+        ax.set_ylabel("streamlines")
+    fig.tight_layout()
+
+    out_file = save_figure(
+        fig,
+        "streamline_stats",
+        figure_format,
+        dpi,
+        max_bytes,
+        bbox_inches="tight",
+    )
+    plt.close(fig)
+
+    return stats_file, out_file
 
 
 def create_html_report(
@@ -328,8 +553,14 @@ def create_html_report(
     plots,
     n_streamlines=10000000,
     plot_connectome_interactive=None,
+    plot_streamline_stats=None,
+    streamline_stats_file=None,
+    embed_figures=True,
 ):
+    import base64
+    import csv
     import os
+    import shutil
     import string
     from nilearn.plotting.html_document import HTMLDocument
 
@@ -342,6 +573,40 @@ def create_html_report(
 
         return string_text
 
+    def _figure_html(figure_file):
+        # SVG figures are inlined; rasterised ones are embedded as base64
+        # or, with embed_figures=False, copied next to the report
+        extension = os.path.splitext(figure_file)[1][1:].lower()
+        if extension == "svg":
+            with open(figure_file, "r", encoding="utf-8") as f:
+                return f.read()
+        if embed_figures:
+            with open(figure_file, "rb") as f:
+                data = base64.b64encode(f.read()).decode("ascii")
+            src = f"data:image/{extension};base64,{data}"
+        else:
+            shutil.copyfile(
+                figure_file,
+                os.path.join(figures_dir, os.path.basename(figure_file)),
+            )
+            src = "/".join(
+                (os.path.basename(figures_dir), os.path.basename(figure_file))
+            )
+        return f'<img src="{src}" style="max-width:100%;height:auto;">'
+
+    def _stats_table(stats_file):
+        with open(stats_file, newline="") as f:
+            rows = list(csv.reader(f, delimiter="\t"))
+        header = "".join(f"<th>{cell}</th>" for cell in rows[0])
+        body = "".join(
+            "<tr>" + "".join(f"<td>{cell}</td>" for cell in row) + "</tr>"
+            for row in rows[1:]
+        )
+        return (
+            "<table class='stats-table'>"
+            f"<thead><tr>{header}</tr></thead><tbody>{body}</tbody></table>"
+        )
+
     def _get_html_text(subject_id, *args):
         _not_available = (
             "<p style='color:#999;font-style:italic;'>"
@@ -354,15 +619,22 @@ def create_html_report(
             "n_streamlines": f"{n_streamlines:,}",
             "plot_connectome_interactive": plot_connectome_interactive
             or _not_available,
+            "streamline_stats_table": (
+                _stats_table(streamline_stats_file)
+                if streamline_stats_file
+                else ""
+            ),
+            "plot_streamline_stats": "",
         }
+        if plot_streamline_stats:
+            to_embed["plot_streamline_stats"] = _figure_html(
+                plot_streamline_stats
+            )
         plot_names = ["plot_tdi_t1w", "plot_connectome", "plot_parc_t1w"]
 
         for idx, plot in enumerate(args):
             if plot is not None and idx < len(plot_names):
-                with open(plot, "r", encoding="utf-8") as f:
-                    svg_text = f.read()
-                f.close()
-                to_embed[plot_names[idx]] = svg_text
+                to_embed[plot_names[idx]] = _figure_html(plot)
 
         return _embed_svg(to_embed)
 
@@ -380,7 +652,6 @@ def create_html_report(
                 bids_name += f"{replacements[key]}{value}"
         return bids_name
 
-    html_text = _get_html_text(bids_entities["subject"], *plots)
     bids_name = _build_bids(bids_entities)
     out_file = os.path.join(
         output_dir,
@@ -388,9 +659,16 @@ def create_html_report(
         report_wf_name,
         f"{bids_name}_report.html",
     )
+    figures_dir = None
+    if not embed_figures:
+        figures_dir = os.path.join(
+            os.path.dirname(out_file), f"{bids_name}_figures"
+        )
+        os.makedirs(figures_dir, exist_ok=True)
+    html_text = _get_html_text(bids_entities["subject"], *plots)
     report_html = HTMLDocument(html_text).save_as_html(out_file)
     print(f"Report for {calling_wf_name} created at {out_file}")
-    return out_file
+    return out_file, figures_dir
 
 
 def init_report_wf(
@@ -399,6 +677,14 @@ def init_report_wf(
     name="report",
     has_connectome=False,
     n_streamlines=10000000,
+    n_threads=1,
+    figure_format="svg",
+    figure_dpi=100,
+    figure_max_bytes=None,
+    embed_figures=True,
+    mesh_max_triangles=None,
+    mesh_cache_dir=None,
+    shared_js=False,
 ):
     """Create a workflow to generate a report for the diffusion preprocessing
     pipeline.
@@ -412,6 +698,29 @@ def init_report_wf(
         subdirectory called 'report' in this directory to store the reports.
     name : str, optional, by default "report"
         Name of the workflow
+    n_threads : int, optional, by default 1
+        Number of processes used to compute the track density image and
+        the streamline statistics
+    figure_format : {"svg", "png", "webp"}, optional, by default "svg"
+        Format of the static figures; png and webp figures are rasterised
+        at ``figure_dpi`` and compressed to at most ``figure_max_bytes``,
+        so their size does not grow with the number of elements drawn
+    figure_dpi : float, optional, by default 100
+        Resolution of rasterised figures
+    figure_max_bytes : int or None, optional, by default None
+        Byte budget of each rasterised figure
+    embed_figures : bool, optional, by default True
+        Embed rasterised figures in the report as base64; otherwise they
+        are copied to a ``<report>_figures`` directory next to the report
+    mesh_max_triangles : int or None, optional, by default None
+        Triangle budget of each surface of the interactive connectome;
+        None keeps the full resolution
+    mesh_cache_dir : str or None, optional, by default None
+        Directory caching the decimated surfaces across runs
+    shared_js : bool, optional, by default False
+        Load the JavaScript of the interactive connectome from one file in
+        the derivatives root (the ``js_asset`` output), instead of
+        embedding it in every report. Only the sunk reports find it.
 
     Returns
     -------
@@ -440,34 +749,62 @@ def init_report_wf(
         name="report_inputnode",
     )
     outputnode = Node(
-        IdentityInterface(fields=["out_file"]),
+        IdentityInterface(
+            fields=["out_file", "stats_file", "figures_dir", "js_asset"]
+        ),
         name="report_outputnode",
     )
 
-    # ===== Track Density Image (TDI) Computation =====
-
-    # Compute TDI with T1w as template
-    tdi_t1w = Node(
-        interface=ComputeTDI(),
-        name="tdi_t1w",
-    )
-    tdi_t1w.inputs.out_file = "tdi_t1w.nii.gz"
-
     # ===== Tractography Plotting Nodes =====
 
-    # Plot TDI on T1w
+    # Plot TDI on T1w; the TDI is computed in-process from the streamlines
+    # on the T1w grid, streaming the tractogram once
     PlotTDIT1W = Function(
-        input_names=["tdi_file", "background_file", "title"],
+        input_names=[
+            "tdi_file",
+            "background_file",
+            "title",
+            "n_jobs",
+            "figure_format",
+            "dpi",
+            "max_bytes",
+        ],
         output_names=["out_file"],
         function=plot_tdi_on_image,
     )
-    plot_tdi_t1w = Node(PlotTDIT1W, name="plot_tdi_t1w")
+    plot_tdi_t1w = Node(PlotTDIT1W, name="plot_tdi_t1w", n_procs=n_threads)
     plot_tdi_t1w.inputs.title = "Track Density on T1w"
+    plot_tdi_t1w.inputs.n_jobs = n_threads
+
+    # Length, endpoint distance and curvature distributions of the
+    # streamlines, plotted and saved as a TSV
+    PlotStreamlineStats = Function(
+        input_names=[
+            "tck_file",
+            "n_jobs",
+            "figure_format",
+            "dpi",
+            "max_bytes",
+        ],
+        output_names=["stats_file", "out_file"],
+        function=plot_streamline_stats,
+    )
+    plot_stats = Node(
+        PlotStreamlineStats, name="plot_streamline_stats", n_procs=n_threads
+    )
+    plot_stats.inputs.n_jobs = n_threads
 
     if has_connectome:
         # Plot connectome as a heatmap
         PlotConnectome = Function(
-            input_names=["connectome_file", "title", "labels_file"],
+            input_names=[
+                "connectome_file",
+                "title",
+                "labels_file",
+                "figure_format",
+                "dpi",
+                "max_bytes",
+            ],
             output_names=["out_file"],
             function=plot_connectome_heatmap,
         )
@@ -475,24 +812,72 @@ def init_report_wf(
         plot_connectome.inputs.title = "Structural Connectome"
 
         # Interactive 3D connectome visualisation on subject pial surface
+        # Node coordinates of the connectome views, once per parcellation
+        LabelCentroids = Function(
+            input_names=["parcellation_t1w"],
+            output_names=["out_file"],
+            function=compute_label_centroids,
+        )
+        label_centroids = Node(LabelCentroids, name="label_centroids")
+
         PlotConnectomeInteractive = Function(
-            input_names=["connectome_file", "parcellation_t1w", "surfaces_t1"],
+            input_names=[
+                "connectome_file",
+                "parcellation_t1w",
+                "surfaces_t1",
+                "centroids_file",
+                "max_triangles",
+                "mesh_cache_dir",
+                "js_lib_url",
+            ],
             output_names=["html_str"],
             function=plot_connectome_interactive,
         )
         plot_connectome_interactive_node = Node(
             PlotConnectomeInteractive, name="plot_connectome_interactive"
         )
+        if mesh_max_triangles is not None:
+            plot_connectome_interactive_node.inputs.max_triangles = (
+                mesh_max_triangles
+            )
+            if mesh_cache_dir is not None:
+                plot_connectome_interactive_node.inputs.mesh_cache_dir = (
+                    mesh_cache_dir
+                )
+        if shared_js:
+            # One copy of the plotting libraries for all reports
+            WriteConnectomeJS = Function(
+                input_names=["bids_entities"],
+                output_names=["js_file", "js_url"],
+                function=write_connectome_js,
+            )
+            connectome_js = Node(WriteConnectomeJS, name="connectome_js")
 
         # Plot parcellation overlaid on T1w for registration QC
         PlotParcT1W = Function(
-            input_names=["parcellation_t1w", "t1w_file", "title"],
+            input_names=[
+                "parcellation_t1w",
+                "t1w_file",
+                "title",
+                "figure_format",
+                "dpi",
+                "max_bytes",
+            ],
             output_names=["out_file"],
             function=plot_parcellation_on_t1w,
         )
         plot_parc_t1w = Node(PlotParcT1W, name="plot_parc_t1w")
         plot_parc_t1w.inputs.title = "Parcellation Registration QC"
 
+    figure_nodes = [plot_tdi_t1w, plot_stats]
+    if has_connectome:
+        figure_nodes += [plot_connectome, plot_parc_t1w]
+    for figure_node in figure_nodes:
+        figure_node.inputs.figure_format = figure_format
+        figure_node.inputs.dpi = figure_dpi
+        if figure_max_bytes is not None:
+            figure_node.inputs.max_bytes = figure_max_bytes
+
     # Create a Merge node to collect all plots
     merge_node = Node(Merge(3 if has_connectome else 1), name="merge_node")
 
@@ -507,8 +892,11 @@ def init_report_wf(
             "plots",
             "n_streamlines",
             "plot_connectome_interactive",
+            "plot_streamline_stats",
+            "streamline_stats_file",
+            "embed_figures",
         ],
-        output_names=["out_file"],
+        output_names=["out_file", "figures_dir"],
         function=create_html_report,
     )
     create_html = Node(CreateHTML, name="create_html")
@@ -517,38 +905,34 @@ def init_report_wf(
     create_html.inputs.template_path = REPORT_TEMPLATE
     create_html.inputs.output_dir = output_dir
     create_html.inputs.n_streamlines = n_streamlines
+    create_html.inputs.embed_figures = embed_figures
 
     workflow = Workflow(name=name, base_dir=output_dir)
     workflow.connect(
         [
-            # ===== TDI Computation Connections =====
-            # Compute TDI with T1w as reference template
-            (
-                inputnode,
-                tdi_t1w,
-                [
-                    ("streamlines", "in_file"),
-                    ("t1w", "reference"),
-                ],
-            ),
             # ===== TDI Plotting Connections =====
-            # Plot TDI on T1w
-            (
-                tdi_t1w,
-                plot_tdi_t1w,
-                [
-                    ("out_file", "tdi_file"),
-                ],
-            ),
+            # Compute the TDI on the T1w grid and plot it on the T1w
             (
                 inputnode,
                 plot_tdi_t1w,
                 [
+                    ("streamlines", "tdi_file"),
                     ("t1w", "background_file"),
                 ],
             ),
             # Add TDI plot to merge node
             (plot_tdi_t1w, merge_node, [("out_file", "in1")]),
+            # ===== Streamline Statistics Connections =====
+            (inputnode, plot_stats, [("streamlines", "tck_file")]),
+            (
+                plot_stats,
+                create_html,
+                [
+                    ("out_file", "plot_streamline_stats"),
+                    ("stats_file", "streamline_stats_file"),
+                ],
+            ),
+            (plot_stats, outputnode, [("stats_file", "stats_file")]),
         ]
     )
 
@@ -569,15 +953,41 @@ def init_report_wf(
                     plot_connectome_interactive_node,
                     [
                         ("connectome", "connectome_file"),
-                        ("parcellation_t1w", "parcellation_t1w"),
                         ("surfaces_t1", "surfaces_t1"),
                     ],
                 ),
+                (
+                    inputnode,
+                    label_centroids,
+                    [("parcellation_t1w", "parcellation_t1w")],
+                ),
+                (
+                    label_centroids,
+                    plot_connectome_interactive_node,
+                    [("out_file", "centroids_file")],
+                ),
                 (
                     plot_connectome_interactive_node,
                     create_html,
                     [("html_str", "plot_connectome_interactive")],
                 ),
+                *(
+                    [
+                        (
+                            inputnode,
+                            connectome_js,
+                            [("bids_entities", "bids_entities")],
+                        ),
+                        (
+                            connectome_js,
+                            plot_connectome_interactive_node,
+                            [("js_url", "js_lib_url")],
+                        ),
+                        (connectome_js, outputnode, [("js_file", "js_asset")]),
+                    ]
+                    if shared_js
+                    else []
+                ),
                 (
                     inputnode,
                     plot_parc_t1w,
@@ -597,7 +1007,11 @@ def init_report_wf(
             # create the html report
             (merge_node, create_html, [("out", "plots")]),
             # output the html report
-            (create_html, outputnode, [("out_file", "out_file")]),
+            (
+                create_html,
+                outputnode,
+                [("out_file", "out_file"), ("figures_dir", "figures_dir")],
+            ),
         ]
     )
     return workflow
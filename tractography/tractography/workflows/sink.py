@@ -3,10 +3,35 @@ from nipype.interfaces.utility import Function
 from nipype.interfaces.io import DataSink
 
 
+def _compress_streamlines(streamlines, tolerance=0.1, precision="float16"):
+    """Write a lossy-compressed copy of the tractogram and its JSON sidecar.
+
+    See ``tractography.utils.compress_tck.compress_tck``.
+    """
+    import os
+    from tractography.utils.compress_tck import EXTENSIONS, compress_tck
+
+    return compress_tck(
+        streamlines,
+        os.path.abspath(f"streamlines_compressed{EXTENSIONS[precision]}"),
+        tolerance=tolerance,
+        precision=precision,
+    )
+
+
 def init_sink_wf(config, name="sink_wf", parcellation_file=None, n_streamlines=10000000):
 
+    # When a compression tolerance is set, a compressed copy of the
+    # tractogram is sunk through the "streamlines" input
+    compress_tolerance = getattr(config, "compress_streamlines", None)
+
     inputnode = Node(
-        IdentityInterface(fields=["bids_entities"]),
+        IdentityInterface(
+            fields=[
+                "bids_entities",
+                *(["streamlines"] if compress_tolerance is not None else []),
+            ]
+        ),
         name="sinkinputnode",
     )
 
@@ -55,6 +80,24 @@ def init_sink_wf(config, name="sink_wf", parcellation_file=None, n_streamlines=1
                 "streamlines.tck",
                 f"{bids_name}_space-T1_desc-iFOD2+ACT+{n_streamlines_label}_tractography.tck",
             ),
+            (
+                "streamlines.trx",
+                f"{bids_name}_space-T1_desc-iFOD2+ACT+{n_streamlines_label}_tractography.trx",
+            ),
+            # Float16LE tractograms, unreadable by MRtrix3, keep a
+            # distinct extension
+            (
+                "streamlines_compressed.tck16",
+                f"{bids_name}_space-T1_desc-iFOD2+ACT+{n_streamlines_label}+compressed_tractography.tck16",
+            ),
+            (
+                "streamlines_compressed.tck",
+                f"{bids_name}_space-T1_desc-iFOD2+ACT+{n_streamlines_label}+compressed_tractography.tck",
+            ),
+            (
+                "streamlines_compressed.json",
+                f"{bids_name}_space-T1_desc-iFOD2+ACT+{n_streamlines_label}+compressed_tractography.json",
+            ),
             (
                 "wm_fod.mif",
                 f"{bids_name}_space-T1_desc-msmt+csd_wm_fod.mif",
@@ -75,10 +118,20 @@ def init_sink_wf(config, name="sink_wf", parcellation_file=None, n_streamlines=1
                 "t1_5tt.mif",
                 f"{bids_name}_space-T1_desc-5tissuetype_segmentation.mif",
             ),
+            (
+                "streamline_stats.tsv",
+                f"{bids_name}_space-T1_desc-iFOD2+ACT+{n_streamlines_label}+stats_tractography.tsv",
+            ),
             (
                 f"{bids_name}_report.html",
                 f"{bids_name}_report.html",
             ),
+            # Directory of the figures of reports built with
+            # --report-sidecar-figures, kept next to the report
+            (
+                f"{bids_name}_figures",
+                f"{bids_name}_figures",
+            ),
         ]
 
         if atlas_name:
@@ -88,11 +141,27 @@ def init_sink_wf(config, name="sink_wf", parcellation_file=None, n_streamlines=1
                     f"{bids_name}_atlas-{atlas_name}_desc-iFOD2+ACT+{n_streamlines_label}_connectome.csv",
                 )
             )
+            # Extra edge metrics of the python connectome engine
+            for metric in [
+                "lengthsum",
+                "meanlength",
+                "lengthstd",
+                "invlength",
+                "invnodevol",
+            ]:
+                substitutions.append(
+                    (
+                        f"connectome_{metric}.csv",
+                        f"{bids_name}_atlas-{atlas_name}_desc-iFOD2+ACT+{n_streamlines_label}+{metric}_connectome.csv",
+                    )
+                )
 
         # add root directory with derivatives/diffusion-tractography structure
         for i, (src, dst) in enumerate(substitutions):
 
             modality = dst.split("_")[-1].split(".")[0]
+            if modality == "figures":
+                modality = "report"
 
             if bids_entities.get("session"):
                 prefix = os.path.join(
@@ -135,4 +204,35 @@ def init_sink_wf(config, name="sink_wf", parcellation_file=None, n_streamlines=1
             (build_substitutions, sink, [("substitutions", "substitutions")]),
         ]
     )
+
+    if compress_tolerance is not None:
+        CompressStreamlines = Function(
+            input_names=["streamlines", "tolerance", "precision"],
+            output_names=["out_file", "sidecar_file"],
+            function=_compress_streamlines,
+        )
+        compress = Node(CompressStreamlines, name="compress_streamlines")
+        compress.inputs.tolerance = compress_tolerance
+        compress.inputs.precision = getattr(
+            config, "compressed_precision", "float16"
+        )
+        sink_wf.connect(
+            [
+                (inputnode, compress, [("streamlines", "streamlines")]),
+                (
+                    compress,
+                    sink,
+                    [
+                        (
+                            "out_file",
+                            "diffusion_tractography.@streamlines_compressed",
+                        ),
+                        (
+                            "sidecar_file",
+                            "diffusion_tractography.@streamlines_sidecar",
+                        ),
+                    ],
+                ),
+            ]
+        )
     return sink_wf
@@ -1,4 +1,6 @@
+import os
 from configparser import ConfigParser
+from pathlib import Path
 from nipype import DataGrabber, Node, Workflow, MapNode, Merge
 from nipype.interfaces.utility import IdentityInterface
 from nipype.interfaces.utility.wrappers import Function
@@ -29,23 +31,42 @@ from .sink import init_sink_wf
 from .report import init_report_wf
 
 
-def _merge_roi_files(parcellation_files):
+def _merge_roi_files(
+    parcellation_files, n_threads=1, cache_dir=None, cache_max_size=1024
+):
     """Merge one or more ROI/parcellation files into a single labelled volume.
 
     When a single file is supplied it is returned unchanged.  When multiple
     binary ROI masks are supplied:
 
-    1. Each mask is binarised (non-zero → ROI voxel).
+    1. Each mask is binarised (non-zero → ROI voxel). Masks are streamed
+       and stored as voxel indices, so the peak memory is about one volume
+       plus the label map whatever the number of ROIs.
     2. Any ROI whose voxels are more than 30 % covered by another ROI is
        considered engulfed: it is silently dropped and a warning is emitted
        to the nipype log.
     3. If after dropping engulfed ROIs any overlap remains, a ValueError is
        raised listing the offending pairs with per-ROI overlap percentages.
     4. Each surviving ROI is assigned a unique integer label (1, 2, 3 …) and
-       the masks are combined into one NIfTI file.
+       the masks are combined into one NIfTI file, stored with the
+       smallest integer type holding the labels.
+
+    Overlaps are found without comparing every pair of masks: one pass over
+    the masks counts how many ROIs cover each voxel, and the overlap of
+    each pair is then counted on the voxels covered more than once only.
+
+    Masks are loaded and decompressed by a pool of ``n_threads`` threads
+    (zlib releases the GIL), and merged as they arrive; at most
+    ``n_threads`` volumes are held at a time.
+
+    With ``cache_dir``, merges are looked up in (and added to) a persistent
+    cache keyed by the content of the ROI files and the engulf threshold,
+    shared by every subject and run, and holding at most ``cache_max_size``
+    MB; see ``tractography.utils.roi_cache.cached_roi_merge``.
     """
     import os
     import logging
+    from concurrent.futures import ThreadPoolExecutor, as_completed
     import nibabel as nib
     import numpy as np
 
@@ -61,36 +82,103 @@ def _merge_roi_files(parcellation_files):
     if len(parcellation_files) == 1:
         return parcellation_files[0]
 
-    imgs = [nib.load(f) for f in parcellation_files]
-    arrays = [img.get_fdata() for img in imgs]
-    binary = [(a > 0).astype(np.uint8) for a in arrays]
+    if cache_dir:
+        from tractography.utils.roi_cache import cached_roi_merge
+        from tractography.workflows.tracto import _merge_roi_files
+
+        return cached_roi_merge(
+            parcellation_files,
+            lambda: _merge_roi_files(parcellation_files, n_threads),
+            cache_dir,
+            _ENGULF_THRESHOLD,
+            max_bytes=int(cache_max_size * 2**20),
+        )
+
     names = [os.path.basename(f) for f in parcellation_files]
+    shape = nib.load(parcellation_files[0]).shape
+
+    # One pass over the masks: the voxels of every ROI (flat indices), and
+    # the number of ROIs covering every voxel. Masks are loaded in their
+    # stored dtype through the proxy, and only their indices are kept, so
+    # memory does not grow with the number of ROIs.
+    n_voxels = int(np.prod(shape))
+    index_dtype = np.min_scalar_type(n_voxels - 1)
+    coverage = np.zeros(
+        n_voxels, dtype=np.min_scalar_type(len(parcellation_files))
+    )
+
+    def _load_roi_voxels(name, f):
+        img = nib.load(f)
+        if img.shape != shape:
+            raise ValueError(
+                f"ROI file {name} has shape {img.shape}, expected {shape}"
+            )
+        roi_voxels = np.flatnonzero(np.asanyarray(img.dataobj) > 0)
+        return roi_voxels.astype(index_dtype)
+
+    voxels = [None] * len(parcellation_files)
+    with ThreadPoolExecutor(max(int(n_threads or 1), 1)) as pool:
+        futures = {
+            pool.submit(_load_roi_voxels, name, f): i
+            for i, (name, f) in enumerate(zip(names, parcellation_files))
+        }
+        for future in as_completed(futures):
+            roi_voxels = future.result()
+            coverage[roi_voxels] += 1
+            voxels[futures[future]] = roi_voxels
+    sizes = np.array([len(v) for v in voxels])
+
+    # Overlap of every pair of ROIs, counted on the shared voxels only:
+    # each shared voxel adds one to the pairs of ROIs covering it
+    shared_voxels, shared_rois = [], []
+    for i, roi_voxels in enumerate(voxels):
+        shared = roi_voxels[coverage[roi_voxels] > 1]
+        shared_voxels.append(shared)
+        shared_rois.append(np.full(len(shared), i))
+    shared_voxels = np.concatenate(shared_voxels)
+    shared_rois = np.concatenate(shared_rois)
+    order = np.lexsort((shared_rois, shared_voxels))
+    shared_rois = shared_rois[order]
+    _, starts, counts = np.unique(
+        shared_voxels[order], return_index=True, return_counts=True
+    )
+    pair_keys = []
+    for k in np.unique(counts):
+        # Voxels covered by k ROIs, as rows of their k ROIs (ascending)
+        rows = shared_rois[starts[counts == k][:, None] + np.arange(k)]
+        a, b = np.triu_indices(k, 1)
+        pair_keys.append((rows[:, a] * len(voxels) + rows[:, b]).ravel())
+    overlaps = {}
+    if pair_keys:
+        keys, n_shared = np.unique(
+            np.concatenate(pair_keys), return_counts=True
+        )
+        overlaps = {
+            divmod(int(key), len(voxels)): int(n)
+            for key, n in zip(keys, n_shared)
+        }
 
     # Identify engulfed ROIs (pairwise)
     to_drop = set()
-    for i in range(len(binary)):
-        for j in range(i + 1, len(binary)):
-            n = int(np.sum(binary[i] & binary[j]))
-            if n == 0:
-                continue
-            pct_i = 100.0 * n / max(int(binary[i].sum()), 1)
-            pct_j = 100.0 * n / max(int(binary[j].sum()), 1)
-            if pct_i > _ENGULF_THRESHOLD:
-                logger.warning(
-                    "merge_rois: dropping '%s' — %.1f%% of its voxels overlap "
-                    "with '%s' (threshold %.0f%%)",
-                    names[i], pct_i, names[j], _ENGULF_THRESHOLD,
-                )
-                to_drop.add(i)
-            if pct_j > _ENGULF_THRESHOLD:
-                logger.warning(
-                    "merge_rois: dropping '%s' — %.1f%% of its voxels overlap "
-                    "with '%s' (threshold %.0f%%)",
-                    names[j], pct_j, names[i], _ENGULF_THRESHOLD,
-                )
-                to_drop.add(j)
+    for (i, j), n in overlaps.items():
+        pct_i = 100.0 * n / max(int(sizes[i]), 1)
+        pct_j = 100.0 * n / max(int(sizes[j]), 1)
+        if pct_i > _ENGULF_THRESHOLD:
+            logger.warning(
+                "merge_rois: dropping '%s' — %.1f%% of its voxels overlap "
+                "with '%s' (threshold %.0f%%)",
+                names[i], pct_i, names[j], _ENGULF_THRESHOLD,
+            )
+            to_drop.add(i)
+        if pct_j > _ENGULF_THRESHOLD:
+            logger.warning(
+                "merge_rois: dropping '%s' — %.1f%% of its voxels overlap "
+                "with '%s' (threshold %.0f%%)",
+                names[j], pct_j, names[i], _ENGULF_THRESHOLD,
+            )
+            to_drop.add(j)
 
-    kept = [(i, imgs[i], binary[i]) for i in range(len(binary)) if i not in to_drop]
+    kept = [i for i in range(len(voxels)) if i not in to_drop]
 
     if not kept:
         raise ValueError(
@@ -100,22 +188,17 @@ def _merge_roi_files(parcellation_files):
         )
 
     if len(kept) == 1:
-        return parcellation_files[kept[0][0]]
-
-    kept_indices, kept_imgs, kept_binary = zip(*kept)
+        return parcellation_files[kept[0]]
 
     # Remaining overlaps are an error
-    overlap_map = sum(kept_binary)
-    if np.any(overlap_map > 1):
-        pairs = []
-        for i in range(len(kept_binary)):
-            for j in range(i + 1, len(kept_binary)):
-                n = int(np.sum(kept_binary[i] & kept_binary[j]))
-                if n > 0:
-                    pct_i = 100.0 * n / max(int(kept_binary[i].sum()), 1)
-                    pct_j = 100.0 * n / max(int(kept_binary[j].sum()), 1)
-                    pairs.append((names[kept_indices[i]], names[kept_indices[j]],
-                                  n, pct_i, pct_j))
+    pairs = [
+        (names[i], names[j], n,
+         100.0 * n / max(int(sizes[i]), 1),
+         100.0 * n / max(int(sizes[j]), 1))
+        for (i, j), n in overlaps.items()
+        if i not in to_drop and j not in to_drop
+    ]
+    if pairs:
         pair_lines = "\n".join(
             f"  {a} <-> {b}: {n} vox ({pi:.1f}% of {a}, {pj:.1f}% of {b})"
             for a, b, n, pi, pj in pairs
@@ -125,15 +208,81 @@ def _merge_roi_files(parcellation_files):
             f"Overlapping pairs:\n{pair_lines}"
         )
 
-    merged = np.zeros(arrays[0].shape, dtype=np.int32)
-    for label, mask in enumerate(kept_binary, start=1):
-        merged[mask > 0] = label
+    # Smallest integer type holding every label
+    merged = np.zeros(shape, dtype=np.min_scalar_type(len(kept)))
+    for label, i in enumerate(kept, start=1):
+        merged.flat[voxels[i]] = label
 
     out_file = os.path.abspath("merged_parcellation.nii.gz")
-    nib.save(nib.Nifti1Image(merged, kept_imgs[0].affine, kept_imgs[0].header), out_file)
+    reference = nib.load(parcellation_files[kept[0]])
+    # The reference header keeps the on-disk type and scaling of the ROI;
+    # store the labels as they are instead
+    header = reference.header.copy()
+    header.set_data_dtype(merged.dtype)
+    header.set_slope_inter(1, 0)
+    nib.save(nib.Nifti1Image(merged, reference.affine, header), out_file)
+    return out_file
+
+
+def _binary_connectome(connectome_file):
+    """Place a connectome CSV next to its binary companion.
+
+    The CSV is linked into the working directory and the symmetric float32
+    companion of ``tractography.utils.connectome.save_binary_connectome``
+    is written beside it, so that the report nodes memory-map it instead
+    of parsing the CSV.
+    """
+    import os
+    import shutil
+    from tractography.utils.connectome import save_binary_connectome
+
+    out_file = os.path.abspath(os.path.basename(connectome_file))
+    if os.path.lexists(out_file):
+        os.remove(out_file)
+    try:
+        os.link(connectome_file, out_file)
+    except OSError:
+        shutil.copyfile(connectome_file, out_file)
+    save_binary_connectome(out_file)
     return out_file
 
 
+def _build_connectomes(streamlines, parcellation, n_jobs=1):
+    """Compute every connectome metric from a single pass over the streamlines.
+
+    Python counterpart of tck2connectome, see
+    ``tractography.utils.connectome.compute_connectomes``. The streamline
+    count matrix is written as ``connectome.csv``, like tck2connectome does,
+    and the other metrics as ``connectome_<metric>.csv``. The count matrix
+    also gets its binary companion, see ``_binary_connectome``.
+    """
+    from tractography.utils.connectome import (
+        compute_connectomes,
+        save_binary_connectome,
+        save_connectomes,
+    )
+
+    connectomes = compute_connectomes(streamlines, parcellation, n_jobs=n_jobs)
+    out_files = save_connectomes(connectomes)
+    save_binary_connectome(out_files["count"], connectomes["count"])
+    other_files = [f for name, f in out_files.items() if name != "count"]
+    return out_files["count"], other_files
+
+
+def _convert_to_trx(streamlines, reference):
+    """Convert the tractogram to TRX, streaming the .tck once.
+
+    See ``tractography.utils.trx.tck_to_trx``; the header records the grid
+    of ``reference`` (the T1w the streamlines were tracked in).
+    """
+    import os
+    from tractography.utils.trx import tck_to_trx
+
+    return tck_to_trx(
+        streamlines, os.path.abspath("streamlines.trx"), reference
+    )
+
+
 # Custom Generate5tt interface with proper lut_file positioning
 class Generate5ttWithLUT(MRTrix3Base):
     """Generate5tt with LUT file support using explicit command line building."""
@@ -325,7 +474,6 @@ def _set_inputs_outputs(config, tracto_wf):
                 tracto_wf.get_node("output_subject"),
                 sink_wf.get_node("sink"),
                 [
-                    ("streamlines", "diffusion_tractography.@streamlines"),
                     ("wm_fod", "diffusion_tractography.@wm_fod"),
                     ("gm_fod", "diffusion_tractography.@gm_fod"),
                     ("csf_fod", "diffusion_tractography.@csf_fod"),
@@ -333,6 +481,36 @@ def _set_inputs_outputs(config, tracto_wf):
                     ("t1_5tt", "diffusion_tractography.@t1_5tt"),
                 ],
             ),
+            # The tractogram is sunk as is unless only its compressed copy,
+            # made by the sink workflow, is kept
+            *(
+                [
+                    (
+                        tracto_wf.get_node("output_subject"),
+                        sink_wf,
+                        [("streamlines", "sinkinputnode.streamlines")],
+                    )
+                ]
+                if getattr(config, "compress_streamlines", None) is not None
+                else []
+            ),
+            *(
+                []
+                if getattr(config, "compress_streamlines", None) is not None
+                and getattr(config, "compressed_only", False)
+                else [
+                    (
+                        tracto_wf.get_node("output_subject"),
+                        sink_wf.get_node("sink"),
+                        [
+                            (
+                                "streamlines",
+                                "diffusion_tractography.@streamlines",
+                            )
+                        ],
+                    )
+                ]
+            ),
             *(
                 [
                     (
@@ -344,6 +522,34 @@ def _set_inputs_outputs(config, tracto_wf):
                 if parcellation_files
                 else []
             ),
+            *(
+                [
+                    (
+                        tracto_wf.get_node("output_subject"),
+                        sink_wf.get_node("sink"),
+                        [
+                            (
+                                "connectome_metrics",
+                                "diffusion_tractography.@connectome_metrics",
+                            )
+                        ],
+                    )
+                ]
+                if parcellation_files
+                and getattr(config, "connectome_engine", None) == "python"
+                else []
+            ),
+            *(
+                [
+                    (
+                        tracto_wf.get_node("output_subject"),
+                        sink_wf.get_node("sink"),
+                        [("trx", "diffusion_tractography.@trx")],
+                    )
+                ]
+                if getattr(config, "trx", False)
+                else []
+            ),
             (
                 tracto_wf.get_node("report"),
                 sink_wf.get_node("sink"),
@@ -351,9 +557,46 @@ def _set_inputs_outputs(config, tracto_wf):
                     (
                         "report_outputnode.out_file",
                         "diffusion_tractography.@report",
-                    )
+                    ),
+                    (
+                        "report_outputnode.stats_file",
+                        "diffusion_tractography.@streamline_stats",
+                    ),
                 ],
             ),
+            *(
+                [
+                    (
+                        tracto_wf.get_node("report"),
+                        sink_wf.get_node("sink"),
+                        [
+                            (
+                                "report_outputnode.figures_dir",
+                                "diffusion_tractography.@report_figures",
+                            )
+                        ],
+                    )
+                ]
+                if getattr(config, "report_sidecar_figures", False)
+                else []
+            ),
+            *(
+                [
+                    (
+                        tracto_wf.get_node("report"),
+                        sink_wf.get_node("sink"),
+                        [
+                            (
+                                "report_outputnode.js_asset",
+                                "diffusion_tractography.@report_js",
+                            )
+                        ],
+                    )
+                ]
+                if getattr(config, "report_shared_js", False)
+                and parcellation_files
+                else []
+            ),
         ]
     )
     return tracto_wf
@@ -493,18 +736,44 @@ def _tracto_wf(
         getattr(config, "parcellation_file", None)
         or getattr(config, "roi_dir", None)
     )
+    use_python_connectome = (
+        getattr(config, "connectome_engine", None) == "python"
+    )
+    n_threads = (
+        config.n_threads
+        if config and getattr(config, "n_threads", None)
+        else 1
+    )
+    write_trx = bool(config and getattr(config, "trx", False))
 
     if has_parcellation:
         # Merge multiple binary ROI masks into a single labelled parcellation
         # (no-op when a single file is provided; raises if ROIs overlap)
         merge_rois = Node(
             interface=Function(
-                input_names=["parcellation_files"],
+                input_names=[
+                    "parcellation_files",
+                    "n_threads",
+                    "cache_dir",
+                    "cache_max_size",
+                ],
                 output_names=["out_file"],
                 function=_merge_roi_files,
             ),
             name="merge_rois",
+            n_procs=n_threads,
         )
+        # ROI files are loaded and decompressed in parallel threads
+        merge_rois.inputs.n_threads = n_threads
+        # Merges are shared by all subjects and runs through a cache
+        roi_cache_size = getattr(config, "roi_cache_max_size", 1024)
+        if roi_cache_size:
+            roi_cache_dir = getattr(config, "roi_cache_dir", None) or (
+                Path(getattr(config, "work_dir", None) or "work")
+                / "roi_cache"
+            )
+            merge_rois.inputs.cache_dir = os.path.abspath(roi_cache_dir)
+            merge_rois.inputs.cache_max_size = roi_cache_size
 
         # Register parcellation from standard space to T1w space
         # NearestNeighbor interpolation preserves integer label values
@@ -519,11 +788,49 @@ def _tracto_wf(
         )
 
         # Compute structural connectome from streamlines and parcellation
-        tck2connectome = Node(
-            interface=BuildConnectome(),
-            name="tck2connectome",
+        if use_python_connectome:
+            # One pass over the streamlines for all edge metrics
+            tck2connectome = Node(
+                interface=Function(
+                    input_names=["streamlines", "parcellation", "n_jobs"],
+                    output_names=["out_file", "out_files"],
+                    function=_build_connectomes,
+                ),
+                name="build_connectomes",
+                n_procs=n_threads,
+            )
+            tck2connectome.inputs.n_jobs = n_threads
+            tracks_input, parc_input = "streamlines", "parcellation"
+        else:
+            tck2connectome = Node(
+                interface=BuildConnectome(),
+                name="tck2connectome",
+            )
+            tck2connectome.inputs.out_file = "connectome.csv"
+            tracks_input, parc_input = "in_file", "in_parc"
+
+        # Where the connectome CSV and its binary companion are taken from
+        connectome_source = tck2connectome
+        if not use_python_connectome:
+            connectome_source = Node(
+                interface=Function(
+                    input_names=["connectome_file"],
+                    output_names=["out_file"],
+                    function=_binary_connectome,
+                ),
+                name="binary_connectome",
+            )
+
+    if write_trx:
+        # Memory-mappable copy of the tractogram
+        convert_to_trx = Node(
+            interface=Function(
+                input_names=["streamlines", "reference"],
+                output_names=["out_file"],
+                function=_convert_to_trx,
+            ),
+            name="convert_to_trx",
         )
-        tck2connectome.inputs.out_file = "connectome.csv"
 
     # ===== Output Node =====
     output_subject = Node(
@@ -536,6 +843,12 @@ def _tracto_wf(
                 "gmwm_boundary",
                 "t1_5tt",
                 *(["connectome"] if has_parcellation else []),
+                *(
+                    ["connectome_metrics"]
+                    if has_parcellation and use_python_connectome
+                    else []
+                ),
+                *(["trx"] if write_trx else []),
             ],
         ),
         name="output_subject",
@@ -547,6 +860,21 @@ def _tracto_wf(
         output_dir=output_dir,
         has_connectome=bool(has_parcellation),
         n_streamlines=nstreamlines,
+        n_threads=n_threads,
+        figure_format=getattr(config, "report_format", "svg"),
+        figure_dpi=getattr(config, "report_dpi", 100),
+        figure_max_bytes=(
+            round(getattr(config, "report_figure_budget", 1024) * 1024)
+            or None
+        ),
+        embed_figures=not getattr(config, "report_sidecar_figures", False),
+        mesh_max_triangles=getattr(config, "report_mesh_triangles", 10000)
+        or None,
+        # Decimated surfaces are shared by all runs through a cache
+        mesh_cache_dir=os.path.abspath(
+            Path(getattr(config, "work_dir", None) or "work") / "mesh_cache"
+        ),
+        shared_js=getattr(config, "report_shared_js", False),
     )
 
     # Build workflow
@@ -649,21 +977,21 @@ def _tracto_wf(
                     ],
                 ),
                 # Compute connectome from streamlines and T1w-space parcellation
-                (tckgen, tck2connectome, [("out_file", "in_file")]),
+                (tckgen, tck2connectome, [("out_file", tracks_input)]),
                 (
                     apply_transform_parc,
                     tck2connectome,
-                    [("output_image", "in_parc")],
+                    [("output_image", parc_input)],
                 ),
                 # Collect connectome output
                 (
-                    tck2connectome,
+                    connectome_source,
                     output_subject,
                     [("out_file", "connectome")],
                 ),
                 # Forward connectome, labels, and parcellation overlay to report
                 (
-                    tck2connectome,
+                    connectome_source,
                     report,
                     [("out_file", "report_inputnode.connectome")],
                 ),
@@ -685,6 +1013,30 @@ def _tracto_wf(
             ]
         )
 
+    if write_trx:
+        workflow.connect(
+            [
+                (tckgen, convert_to_trx, [("out_file", "streamlines")]),
+                (
+                    input_subject,
+                    convert_to_trx,
+                    [("preprocessed_t1", "reference")],
+                ),
+                (convert_to_trx, output_subject, [("out_file", "trx")]),
+            ]
+        )
+
+    if has_parcellation and not use_python_connectome:
+        workflow.connect(
+            tck2connectome, "out_file", connectome_source, "connectome_file"
+        )
+
+    if has_parcellation and use_python_connectome:
+        # Collect the extra edge metrics of the python engine
+        workflow.connect(
+            tck2connectome, "out_files", output_subject, "connectome_metrics"
+        )
+
     workflow.connect(
         [
             (